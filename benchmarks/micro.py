@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+"""
+Micro-benchmarks of the classifier checks and the verifier predicates.
+Emulation traces and symbolic states are captured once from a binary, then replayed through each function,
+so that the measures do not depend on unicorn, angr stepping or random values.
+
+usage: python benchmarks/micro.py capture <binary> [-o TRACES] [--limit N]
+       python benchmarks/micro.py run <traces> [--repeat N] [--only FUNCTIONS] [--json FILE]
+"""
+
+import argparse
+import json
+import os
+import pickle
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ropd import Arch
+from ropd.Gadget import *
+import ropd.GadgetsCollector
+import ropd.GadgetsVerifier
+
+# the package exports the classes with the same name of the modules
+C = sys.modules['ropd.GadgetsCollector']
+V = sys.modules['ropd.GadgetsVerifier']
+
+TRACES_EXTENSION = '.traces'
+LIMIT = 500
+SEED = 0
+
+# classifier checks, called as in do_analysis: (arch, g, trace1, trace2) -> typed gadgets.
+# A trace is the tuple returned by emulate: (rv_pairs, final_values, rand_stack, sp_init,
+# address_written, address_read, flags_init, final_flags)
+CHECKS = (
+    ('checkStackPtrOpGadget', lambda a, g, t1, t2: C.checkStackPtrOpGadget(a, t1[0], t1[1], t2[0], t2[1], g)),
+    ('checkLoadConstGadget', lambda a, g, t1, t2: C.checkLoadConstGadget(a, t1[0], t1[2], t1[1], g)),
+    ('checkClearRegGadget', lambda a, g, t1, t2: C.checkClearRegGadget(a, t1[0], t1[2], t1[1], g)),
+    ('checkUnOpGadget', lambda a, g, t1, t2: C.checkUnOpGadget(a, t1[0], t1[2], t1[1], g)),
+    ('checkMovRegGadget', lambda a, g, t1, t2: C.checkMovRegGadget(a, t1[0], t1[2], t1[1], g)),
+    ('checkBinOpGadget', lambda a, g, t1, t2: C.checkBinOpGadget(a, t1[0], t1[2], t1[1], g)),
+    ('checkLahfGadget', lambda a, g, t1, t2: C.checkLahfGadget(a, t1[6], t1[7], t1[1], g)),
+    ('checkReadMemGadget', lambda a, g, t1, t2: C.checkReadMemGadget(a, t1[0], t1[1], t1[5], t2[0], t2[1], t2[5], g)),
+    ('checkWriteMemGadget', lambda a, g, t1, t2: C.checkWriteMemGadget(a, t1[0], t1[4], t2[0], t2[4], g)),
+    ('checkReadMemOpGadget', lambda a, g, t1, t2: C.checkReadMemOpGadget(a, t1[0], t1[1], t1[5], t2[0], t2[1], t2[5], g)),
+    ('checkWriteMemOpGadget', lambda a, g, t1, t2: C.checkWriteMemOpGadget(a, t1[0], t1[5], t1[4], t2[0], t2[5], t2[4], g)),
+)
+
+# verifier predicates of each gadget type, called as in do_verify
+VERIFIERS = {
+    MovReg_Gadget: 'verifyMovRegGadget', LoadConst_Gadget: 'verifyLoadConstGadget', ClearReg_Gadget: 'verifyClearRegGadget',
+    UnOp_Gadget: 'verifyUnOpGadget', BinOp_Gadget: 'verifyBinOpGadget', ReadMem_Gadget: 'verifyReadMemGadget',
+    WriteMem_Gadget: 'verifyWriteMemGadget', ReadMemOp_Gadget: 'verifyReadMemOpGadget',
+    WriteMemOp_Gadget: 'verifyWriteMemOpGadget', Lahf_Gadget: 'verifyLahfGadget', StackPtrOp_Gadget: 'verifyStackPtrOpGadget',
+}
+
+
+def classify(arch, g, trace1, trace2):
+    """
+    Runs all the checks on the traces, as do_analysis does
+    """
+    typed_gadgets = C.checkStackPtrOpGadget(arch, trace1[0], trace1[1], trace2[0], trace2[1], g)
+    if g.stack_fix < 4 or g.stack_fix > 0x1000 or type(g) is Other_Gadget:
+        return None
+    for (name, check) in CHECKS[1:]:
+        typed_gadgets += check(arch, g, trace1, trace2)
+    return typed_gadgets
+
+
+def capture(binary, filename, limit):
+    """
+    Emulates the first limit gadgets of binary and symbolically executes the ones classified, saving traces and states
+    """
+    random.seed(SEED)
+    collector = C.GadgetsCollector(binary)
+    gadgets = collector.collect()
+    arch = collector.arch
+    classifier = []
+    typed_gadgets = []
+    for g in sorted(gadgets, key=lambda g: g.address):
+        if len(classifier) >= limit:
+            break
+        trace1 = C.emulate(g, arch)
+        trace2 = C.emulate(g, arch)
+        if trace1[1] is None or trace2[1] is None:
+            continue
+        C.set_effects(arch, g, trace1[0], trace1[1], trace1[3])
+        effects = (g.modified_regs, g.stack_fix)
+        result = classify(arch, g, trace1, trace2)
+        if result is None:
+            continue
+        # typed gadgets share the analysis of g, modified by the replays: these use a copy
+        copy = Gadget(g.hex, address=g.address, address_end=g.address_end, retn=g.retn, arch=g.arch)
+        copy.static = g.static
+        classifier.append((copy, effects, trace1, trace2))
+        typed_gadgets += result
+    print ('[+] captured %d emulation traces' % len(classifier))
+
+    project = V.load_project(binary)
+    generic_state = V.make_symbolic_state(project)
+    verifier = []
+    for gad_list in V.group_by_address(typed_gadgets).values():
+        states = V.symbolic_step(project, generic_state, gad_list[0])
+        if states is not None:
+            verifier.append((gad_list, states[0], states[1]))
+    print ('[+] captured %d symbolic states' % len(verifier))
+
+    with open(filename, 'wb') as f:
+        pickle.dump({'binary': binary, 'arch': arch.ARCH_BITS, 'classifier': classifier, 'verifier': verifier}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    print ('Traces saved in', filename)
+
+
+class Measure(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.ns = 0
+        self.candidates = 0
+
+    def time(self, function, *args):
+        start = time.perf_counter_ns()
+        result = function(*args)
+        self.ns += time.perf_counter_ns() - start
+        self.calls += 1
+        return result
+
+    def record(self):
+        return {'function': self.name, 'calls': self.calls, 'ns_per_call': self.ns // self.calls if self.calls else 0,
+                'candidates': self.candidates}
+
+
+def replay_classifier(traces, arch, repeat, measures):
+    for i in range(repeat):
+        for (name, check) in CHECKS:
+            if name not in measures:
+                continue
+            for (g, effects, trace1, trace2) in traces:
+                # checkStackPtrOpGadget modifies the stack fix
+                g.modified_regs, g.stack_fix = effects
+                result = measures[name].time(check, arch, g, trace1, trace2)
+                if i == 0:
+                    measures[name].candidates += len(result)
+
+
+def load_traces(filename):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def replay_verifier(filename, arch, repeat, measures):
+    def measure(name, function, *args):
+        if name not in measures:
+            return function(*args)
+        result = measures[name].time(function, *args)
+        if i == 0 and (result[0] if name == 'compute_mem_accesses' else result):
+            measures[name].candidates += 1
+        return result
+
+    for i in range(repeat):
+        # the solver caches its results in the states: each replay starts from fresh ones
+        states = load_traces(filename)['verifier']
+        project = states[0][2].project if states else None
+        for (gad_list, init_state, final_state) in states:
+            first_g = gad_list[0]
+            if not measure('verifyModReg', V.verifyModReg, arch, first_g, init_state, final_state):
+                measure('computeModReg', V.computeModReg, arch, first_g, init_state, final_state)
+            measure('compute_mem_accesses', V.compute_mem_accesses, arch, project, first_g, init_state, final_state)
+            for g in gad_list:
+                if type(g) is not StackPtrOp_Gadget:
+                    measure('verifyStackFix', V.verifyStackFix, g, init_state, final_state)
+                if type(g) in VERIFIERS:
+                    measure(VERIFIERS[type(g)], getattr(V, VERIFIERS[type(g)]), project, g, init_state, final_state)
+
+
+def run(filename, repeat, only=None, json_file=None):
+    traces = load_traces(filename)
+    arch = Arch.get(traces['arch'])
+    names = [name for (name, check) in CHECKS] + ['verifyModReg', 'computeModReg', 'compute_mem_accesses', 'verifyStackFix'] + \
+        sorted(set(VERIFIERS.values()))
+    measures = dict((name, Measure(name)) for name in names if only is None or name in only)
+    print ('Replaying %d traces and %d states of %s, %d times' % (len(traces['classifier']), len(traces['verifier']),
+                                                                  traces['binary'], repeat))
+    replay_classifier(traces['classifier'], arch, repeat, measures)
+    replay_verifier(filename, arch, repeat, measures)
+
+    records = [measures[name].record() for name in names if name in measures]
+    print ('%-24s %8s %12s %10s' % ('function', 'calls', 'ns/call', 'candidates'))
+    for r in records:
+        print ('%-24s %8d %12d %10d' % (r['function'], r['calls'], r['ns_per_call'], r['candidates']))
+    if json_file is not None:
+        with open(json_file, 'w') as f:
+            json.dump({'traces': filename, 'repeat': repeat, 'results': records}, f, indent=2)
+        print ('Results saved in', json_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="micro-benchmarks of the classifier checks and verifier predicates")
+    subparsers = parser.add_subparsers(dest='command')
+    parser_capture = subparsers.add_parser('capture', help="capture emulation traces and symbolic states of a binary")
+    parser_capture.add_argument('binary', help="input binary")
+    parser_capture.add_argument('-o', '--output', help="traces file (default: <binary>%s)" % TRACES_EXTENSION, default=None)
+    parser_capture.add_argument('--limit', help="number of gadgets emulated (default: %d)" % LIMIT, type=int, default=LIMIT)
+    parser_run = subparsers.add_parser('run', help="replay captured traces through the checks")
+    parser_run.add_argument('traces', help="traces file")
+    parser_run.add_argument('--repeat', help="replays of each trace (default: 3)", type=int, default=3)
+    parser_run.add_argument('--only', help="comma separated functions to measure", default=None)
+    parser_run.add_argument('--json', help="save the results in a json file", default=None)
+    args = parser.parse_args()
+
+    if args.command == 'capture':
+        capture(args.binary, args.output or args.binary + TRACES_EXTENSION, args.limit)
+    elif args.command == 'run':
+        run(args.traces, args.repeat, args.only.split(',') if args.only else None, args.json)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+"""
+Measures the start up time of read-only ropd commands, and checks that they do not import the analysis dependencies.
+The binary must be already collected and verified.
+
+usage: python benchmarks/startup.py test/baby_stack [-n RUNS] [--limit SECONDS]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('angr', 'ropper', 'networkx', 'lief', 'claripy')
+
+# runs the cli with the given arguments, then reports the heavy modules it imported on stderr
+RUNNER = '''
+import json, sys
+from ropd import ropcli
+sys.argv = ['ropd'] + sys.argv[1:]
+try:
+    ropcli.main()
+except SystemExit:
+    pass
+finally:
+    sys.stderr.write('\\n' + json.dumps([m for m in %r if m in sys.modules]) + '\\n')
+''' % (HEAVY_MODULES,)
+
+
+def run(args, cwd):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+    start = time.time()
+    p = subprocess.run([sys.executable, '-c', RUNNER] + args, cwd=cwd, env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.time() - start
+    if p.returncode != 0:
+        raise Exception('ropd %s failed:\n%s' % (' '.join(args), p.stderr))
+    return (elapsed, json.loads(p.stderr.strip().splitlines()[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="start up time of read-only ropd commands")
+    parser.add_argument('binary', help="collected and verified binary")
+    parser.add_argument('-n', '--runs', help="runs of each command", type=int, default=5)
+    parser.add_argument('--limit', help="maximum start up time in seconds", type=float, default=1.0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ropd-startup-')
+    try:
+        binary = os.path.join(workdir, os.path.basename(args.binary))
+        for ext in ('', '.verified'):
+            shutil.copy(args.binary + ext, binary + ext)
+        db = os.path.join(workdir, 'gadgets.db')
+        run([binary, '--index', db], workdir)
+
+        commands = [('help', ['-h']),
+                    ('stats', [binary, '--stats']),
+                    ('query', ['query', db, 'type=LoadConst', '--limit', '10']),
+                    ('dump', [binary, '-d'])]
+        slow = False
+        print ('%-8s %8s %8s  %s' % ('command', 'median', 'min', 'heavy imports'))
+        for (name, command) in commands:
+            times = []
+            for _ in range(args.runs):
+                (elapsed, heavy) = run(command, workdir)
+                times.append(elapsed)
+            times.sort()
+            median = times[len(times) // 2]
+            # dump time depends on the number of gadgets: only the imports are checked
+            if heavy or (name != 'dump' and median > args.limit):
+                slow = True
+            print ('%-8s %7.3fs %7.3fs  %s' % (name, median, times[0], ', '.join(heavy) or '-'))
+    finally:
+        shutil.rmtree(workdir)
+    if slow:
+        print ('[-] some commands are slower than %.2fs or import analysis dependencies' % args.limit)
+        sys.exit(1)
+    print ('[+] all commands start in less than %.2fs' % args.limit)
+
+
+if __name__ == "__main__":
+    main()
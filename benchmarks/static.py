@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+"""
+Checks that the static pre-analysis of the collector does not lose candidates: each gadget is classified with and
+without it, from the same random values, and the candidates found only without it are reported.
+The regression cases must not lose any, the gadgets of a binary are only reported (the pre-analysis drops
+candidates on registers the gadget does not read, found by coincidence).
+
+usage: python benchmarks/static.py [binary] [--limit N]
+"""
+
+import argparse
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ropd import Arch
+from ropd.Gadget import *
+from ropd.GadgetsTrie import tail_params
+import ropd.GadgetsCollector
+
+# the package exports the classes with the same name of the modules
+C = sys.modules['ropd.GadgetsCollector']
+
+R = Arch.Registers64
+# (bytes, arch, candidate that must be found)
+CASES = (
+    # mov rcx, rax; mov qword ptr [rcx], rbx; ret
+    ('4889c1488919c3', 64, (WriteMem_Gadget, (R.rax, 0, R.rbx))),
+    # mov rcx, rax; mov rdx, qword ptr [rcx]; ret
+    ('4889c1488b11c3', 64, (ReadMem_Gadget, (R.rdx, R.rax, 0))),
+    # push rbx; pop rcx; mov qword ptr [rcx], rax; ret
+    ('5359488901c3', 64, (WriteMem_Gadget, (R.rbx, 0, R.rax))),
+    # mov rdx, rax; add rdx, 8; mov rcx, qword ptr [rdx]; ret
+    ('4889c24883c208488b0ac3', 64, (ReadMem_Gadget, (R.rcx, R.rax, 8))),
+    # pop rcx; mov qword ptr [rcx], rax; ret
+    ('59488901c3', 64, None),
+    # mov rcx, rax; inc rcx; ret
+    ('4889c148ffc1c3', 64, None),
+)
+ADDRESS = 0x1000
+LIMIT = 2000
+
+
+def candidates(g, static):
+    """
+    Returns the (type, params) of the candidates of g, classified from the random values seeded by its address
+    """
+    arch = Arch.get(g.arch)
+    (g,) = C.filter_unsafe([g], arch)
+    if not static:
+        g.static = None
+    random.seed(g.address)
+    return set((type(t), tail_params(t)) for t in C.do_analysis(g))
+
+
+def lost(make_gadget):
+    return candidates(make_gadget(), False) - candidates(make_gadget(), True)
+
+
+def check_cases():
+    failures = 0
+    for (hex, arch, expected) in CASES:
+        code = bytes.fromhex(hex)
+        make_gadget = lambda: Gadget(code, address=ADDRESS, address_end=ADDRESS + len(code) - 1, retn=0, arch=arch)
+        missing = lost(make_gadget)
+        if expected is not None and expected not in candidates(make_gadget(), True):
+            missing.add(expected)
+        status = 'FAIL' if missing else 'ok'
+        failures += bool(missing)
+        print ('[%s] %s' % (status, make_gadget().disasm()))
+        for (t, params) in sorted(missing, key=str):
+            print ('    lost %s%s' % (t.__name__, params))
+    return failures
+
+
+def check_binary(binary, limit):
+    collector = C.GadgetsCollector(binary)
+    gadgets = sorted(collector.collect(), key=lambda g: g.address)[:limit]
+    counts = {}
+    for g in gadgets:
+        make_gadget = lambda: Gadget(g.hex, address=g.address, address_end=g.address_end, retn=0, arch=g.arch)
+        for (t, params) in lost(make_gadget):
+            counts[t.__name__] = counts.get(t.__name__, 0) + 1
+            print ('[-] %s: lost %s%s' % (make_gadget().disasm(), t.__name__, params))
+    print ('[+] %d gadgets of %s, lost candidates: %s' % (len(gadgets), binary, counts or 'none'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="check that the static pre-analysis of the collector does not lose candidates")
+    parser.add_argument('binary', nargs='?', help="also report the candidates lost on the gadgets of binary", default=None)
+    parser.add_argument('--limit', help="gadgets of the binary to check (default: %d)" % LIMIT, type=int, default=LIMIT)
+    args = parser.parse_args()
+    failures = check_cases()
+    if args.binary is not None:
+        check_binary(args.binary, args.limit)
+    if failures:
+        print ('[-] %d regression cases lost candidates' % failures)
+        return 1
+    print ('[+] all the regression cases passed')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
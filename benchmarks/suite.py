@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+"""
+End-to-end benchmarks: runs collect, verify, json export and execve on the test binaries, each phase in a fresh
+interpreter, and appends wall time, gadgets per second, peak RSS and result counts to a json history file.
+
+usage: python benchmarks/suite.py [binaries] [--phases collect,verify,json,execve] [--history FILE]
+       python benchmarks/suite.py --compare [OLD [NEW]] [--threshold 0.1]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BINARIES = [os.path.join(ROOT, 'test', 'baby_stack'), os.path.join(ROOT, 'test', 'libc6_2.21-0ubuntu4.3_i386.so')]
+PHASES = ('collect', 'verify', 'json', 'execve')
+HISTORY_FILE = os.path.join(ROOT, 'benchmarks', 'history.json')
+# relative change considered a regression
+THRESHOLD = 0.1
+# wall time changes below this many seconds are noise
+MIN_TIME_DELTA = 0.5
+
+
+def type_counts(gadgets):
+    from ropd.GadgetStore import count_types
+    return dict((t.__name__, count) for (t, count) in count_types(gadgets).items())
+
+
+def run_collect(binary):
+    from ropd.GadgetsCollector import GadgetsCollector
+    from ropd.GadgetStore import save_gadgets, COLLECTED_EXTENSION
+    gadgets = GadgetsCollector(binary).analyze()
+    save_gadgets(binary + COLLECTED_EXTENSION, gadgets)
+    return {'gadgets': len(gadgets), 'types': type_counts(gadgets)}
+
+
+def run_verify(binary):
+    from ropd.GadgetsVerifier import GadgetsVerifier
+    from ropd.GadgetStore import save_gadgets, load_gadgets, COLLECTED_EXTENSION, VERIFIED_EXTENSION
+    gadgets = load_gadgets(binary + COLLECTED_EXTENSION)
+    verified = GadgetsVerifier(binary, gadgets).verify()
+    save_gadgets(binary + VERIFIED_EXTENSION, verified)
+    return {'gadgets': len(gadgets), 'verified': len(verified), 'types': type_counts(verified)}
+
+
+def run_json(binary):
+    from ropd.GadgetsExporter import GadgetsExporter
+    from ropd.GadgetStore import load_gadgets, VERIFIED_EXTENSION
+    filename = binary + '.json'
+    count = GadgetsExporter(load_gadgets(binary + VERIFIED_EXTENSION)).export_file(filename)
+    return {'gadgets': count, 'bytes': os.path.getsize(filename)}
+
+
+def run_execve(binary):
+    from ropd.GadgetsCombiner import GadgetsCombiner
+    from ropd.GadgetStore import load_gadgets, VERIFIED_EXTENSION
+    gadgets = load_gadgets(binary + VERIFIED_EXTENSION, types=GadgetsCombiner.CHAIN_GADGET_TYPES)
+    combiner = GadgetsCombiner(binary, gadgets)
+    combiner.execve(validate=True)
+    return {'gadgets': len(gadgets), 'chain_bytes': len(combiner.chain.pack()) if combiner.chain is not None else None}
+
+
+RUNNERS = {'collect': run_collect, 'verify': run_verify, 'json': run_json, 'execve': run_execve}
+
+
+def run_phase(phase, binary, result_file):
+    """
+    Runs a phase in this process and saves its measures in result_file
+    """
+    sys.path.insert(0, ROOT)
+    os.chdir(os.path.dirname(binary))
+    start = time.time()
+    result = RUNNERS[phase](binary)
+    result['time'] = time.time() - start
+    result['gadgets_per_second'] = result['gadgets'] / result['time'] if result['time'] else None
+    # the pools are joined, so their workers are accounted as children
+    result['peak_rss_kb'] = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    with open(result_file, 'w') as f:
+        json.dump(result, f)
+
+
+def spawn_phase(phase, binary, workdir):
+    result_file = os.path.join(workdir, 'result.json')
+    with open(os.path.join(workdir, phase + '.log'), 'w') as log:
+        p = subprocess.run([sys.executable, os.path.abspath(__file__), '--phase', phase, binary, '--result', result_file],
+                           stdout=log, stderr=subprocess.STDOUT)
+    if p.returncode != 0:
+        with open(os.path.join(workdir, phase + '.log')) as log:
+            return {'error': log.read()[-2000:]}
+    with open(result_file) as f:
+        return json.load(f)
+
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, universal_newlines=True).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision + ('-dirty' if dirty else '')
+
+
+def load_history(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return json.load(f)
+
+
+def run_suite(binaries, phases, history_file):
+    record = {'revision': git_revision(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'cpus': os.cpu_count(), 'results': {}}
+    for binary in binaries:
+        name = os.path.basename(binary)
+        workdir = tempfile.mkdtemp(prefix='ropd-bench-')
+        try:
+            copy = os.path.join(workdir, name)
+            # cached results of the original binary are used by the phases whose inputs are not computed in this run
+            for ext in ('', '.collected', '.verified'):
+                if os.path.exists(binary + ext):
+                    shutil.copy(binary + ext, copy + ext)
+            results = record['results'][name] = {}
+            for phase in phases:
+                print ('[+] %s: %s' % (name, phase))
+                results[phase] = spawn_phase(phase, copy, workdir)
+                if 'error' in results[phase]:
+                    print ('[-] %s failed:\n%s' % (phase, results[phase]['error']))
+                    break
+                print ('    %.2fs, %s gadgets, peak RSS %d MB' % (results[phase]['time'], results[phase]['gadgets'], results[phase]['peak_rss_kb'] // 1024))
+        finally:
+            shutil.rmtree(workdir)
+    history = load_history(history_file)
+    history.append(record)
+    with open(history_file, 'w') as f:
+        json.dump(history, f, indent=2)
+    print ('Results saved in', history_file)
+
+
+def find_record(history, revision):
+    for record in reversed(history):
+        if record['revision'] is not None and record['revision'].startswith(revision):
+            return record
+    raise Exception('No results for revision %s' % revision)
+
+
+def compare(history_file, old=None, new=None, threshold=THRESHOLD):
+    """
+    Compares two runs of the suite, by default the last two. Returns the number of regressions
+    """
+    history = load_history(history_file)
+    if len(history) < 2 and (old is None or new is None):
+        raise Exception('At least two runs are needed to compare')
+    old = find_record(history, old) if old is not None else history[-2]
+    new = find_record(history, new) if new is not None else history[-1]
+    print ('Comparing %s (%s) with %s (%s)' % (old['revision'], old['date'], new['revision'], new['date']))
+    regressions = 0
+    for (name, phases) in sorted(new['results'].items()):
+        for (phase, result) in phases.items():
+            before = old['results'].get(name, {}).get(phase)
+            if before is None or 'error' in before or 'error' in result:
+                continue
+            notes = []
+            if result['time'] > before['time'] * (1 + threshold) and result['time'] - before['time'] > MIN_TIME_DELTA:
+                notes.append('time %.2fs -> %.2fs' % (before['time'], result['time']))
+            if result['peak_rss_kb'] > before['peak_rss_kb'] * (1 + threshold):
+                notes.append('peak RSS %d MB -> %d MB' % (before['peak_rss_kb'] // 1024, result['peak_rss_kb'] // 1024))
+            if before.get('chain_bytes') is not None and (result.get('chain_bytes') is None or result['chain_bytes'] > before['chain_bytes']):
+                notes.append('chain %s -> %s bytes' % (before['chain_bytes'], result.get('chain_bytes')))
+            regressions += len(notes)
+            print ('%s %s %s: %.2fs (%+.1f%%)%s' % ('[-]' if notes else '[+]', name, phase, result['time'],
+                   (result['time'] / before['time'] - 1) * 100 if before['time'] else 0, ''.join(', ' + n for n in notes)))
+            # collection is randomized: count changes are reported, not counted as regressions
+            for key in ('verified', 'types'):
+                if key in result and result[key] != before.get(key):
+                    print ('[*] %s %s: %s changed: %s -> %s' % (name, phase, key, before.get(key), result[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end benchmarks of ropd")
+    parser.add_argument('binaries', nargs='*', help="binaries to benchmark (default: the test binaries), or the revisions to compare with --compare")
+    parser.add_argument('--phases', help="comma separated phases (default: %s)" % ','.join(PHASES), default=','.join(PHASES))
+    parser.add_argument('--history', help="json history file (default: benchmarks/history.json)", default=HISTORY_FILE)
+    parser.add_argument('--compare', help="compare two runs, by default the last two, else the given revisions", action='store_true')
+    parser.add_argument('--threshold', help="relative change reported as regression (default: %.2f)" % THRESHOLD, type=float, default=THRESHOLD)
+    parser.add_argument('--phase', help=argparse.SUPPRESS, choices=PHASES)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phase:
+        return run_phase(args.phase, args.binaries[0], args.result)
+    if args.compare:
+        if compare(args.history, *(args.binaries + [None, None])[:2], threshold=args.threshold):
+            sys.exit(1)
+        return
+    phases = args.phases.split(',')
+    for phase in phases:
+        if phase not in PHASES:
+            parser.error('unknown phase: %s' % phase)
+    run_suite([os.path.abspath(b) for b in args.binaries or BINARIES], phases, args.history)
+
+
+if __name__ == "__main__":
+    main()
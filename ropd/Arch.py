@@ -10,6 +10,7 @@ import random
 from enum import Enum
 from struct import pack, unpack
 from itertools import permutations, combinations
+from types import MappingProxyType
 import capstone
 from capstone.x86 import *
 from unicorn import *
@@ -19,6 +20,8 @@ import logging
 ARCH_32 = 32
 ARCH_64 = 64
 STACK_CELLS = 16
+# flags loaded in ah by lahf
+FLAGS_MASK = 0xd5
 md = None
 Registers = None
 Registers_sp = None
@@ -41,86 +44,171 @@ Registers32 = Enum('Registers32', 'eax ebx ecx edx esi edi ebp esp')
 Registers64 = Enum('Registers64', 'rax rbx rcx rdx rsi rdi rbp rsp r8 r9 r10 r11 r12 r13 r14 r15')
 UnknownType = Enum('UnknownType', 'unknown')
 MemType = Enum('MemType', 'stack')
+FlagsType = Enum('FlagsType', 'flags')
+
+# architecture attributes, also exported as module globals by init()
+CONTEXT_ATTRIBUTES = ('md', 'Registers', 'Registers_sp', 'Registers_a', 'Registers_d', 'ARCH_BITS', 'PAGE_SIZE', 'PACK_VALUE',
+                      'MAX_INT', 'regs', 'regs_no_sp', 'FLAGS_REG', 'IP_REG', 'UC_MODE', 'RAND_BITS')
+
+
+class ArchContext(object):
+    """
+    Immutable description of an architecture: disassembler, register tables and masks, emulation parameters.
+    Contexts are shared, use get() to obtain them
+    """
+    def __init__(self, arch):
+        if arch == ARCH_32 or arch == 'x86':
+            md = capstone.Cs(capstone.CS_ARCH_X86, capstone.CS_MODE_32)
+            md.detail = True
+
+            UC_MODE = UC_MODE_32
+
+            Registers = Registers32
+            Registers_sp = Registers.esp
+            Registers_a = Registers.eax
+            Registers_d = Registers.edx
+
+            ARCH_BITS = 32
+            PAGE_SIZE = 4 * 1024
+            PACK_VALUE = 'I'
+            MAX_INT = 0xFFFFFFFF
+
+            regs = {Registers.eax:  UC_X86_REG_EAX, Registers.ebx:  UC_X86_REG_EBX,        Registers.ecx: UC_X86_REG_ECX, Registers.edx:  UC_X86_REG_EDX, 
+                    Registers.esi:  UC_X86_REG_ESI, Registers.edi:  UC_X86_REG_EDI,Registers.ebp:  UC_X86_REG_EBP, Registers.esp:  UC_X86_REG_ESP}
+
+            FLAGS_REG = UC_X86_REG_EFLAGS
+            IP_REG = UC_X86_REG_EIP
+            RAND_BITS = 30
+
+        elif arch == ARCH_64 or arch == 'x86_64':
+            md = capstone.Cs(capstone.CS_ARCH_X86, capstone.CS_MODE_64)
+            md.detail = True
+
+            UC_MODE = UC_MODE_64
+
+            Registers = Registers64
+            Registers_sp = Registers.rsp
+            Registers_a = Registers.rax
+            Registers_d = Registers.rdx
+
+            ARCH_BITS = 64
+            PAGE_SIZE = 4 * 1024
+            PACK_VALUE = 'Q'
+            MAX_INT = 0xFFFFFFFFFFFFFFFF
+
+            regs = {Registers.rax:  UC_X86_REG_RAX, Registers.rbx:  UC_X86_REG_RBX,        Registers.rcx: UC_X86_REG_RCX, Registers.rdx:  UC_X86_REG_RDX, 
+                    Registers.rsi:  UC_X86_REG_RSI, Registers.rdi:  UC_X86_REG_RDI,Registers.rbp:  UC_X86_REG_RBP, Registers.rsp:  UC_X86_REG_RSP,
+                    Registers.r8:  UC_X86_REG_R8, Registers.r9:  UC_X86_REG_R9,    Registers.r10: UC_X86_REG_R10, Registers.r11:  UC_X86_REG_R11, 
+                    Registers.r12:  UC_X86_REG_R12, Registers.r13:  UC_X86_REG_R13,Registers.r14:  UC_X86_REG_R14, Registers.r15:  UC_X86_REG_R15}
+
+            FLAGS_REG = UC_X86_REG_EFLAGS
+            IP_REG = UC_X86_REG_RIP
+            RAND_BITS = 46
+        else: 
+            raise Exception('Not supported Architecture: ' + str(arch))
+
+        regs_no_sp = dict((r, uc_reg) for (r, uc_reg) in regs.items() if r is not Registers_sp)
+        for name in CONTEXT_ATTRIBUTES:
+            value = locals()[name]
+            object.__setattr__(self, name, MappingProxyType(value) if isinstance(value, dict) else value)
+        object.__setattr__(self, 'STACK_CELLS', STACK_CELLS)
+        # bit of each register in register masks
+        object.__setattr__(self, 'REG_MASKS', MappingProxyType(dict((r, 1 << (r.value - 1)) for r in Registers)))
+        object.__setattr__(self, 'ALL_REGS_MASK', (1 << len(Registers)) - 1)
+        # capstone register id -> full register, for all the aliasing registers
+        object.__setattr__(self, 'CS_REGS', MappingProxyType(dict((getattr(capstone.x86, 'X86_REG_' + name.upper()), r)
+                                                                  for r in Registers for name in sub_registers(r.name, ARCH_BITS))))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ArchContext is immutable')
+
+    def __reduce__(self):
+        # unpickled contexts are the cached ones
+        return (get, (self.ARCH_BITS,))
+
+    def __repr__(self):
+        return 'ArchContext(%d)' % self.ARCH_BITS
+
+    def rand(self):
+        r = random.getrandbits(self.RAND_BITS)
+        while r == 0:
+            r = random.getrandbits(self.RAND_BITS)
+        return r
+
+    def effects(self, instructions):
+        """
+        Returns the registers read and written by the capstone instructions (FlagsType.flags for the flags),
+        and whether they may access memory, through memory operands or the stack
+        """
+        read = set()
+        written = set()
+        memory = False
+        for i in instructions:
+            (regs_read, regs_write) = i.regs_access()
+            # capstone reports the accumulator as written by test eax, imm
+            if i.id in (X86_INS_TEST, X86_INS_CMP):
+                regs_write = [r for r in regs_write if r == X86_REG_EFLAGS]
+            read.update(self.CS_REGS.get(r, FlagsType.flags) for r in regs_read if r in self.CS_REGS or r == X86_REG_EFLAGS)
+            written.update(self.CS_REGS.get(r, FlagsType.flags) for r in regs_write if r in self.CS_REGS or r == X86_REG_EFLAGS)
+            # lea and nop have memory operands, without accessing them
+            if i.id not in (X86_INS_LEA, X86_INS_NOP) and any(op.type == X86_OP_MEM for op in i.operands):
+                memory = True
+        # push, pop, leave...
+        if self.Registers_sp in written:
+            memory = True
+        return (read, written, memory)
+
+    def mask(self, registers):
+        mask = 0
+        for r in registers:
+            mask |= self.REG_MASKS.get(r, 0)
+        return mask
+
+
+ARCH_NAMES = {'x86': ARCH_32, 'x86_64': ARCH_64}
+_contexts = {}
+
+def sub_registers(name, bits):
+    """
+    Returns the names of the registers aliasing the full register name, e.g. rax: ax al ah eax rax
+    """
+    if name[1:].isdigit():
+        return (name, name + 'd', name + 'w', name + 'b')
+    base = name[1:]
+    names = [base]
+    if base.endswith('x'):
+        names += [base[0] + 'l', base[0] + 'h']
+    elif bits == ARCH_64:
+        names.append(base + 'l')
+    names.append('e' + base)
+    if bits == ARCH_64:
+        names.append('r' + base)
+    return names
+
+
+def get(arch):
+    """
+    Returns the context of arch (32, 64, 'x86' or 'x86_64')
+    """
+    bits = ARCH_NAMES.get(arch, arch)
+    try:
+        return _contexts[bits]
+    except KeyError:
+        pass
+    _contexts[bits] = ArchContext(bits)
+    return _contexts[bits]
+
 
 def init(arch):
-    global md
-    global Registers
-    global Registers_sp
-    global Registers_a
-    global Registers_d
-    
-    global ARCH_BITS
-    global PAGE_SIZE 
-    global PACK_VALUE
-    global MAX_INT
-
-    global regs
-    global regs_no_sp 
-    global FLAGS_REG
-    global IP_REG
-    global UC_MODE
-    global RAND_BITS
-
-    if arch == ARCH_32 or arch == 'x86':
-        md = capstone.Cs(capstone.CS_ARCH_X86, capstone.CS_MODE_32)
-        md.detail = True
-
-        UC_MODE = UC_MODE_32
-
-        Registers = Registers32
-        Registers_sp = Registers.esp
-        Registers_a = Registers.eax
-        Registers_d = Registers.edx
-
-        ARCH_BITS = 32
-        PAGE_SIZE = 4 * 1024
-        PACK_VALUE = 'I'
-        MAX_INT = 0xFFFFFFFF
-
-        regs = {Registers.eax:  UC_X86_REG_EAX, Registers.ebx:  UC_X86_REG_EBX,        Registers.ecx: UC_X86_REG_ECX, Registers.edx:  UC_X86_REG_EDX, 
-                Registers.esi:  UC_X86_REG_ESI, Registers.edi:  UC_X86_REG_EDI,Registers.ebp:  UC_X86_REG_EBP, Registers.esp:  UC_X86_REG_ESP}
-
-        regs_no_sp = {Registers.eax:  UC_X86_REG_EAX, Registers.ebx:  UC_X86_REG_EBX, Registers.ecx:  UC_X86_REG_ECX, Registers.edx:  UC_X86_REG_EDX, Registers.esi:  UC_X86_REG_ESI, Registers.edi:  UC_X86_REG_EDI, Registers.ebp:  UC_X86_REG_EBP}
-
-        FLAGS_REG = UC_X86_REG_EFLAGS
-        IP_REG = UC_X86_REG_EIP
-        RAND_BITS = 30
-        
-    elif arch == ARCH_64 or arch == 'x86_64':
-        md = capstone.Cs(capstone.CS_ARCH_X86, capstone.CS_MODE_64)
-        md.detail = True
-
-        UC_MODE = UC_MODE_64
-
-        Registers = Registers64
-        Registers_sp = Registers.rsp
-        Registers_a = Registers.rax
-        Registers_d = Registers.rdx
-
-        ARCH_BITS = 64
-        PAGE_SIZE = 4 * 1024
-        PACK_VALUE = 'Q'
-        MAX_INT = 0xFFFFFFFFFFFFFFFF
-
-        regs = {Registers.rax:  UC_X86_REG_RAX, Registers.rbx:  UC_X86_REG_RBX,        Registers.rcx: UC_X86_REG_RCX, Registers.rdx:  UC_X86_REG_RDX, 
-                Registers.rsi:  UC_X86_REG_RSI, Registers.rdi:  UC_X86_REG_RDI,Registers.rbp:  UC_X86_REG_RBP, Registers.rsp:  UC_X86_REG_RSP,
-                Registers.r8:  UC_X86_REG_R8, Registers.r9:  UC_X86_REG_R9,    Registers.r10: UC_X86_REG_R10, Registers.r11:  UC_X86_REG_R11, 
-                Registers.r12:  UC_X86_REG_R12, Registers.r13:  UC_X86_REG_R13,Registers.r14:  UC_X86_REG_R14, Registers.r15:  UC_X86_REG_R15}
-
-        regs_no_sp = \
-            {Registers.rax:  UC_X86_REG_RAX, Registers.rbx:  UC_X86_REG_RBX,    Registers.rcx: UC_X86_REG_RCX, Registers.rdx:  UC_X86_REG_RDX, 
-             Registers.rsi:  UC_X86_REG_RSI, Registers.rdi:  UC_X86_REG_RDI,Registers.rbp:  UC_X86_REG_RBP, Registers.r8:  UC_X86_REG_R8, Registers.r9:  UC_X86_REG_R9, Registers.r10: UC_X86_REG_R10, Registers.r11:  UC_X86_REG_R11,Registers.r12:  UC_X86_REG_R12, Registers.r13:  UC_X86_REG_R13,Registers.r14:  UC_X86_REG_R14, Registers.r15:  UC_X86_REG_R15}
-
-        FLAGS_REG = UC_X86_REG_EFLAGS
-        IP_REG = UC_X86_REG_RIP
-        RAND_BITS = 46
-    else: 
-        raise Exception('Not supported Architecture: ' + str(arch))
+    """
+    Exports the attributes of the context of arch as module globals, for code still relying on them
+    """
+    context = get(arch)
+    for name in CONTEXT_ATTRIBUTES:
+        globals()[name] = getattr(context, name)
 
 def rand():
     r = random.getrandbits(RAND_BITS)
     while r == 0:
         r = random.getrandbits(RAND_BITS)
     return r
-
-
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+import hashlib
+import json
+from . import Profiler
+import logging
+
+META_EXTENSION = '.meta'
+META_VERSION = 1
+
+
+def file_digest(filename):
+    """
+    Returns the sha256 of the content of filename
+    """
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.digest()
+
+
+class BinaryInfo(object):
+    """
+    Arch, image base and segments of a binary, parsed once by the collection phase and saved in a sidecar
+    next to its gadgets. The digest of the binary tells whether the gadgets were collected from its current content
+    """
+    def __init__(self, filename, sha256, arch, image_base, segments):
+        self.filename = filename
+        self.sha256 = sha256
+        self.arch = arch
+        self.image_base = image_base
+        # loadable segments: {'address', 'size', 'offset', 'file_size', 'flags'}, flags is a subset of 'rwx'
+        self.segments = segments
+        self.writable_intervals = [(s['address'], s['address'] + s['size']) for s in segments
+                                   if s['address'] and 'r' in s['flags'] and 'w' in s['flags']]
+
+    @staticmethod
+    def parse(filename):
+        import lief
+        with Profiler.stage('load_binary'):
+            binary = lief.parse(filename)
+            if binary is None or not isinstance(binary, lief.ELF.Binary):
+                raise Exception('%s is not an ELF binary' % filename)
+            arch = {lief.ELF.ARCH.i386: 32, lief.ELF.ARCH.x86_64: 64}.get(binary.header.machine_type)
+            if arch is None:
+                raise Exception('Unsupported architecture: %s' % binary.header.machine_type)
+            segments = []
+            for segment in binary.segments:
+                if segment.type != lief.ELF.SEGMENT_TYPES.LOAD:
+                    continue
+                flags = ''.join(c for (c, flag) in (('r', lief.ELF.SEGMENT_FLAGS.R), ('w', lief.ELF.SEGMENT_FLAGS.W),
+                                                    ('x', lief.ELF.SEGMENT_FLAGS.X)) if segment.has(flag))
+                segments.append({'address': segment.virtual_address, 'size': segment.virtual_size,
+                                 'offset': segment.file_offset, 'file_size': segment.physical_size, 'flags': flags})
+            return BinaryInfo(filename, file_digest(filename).hex(), arch, binary.imagebase, segments)
+
+    def save(self, filename=None):
+        filename = filename or self.filename + META_EXTENSION
+        with open(filename, 'w') as f:
+            json.dump({'version': META_VERSION, 'sha256': self.sha256, 'arch': self.arch, 'image_base': self.image_base,
+                       'segments': self.segments, 'writable_intervals': self.writable_intervals}, f, indent=2)
+        return filename
+
+    @staticmethod
+    def load(binary):
+        """
+        Loads the sidecar of binary
+        """
+        with open(binary + META_EXTENSION) as f:
+            meta = json.load(f)
+        if meta.get('version') != META_VERSION:
+            raise IOError('Unsupported version of %s' % (binary + META_EXTENSION))
+        return BinaryInfo(binary, meta['sha256'], meta['arch'], meta['image_base'], meta['segments'])
+
+    def is_stale(self):
+        return file_digest(self.filename).hex() != self.sha256
+
+    def segment_contents(self):
+        """
+        Returns the (address, content, size) of the loadable segments, read from the binary
+        """
+        contents = []
+        with open(self.filename, 'rb') as f:
+            for s in self.segments:
+                f.seek(s['offset'])
+                contents.append((s['address'], f.read(s['file_size']), s['size']))
+        return contents
+
+
+def load_info(binary):
+    """
+    Returns the info of binary from its sidecar, parsing the binary if there is none.
+    Raises an exception if the binary changed since the sidecar was saved, i.e. since its gadgets were collected
+    """
+    try:
+        info = BinaryInfo.load(binary)
+    except (IOError, ValueError, KeyError) as e:
+        logging.info('No valid sidecar for %s (%s), parsing it', binary, e)
+        info = BinaryInfo.parse(binary)
+        info.save()
+        return info
+    if info.is_stale():
+        raise Exception('%s changed since its gadgets were collected, collect them again' % binary)
+    return info
@@ -8,6 +8,7 @@ __email__ = "pietro.borrello95@gmail.com"
 from binascii import unhexlify, hexlify
 from enum import Enum
 from . import Arch
+from . import Profiler
 import capstone
 
 md64 = capstone.Cs(capstone.CS_ARCH_X86, capstone.CS_MODE_64)
@@ -16,6 +17,85 @@ md64.detail = True
 md32 = capstone.Cs(capstone.CS_ARCH_X86, capstone.CS_MODE_32)
 md32.detail = True
 
+# disassembly of each distinct byte sequence: (arch, hex) -> ([(offset, mnemonic, op_str)], position_dependent)
+disasm_cache = {}
+MAX_DISASM_CACHE = 1 << 18
+# minimum number of byte sequences to disassemble in parallel
+PARALLEL_DISASM = 4096
+
+
+def decode(arch, hex, address):
+    if arch == Arch.ARCH_32:
+        md = md32
+    else:
+        md = md64
+    return decoded(md.disasm(hex, address), address)
+
+
+def decoded(cs_instructions, address):
+    """
+    Returns the disassembly cache entry of capstone instructions decoded at address
+    """
+    instructions = []
+    # relative branches are printed with their absolute target
+    position_dependent = False
+    for i in cs_instructions:
+        instructions.append((i.address - address, i.mnemonic, i.op_str))
+        position_dependent = position_dependent or i.group(capstone.CS_GRP_BRANCH_RELATIVE)
+    return (instructions, position_dependent)
+
+
+def cache_disassembly(arch, hex, address, cs_instructions):
+    """
+    Caches the disassembly of the byte sequence hex, already decoded by the caller
+    """
+    if len(disasm_cache) >= MAX_DISASM_CACHE:
+        disasm_cache.clear()
+    disasm_cache[(arch, hex)] = decoded(cs_instructions, address)
+
+
+def _decode(args):
+    return decode(*args)
+
+
+def disassemble(arch, hex, address):
+    """
+    Returns the instructions of the byte sequence hex, at address, using the cache
+    """
+    try:
+        (instructions, position_dependent) = disasm_cache[(arch, hex)]
+    except KeyError:
+        if len(disasm_cache) >= MAX_DISASM_CACHE:
+            disasm_cache.clear()
+        (instructions, position_dependent) = disasm_cache[(arch, hex)] = decode(arch, hex, address)
+        return instructions
+    if position_dependent:
+        return decode(arch, hex, address)[0]
+    return instructions
+
+
+def disasm_all(gadgets, processes=None):
+    """
+    Fills the disassembly cache with the byte sequences of all the gadgets in a single pass,
+    in parallel if there are many of them
+    """
+    missing = {}
+    if len(disasm_cache) >= MAX_DISASM_CACHE:
+        disasm_cache.clear()
+    for g in gadgets:
+        if (g.arch, g.hex) not in disasm_cache:
+            missing.setdefault((g.arch, g.hex), g.address)
+    tasks = [(arch, hex, address) for ((arch, hex), address) in missing.items()]
+    if len(tasks) >= PARALLEL_DISASM and processes != 1:
+        pool = Profiler.Pool(processes)
+        results = pool.map(_decode, tasks, chunksize=256)
+        pool.close()
+        pool.join()
+    else:
+        results = map(_decode, tasks)
+    for ((arch, hex, address), result) in zip(tasks, results):
+        disasm_cache[(arch, hex)] = result
+
 
 def dump_op(op):
     if op == Operations.ADD:
@@ -34,7 +114,12 @@ def dump_op(op):
         op = '&'
     return op
 
-class Gadget(object):
+class GadgetBase(object):
+    """
+    Type independent analysis of a gadget, shared by all the typed gadgets found at the same address
+    """
+    __slots__ = ('hex', 'address', 'address_end', 'modified_regs', 'mem', 'stack_fix', 'retn', 'arch')
+
     def __init__(self, hex, address=None, address_end=None, modified_regs=None, stack_fix=None, retn=None, arch=None, mem=None):
         self.hex = bytes(hex)
         self.address = address
@@ -46,6 +131,66 @@ class Gadget(object):
         self.retn = retn
         self.arch = arch
 
+    def fields(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.fields() == other.fields()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.fields())
+
+
+def base_property(name):
+    return property(lambda self: getattr(self.base, name), lambda self, value: setattr(self.base, name, value))
+
+
+class Gadget(object):
+    # static analysis of the instructions of an untyped gadget, set by the collector, not part of its identity
+    static = None
+
+    def __init__(self, hex=None, address=None, address_end=None, modified_regs=None, stack_fix=None, retn=None, arch=None, mem=None, base=None):
+        # typed gadgets reference the base of the gadget they are built from
+        if base is None:
+            base = GadgetBase(hex, address, address_end, modified_regs, stack_fix, retn, arch, mem)
+        # parameters are set by typed gadgets before calling this constructor
+        params = tuple(self.__dict__.values())
+        self.base = base
+        self.set_key(params)
+
+    def set_key(self, params):
+        # the identity of a gadget does not depend on its (mutable) analysis
+        self._key = (type(self), self.base.address, self.base.address_end) + params
+        self._hash = hash(self._key)
+
+    def key(self):
+        return self._key
+
+    def params(self):
+        """
+        Returns the parameters of the typed gadget, in definition order
+        """
+        return dict((k, v) for (k, v) in self.__dict__.items() if k not in ('base', '_key', '_hash', 'static'))
+
+    def same_analysis(self, other):
+        return self == other and self.base == other.base
+
+    def __getstate__(self):
+        # hashes of enums are not stable across processes
+        return dict((k, v) for (k, v) in self.__dict__.items() if k not in ('_key', '_hash'))
+
+    def __setstate__(self, state):
+        # gadgets pickled before the introduction of GadgetBase
+        if 'base' not in state:
+            state['base'] = GadgetBase(*[state.pop(name) for name in ('hex', 'address', 'address_end', 'modified_regs', 'stack_fix', 'retn', 'arch', 'mem')])
+        state.pop('_key', None)
+        state.pop('_hash', None)
+        self.__dict__.update(state)
+        self.set_key(tuple(self.params().values()))
+
     def __str__(self):
         mod = []
         for r in self.modified_regs:
@@ -57,7 +202,7 @@ class Gadget(object):
         return '(%s, %s, %s, mod_regs = %s, mem = %s %s, %d)' % (self.hex.hex(), hex(self.address), hex(self.address_end), mod, mem, simple_accesses, self.stack_fix)
     
     def __eq__(self, other):
-        return type(self) == type(other) and self.__dict__ == other.__dict__
+        return isinstance(other, Gadget) and self._key == other._key
     
     def __ne__(self, other):
         """Overrides the default implementation (unnecessary in Python 3)"""
@@ -65,32 +210,27 @@ class Gadget(object):
 
     def __hash__(self):
         """Overrides the default implementation"""
-        return hash(tuple(sorted(self.__dict__.items())))
+        return self._hash
     
     def disasm(self):
-        if self.arch == Arch.ARCH_32:
-            md = md32
-        else:
-            md = md64
         ris = ''
-        for i in md.disasm(self.hex, self.address):
-            ris += ("%s %s; " % (i.mnemonic, i.op_str))
+        for (offset, mnemonic, op_str) in disassemble(self.arch, self.hex, self.address):
+            ris += ("%s %s; " % (mnemonic, op_str))
         return ris.strip('; ')
 
 
     def dump(self):
-        if self.arch == Arch.ARCH_32:
-            md = md32
-        else:
-            md = md64
         ris = ''
-        for i in md.disasm(self.hex, self.address):
-            ris += ("0x%x:\t%s\t%s\n" % (i.address, i.mnemonic, i.op_str))
+        for (offset, mnemonic, op_str) in disassemble(self.arch, self.hex, self.address):
+            ris += ("0x%x:\t%s\t%s\n" % (self.address + offset, mnemonic, op_str))
         return ris
 
     def param_str(self):
         raise NotImplemented("Implement this method to dump parameters!")
 
+for name in GadgetBase.__slots__:
+    setattr(Gadget, name, base_property(name))
+
 
 #GADGET TYPES
 '''
@@ -121,8 +261,7 @@ class LoadConst_Gadget(Gadget): # dest = const (at offset from esp)
     def __init__(self, dest, offset, gadget):
         self.dest = dest
         self.offset = offset
-        super(LoadConst_Gadget, self).__init__(gadget.hex, gadget.address,
-                                               gadget.address_end, gadget.modified_regs, gadget.stack_fix, gadget.retn, gadget.arch, gadget.mem)
+        super(LoadConst_Gadget, self).__init__(base=gadget.base)
 
     def __str__(self):
         return 'LoadConst_Gadget(%s, %s)' % (self.dest.name, hex(self.offset)) + super(LoadConst_Gadget, self).__str__()
@@ -134,8 +273,7 @@ class LoadConst_Gadget(Gadget): # dest = const (at offset from esp)
 class ClearReg_Gadget(Gadget): # dest = 0
     def __init__(self, dest, gadget):
         self.dest = dest
-        super(ClearReg_Gadget, self).__init__(gadget.hex, gadget.address,
-                                               gadget.address_end, gadget.modified_regs, gadget.stack_fix, gadget.retn, gadget.arch, gadget.mem)
+        super(ClearReg_Gadget, self).__init__(base=gadget.base)
  
     def __str__(self):
         return 'ClearReg_Gadget(%s)' % (self.dest.name) + super(ClearReg_Gadget, self).__str__()
@@ -147,8 +285,7 @@ class ClearReg_Gadget(Gadget): # dest = 0
 class UnOp_Gadget(Gadget): # dest++
     def __init__(self, dest, gadget):
         self.dest = dest
-        super(UnOp_Gadget, self).__init__(gadget.hex, gadget.address,
-                                               gadget.address_end, gadget.modified_regs, gadget.stack_fix, gadget.retn, gadget.arch, gadget.mem)
+        super(UnOp_Gadget, self).__init__(base=gadget.base)
 
     def __str__(self):
         return 'UnOp_Gadget(%s)' % (self.dest.name) + super(UnOp_Gadget, self).__str__()
@@ -161,8 +298,7 @@ class MovReg_Gadget(Gadget):  # dest = src
     def __init__(self, dest, src, gadget):
         self.dest = dest
         self.src = src
-        super(MovReg_Gadget, self).__init__(gadget.hex, gadget.address,
-                                               gadget.address_end, gadget.modified_regs, gadget.stack_fix, gadget.retn, gadget.arch, gadget.mem)
+        super(MovReg_Gadget, self).__init__(base=gadget.base)
 
     def __str__(self):
         return 'MovReg_Gadget(%s, %s)' % (self.dest.name, self.src.name) + super(MovReg_Gadget, self).__str__()
@@ -176,8 +312,7 @@ class BinOp_Gadget(Gadget):  # dest = src1 OP src2
         self.src1 = src1
         self.op = op
         self.src2 = src2
-        super(BinOp_Gadget, self).__init__(gadget.hex, gadget.address,
-                                               gadget.address_end, gadget.modified_regs, gadget.stack_fix, gadget.retn, gadget.arch, gadget.mem)
+        super(BinOp_Gadget, self).__init__(base=gadget.base)
 
     def __str__(self):
         op = self.op
@@ -205,8 +340,7 @@ class ReadMem_Gadget(Gadget):  # dest = [addr_reg + offset]
         self.dest = dest
         self.addr_reg = addr_reg
         self.offset = offset
-        super(ReadMem_Gadget, self).__init__(gadget.hex, gadget.address,
-                                               gadget.address_end, gadget.modified_regs, gadget.stack_fix, gadget.retn, gadget.arch, gadget.mem)
+        super(ReadMem_Gadget, self).__init__(base=gadget.base)
 
     def __str__(self):
         return 'ReadMem_Gadget(%s = [%s + %s])' % (self.dest.name, self.addr_reg.name, hex(self.offset)) + super(ReadMem_Gadget, self).__str__()
@@ -220,8 +354,7 @@ class WriteMem_Gadget(Gadget):  # [addr_reg + offset] = src
         self.src = src
         self.addr_reg = addr_reg
         self.offset = offset
-        super(WriteMem_Gadget, self).__init__(gadget.hex, gadget.address,
-                                               gadget.address_end, gadget.modified_regs, gadget.stack_fix, gadget.retn, gadget.arch, gadget.mem)  
+        super(WriteMem_Gadget, self).__init__(base=gadget.base)  
 
     def __str__(self):
         return 'WriteMem_Gadget([%s + %s] = %s)' % (self.addr_reg.name, hex(self.offset), self.src.name) + super(WriteMem_Gadget, self).__str__()
@@ -236,8 +369,7 @@ class ReadMemOp_Gadget(Gadget):  # dest OP= [addr_reg + offset]
         self.op = op
         self.addr_reg = addr_reg
         self.offset = offset
-        super(ReadMemOp_Gadget, self).__init__(gadget.hex, gadget.address,
-                                             gadget.address_end, gadget.modified_regs, gadget.stack_fix, gadget.retn, gadget.arch, gadget.mem)
+        super(ReadMemOp_Gadget, self).__init__(base=gadget.base)
     def __str__(self):
         op = self.op
         if op == Operations.ADD:
@@ -266,8 +398,7 @@ class WriteMemOp_Gadget(Gadget):  # [addr_reg + offset] OP= src
         self.op = op 
         self.addr_reg = addr_reg
         self.offset = offset
-        super(WriteMemOp_Gadget, self).__init__(gadget.hex, gadget.address,
-                                               gadget.address_end, gadget.modified_regs, gadget.stack_fix, gadget.retn, gadget.arch, gadget.mem)
+        super(WriteMemOp_Gadget, self).__init__(base=gadget.base)
     def __str__(self):
         op = self.op
         if op == Operations.ADD:
@@ -295,8 +426,7 @@ class WriteMemOp_Gadget(Gadget):  # [addr_reg + offset] OP= src
 # 2nd youngest bit of EFLAGS is set to 1 (reserved bit)
 class Lahf_Gadget(Gadget): #load FLAGS to AH
     def __init__(self, gadget):
-        super(Lahf_Gadget, self).__init__(gadget.hex, gadget.address,
-                                               gadget.address_end, gadget.modified_regs, gadget.stack_fix, gadget.retn, gadget.arch, gadget.mem)
+        super(Lahf_Gadget, self).__init__(base=gadget.base)
 
     def __str__(self):
         return 'Lahf_Gadget' + super(Lahf_Gadget, self).__str__()
@@ -308,8 +438,7 @@ class StackPtrOp_Gadget(Gadget):  # esp=esp op reg
     def __init__(self, register, op, gadget):
         self.register = register
         self.op = op
-        super(StackPtrOp_Gadget, self).__init__(gadget.hex, gadget.address,
-                                               gadget.address_end, gadget.modified_regs, gadget.stack_fix, gadget.retn, gadget.arch, gadget.mem)
+        super(StackPtrOp_Gadget, self).__init__(base=gadget.base)
 
     def __str__(self):
         op = self.op
@@ -325,8 +454,7 @@ class StackPtrOp_Gadget(Gadget):  # esp=esp op reg
 
 class Other_Gadget(Gadget): 
     def __init__(self, gadget):
-        super(Other_Gadget, self).__init__(gadget.hex, gadget.address,
-                                          gadget.address_end, gadget.modified_regs, gadget.stack_fix, gadget.retn, gadget.arch, gadget.mem)
+        super(Other_Gadget, self).__init__(base=gadget.base)
 
     def __str__(self):
         return 'Other_Gadget' + super(Other_Gadget, self).__str__()
@@ -8,18 +8,45 @@ __email__ = "pietro.borrello95@gmail.com"
 from binascii import unhexlify, hexlify
 from enum import Enum
 from . import Arch
+from .Gadget import LoadConst_Gadget
 
 class GadgetBox(object):
-    def __init__(self, gadget, value=None):
+    def __init__(self, gadget, value=None, loads=()):
         self.gadget = gadget
         self.value = value
+        # other LoadConst gadgets at the same address, filled by the same gadget execution: ((gadget, value), ...)
+        self.loads = tuple(loads)
+
+    def set_registers(self):
+        """
+        Returns the registers set by the gadget execution, mapped to their values
+        """
+        registers = {}
+        for (g, value) in ((self.gadget, self.value),) + self.loads:
+            try:
+                registers[g.dest] = value
+            except AttributeError:
+                pass
+        return registers
+
+    def stack_value(self, offset):
+        """
+        Returns the value to place in the gadget stack slot at offset
+        """
+        for (g, value) in ((self.gadget, self.value),) + self.loads:
+            if isinstance(g, LoadConst_Gadget) and g.offset == offset:
+                return value
+        return self.value
 
     def dump(self):
         return 'Using: ' + str(self.value)+ '\n' + self.gadget.dump()
 
 
+    def key(self):
+        return (self.gadget.key(), self.value, tuple((g.key(), value) for (g, value) in self.loads))
+
     def __eq__(self, other):
-        return type(self) == type(other) and self.__dict__ == other.__dict__
+        return type(self) == type(other) and self.key() == other.key()
 
     def __ne__(self, other):
         """Overrides the default implementation (unnecessary in Python 3)"""
@@ -27,4 +54,4 @@ class GadgetBox(object):
 
     def __hash__(self):
         """Overrides the default implementation"""
-        return hash(tuple(sorted(self.__dict__.items())))
+        return hash(self.key())
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+from array import array
+from struct import pack, unpack, calcsize
+import io
+import mmap
+import pickle
+import sys
+from .Gadget import *
+from . import Arch
+
+COLLECTED_EXTENSION = '.collected'
+VERIFIED_EXTENSION = '.verified'
+
+MAGIC = b'ROPDGS\x00\x02'
+# count, arena size
+HEADER = '<II'
+# columns are aligned in the file, to be directly mapped in memory
+ALIGNMENT = 8
+
+GADGET_TYPES = (Gadget, LoadConst_Gadget, ClearReg_Gadget, UnOp_Gadget, MovReg_Gadget, BinOp_Gadget, ReadMem_Gadget,
+                WriteMem_Gadget, ReadMemOp_Gadget, WriteMemOp_Gadget, Lahf_Gadget, StackPtrOp_Gadget, Other_Gadget)
+TYPE_CODES = {t: i for (i, t) in enumerate(GADGET_TYPES)}
+
+# parameters of each gadget type, in constructor order
+PARAMS = {
+    Gadget: (),
+    LoadConst_Gadget: ('dest', 'offset'),
+    ClearReg_Gadget: ('dest',),
+    UnOp_Gadget: ('dest',),
+    MovReg_Gadget: ('dest', 'src'),
+    BinOp_Gadget: ('dest', 'src1', 'op', 'src2'),
+    ReadMem_Gadget: ('dest', 'addr_reg', 'offset'),
+    WriteMem_Gadget: ('addr_reg', 'offset', 'src'),
+    ReadMemOp_Gadget: ('dest', 'op', 'addr_reg', 'offset'),
+    WriteMemOp_Gadget: ('addr_reg', 'offset', 'op', 'src'),
+    Lahf_Gadget: (),
+    StackPtrOp_Gadget: ('register', 'op'),
+    Other_Gadget: (),
+}
+# column storing each parameter
+PARAM_COLUMNS = {'dest': 'dest', 'src': 'src', 'src1': 'src', 'register': 'src', 'src2': 'src2',
+                 'addr_reg': 'addr_reg', 'op': 'op', 'offset': 'offset'}
+
+COLUMNS = (('address', 'Q'), ('address_end', 'Q'), ('stack_fix', 'i'), ('retn', 'H'), ('type', 'B'), ('arch', 'B'),
+           ('dest', 'b'), ('src', 'b'), ('src2', 'b'), ('addr_reg', 'b'), ('op', 'B'), ('offset', 'Q'),
+           ('modified_regs', 'I'), ('mem', 'I'), ('flags', 'B'))
+
+# columns describing the base of a gadget
+BASE_COLUMNS = ('address', 'address_end', 'stack_fix', 'retn', 'arch', 'modified_regs', 'mem', 'flags')
+
+# maximum number of bases interned by a store
+MAX_BASES = 1 << 18
+
+# rows are sorted by type and destination register: each (type, dest) pair is a section of the file.
+# dest is -1 for gadgets without destination, so 17 slots per type
+DEST_SLOTS = 17
+
+# mem column bits, registers use the bits of their index
+MEM_STACK = 1 << 30
+MEM_UNKNOWN = 1 << 31
+# flags column bits
+FLAG_MEM = 1
+FLAG_SIMPLE_ACCESS = 2
+FLAG_MODIFIED_REGS = 4
+FLAG_STACK_FIX = 8
+
+
+REGISTERS = {registers: list(registers) for registers in (Arch.Registers32, Arch.Registers64)}
+OPERATIONS = list(Operations)
+
+
+def registers_for(arch):
+    if arch == Arch.ARCH_32:
+        return Arch.Registers32
+    return Arch.Registers64
+
+
+def regs_to_mask(regs):
+    mask = 0
+    for r in regs:
+        if r is Arch.MemType.stack:
+            mask |= MEM_STACK
+        elif r is Arch.UnknownType.unknown:
+            mask |= MEM_UNKNOWN
+        else:
+            mask |= 1 << (r.value - 1)
+    return mask
+
+
+# decoded register sets, shared between the gadgets
+_masks_cache = {}
+
+def mask_to_regs(mask, registers):
+    try:
+        return _masks_cache[(mask, registers)]
+    except KeyError:
+        pass
+    regs = set([r for r in registers if mask & (1 << (r.value - 1))])
+    if mask & MEM_STACK:
+        regs.add(Arch.MemType.stack)
+    if mask & MEM_UNKNOWN:
+        regs.add(Arch.UnknownType.unknown)
+    _masks_cache[(mask, registers)] = frozenset(regs)
+    return _masks_cache[(mask, registers)]
+
+
+def section_index(gadget_type, dest):
+    return gadget_type * DEST_SLOTS + dest + 1
+
+
+def align(pos):
+    return pos + (-pos % ALIGNMENT)
+
+
+class GadgetStore(object):
+    """
+    Compact columnar storage of gadgets: one array per field, and a byte arena for the opcodes.
+    Gadget objects are built on demand when accessing the store.
+    Loaded stores are memory mapped: only the pages of the accessed gadgets are read from disk
+    """
+    def __init__(self):
+        self.columns = {name: array(typecode) for (name, typecode) in COLUMNS}
+        self.hex_offsets = array('I', [0])
+        self.arena = bytearray()
+        # rows boundaries of the (type, dest) sections, if sorted
+        self.sections = None
+        self.bases = {}
+        self._mmap = None
+
+    def __len__(self):
+        return len(self.columns['type'])
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        c = self.columns
+        hex = bytes(self.arena[self.hex_offsets[i]:self.hex_offsets[i + 1]])
+        # typed gadgets at the same address share a single base
+        key = tuple(c[name][i] for name in BASE_COLUMNS) + (hex,)
+        base = self.bases.get(key)
+        if base is None:
+            registers = registers_for(c['arch'][i])
+            flags = c['flags'][i]
+            mem = None
+            if flags & FLAG_MEM:
+                mem = (mask_to_regs(c['mem'][i], registers), bool(flags & FLAG_SIMPLE_ACCESS))
+            base = GadgetBase(hex, address=c['address'][i], address_end=c['address_end'][i],
+                              modified_regs=mask_to_regs(c['modified_regs'][i], registers) if flags & FLAG_MODIFIED_REGS else None,
+                              stack_fix=c['stack_fix'][i] if flags & FLAG_STACK_FIX else None,
+                              retn=c['retn'][i], arch=c['arch'][i], mem=mem)
+            if len(self.bases) >= MAX_BASES:
+                self.bases.clear()
+            self.bases[key] = base
+        g = Gadget(base=base)
+        gadget_type = GADGET_TYPES[c['type'][i]]
+        if gadget_type is Gadget:
+            return g
+        params = []
+        for param in PARAMS[gadget_type]:
+            value = c[PARAM_COLUMNS[param]][i]
+            if param == 'offset':
+                params.append(value)
+            elif param == 'op':
+                params.append(OPERATIONS[value - 1])
+            else:
+                params.append(REGISTERS[registers_for(c['arch'][i])][value])
+        return gadget_type(*(params + [g]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def rows(self, types, dests=None):
+        """
+        Returns the indexes of the gadgets of the given types and, if dests is not None, with destination in the given registers
+        """
+        codes = [TYPE_CODES[t] for t in types]
+        dest_indexes = [-1] + list(range(DEST_SLOTS - 1)) if dests is None else [r.value - 1 for r in dests]
+        if self.sections is not None:
+            return [i for code in codes for dest in dest_indexes
+                    for i in range(self.sections[section_index(code, dest)], self.sections[section_index(code, dest) + 1])]
+        return [i for i in range(len(self)) if self.columns['type'][i] in codes and self.columns['dest'][i] in dest_indexes]
+
+    def select(self, types, dests=None):
+        return [self[i] for i in self.rows(types, dests)]
+
+    def counts(self):
+        """
+        Returns the number of gadgets of each type
+        """
+        counts = {}
+        for (code, t) in enumerate(GADGET_TYPES):
+            if self.sections is not None:
+                count = self.sections[section_index(code + 1, -1)] - self.sections[section_index(code, -1)]
+            else:
+                count = self.columns['type'].tolist().count(code)
+            if count:
+                counts[t] = count
+        return counts
+
+    def append(self, g):
+        c = self.columns
+        gadget_type = type(g)
+        c['address'].append(g.address or 0)
+        c['address_end'].append(g.address_end or 0)
+        c['stack_fix'].append(g.stack_fix if g.stack_fix is not None else 0)
+        c['retn'].append(g.retn or 0)
+        c['type'].append(TYPE_CODES[gadget_type])
+        c['arch'].append(g.arch)
+        for column in ('dest', 'src', 'src2', 'addr_reg'):
+            c[column].append(-1)
+        c['op'].append(0)
+        c['offset'].append(0)
+        for param in PARAMS[gadget_type]:
+            value = getattr(g, param)
+            if param == 'offset':
+                c['offset'][-1] = value & 0xFFFFFFFFFFFFFFFF
+            elif param == 'op':
+                c['op'][-1] = value.value
+            else:
+                c[PARAM_COLUMNS[param]][-1] = value.value - 1
+        flags = 0
+        if g.modified_regs is not None:
+            flags |= FLAG_MODIFIED_REGS
+        if g.stack_fix is not None:
+            flags |= FLAG_STACK_FIX
+        if g.mem is not None:
+            flags |= FLAG_MEM
+            if g.mem[1]:
+                flags |= FLAG_SIMPLE_ACCESS
+        c['modified_regs'].append(regs_to_mask(g.modified_regs or ()))
+        c['mem'].append(regs_to_mask(g.mem[0]) if g.mem is not None else 0)
+        c['flags'].append(flags)
+        self.arena += g.hex
+        self.hex_offsets.append(len(self.arena))
+        self.sections = None
+
+    @staticmethod
+    def from_gadgets(gadgets):
+        store = GadgetStore()
+        for g in gadgets:
+            store.append(g)
+        return store
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            self.write(f)
+
+    def to_bytes(self):
+        f = io.BytesIO()
+        self.write(f)
+        return f.getvalue()
+
+    def write(self, f):
+        # sort the rows in (type, dest) sections
+        order = sorted(range(len(self)), key=lambda i: (self.columns['type'][i], self.columns['dest'][i]))
+        sections = array('I', [0] * (len(GADGET_TYPES) * DEST_SLOTS + 1))
+        for i in order:
+            sections[section_index(self.columns['type'][i], self.columns['dest'][i]) + 1] += 1
+        for k in range(1, len(sections)):
+            sections[k] += sections[k - 1]
+        arena = bytearray()
+        hex_offsets = array('I', [0])
+        for i in order:
+            arena += self.arena[self.hex_offsets[i]:self.hex_offsets[i + 1]]
+            hex_offsets.append(len(arena))
+
+        header = MAGIC + pack(HEADER, len(self), len(arena))
+        f.write(header)
+        pos = len(header)
+        for (name, typecode) in (('sections', 'I'),) + COLUMNS + (('hex_offsets', 'I'),):
+            if name == 'sections':
+                column = sections
+            elif name == 'hex_offsets':
+                column = hex_offsets
+            else:
+                column = array(typecode, [self.columns[name][i] for i in order])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            f.write(b'\x00' * (align(pos) - pos))
+            f.write(column.tobytes())
+            pos = align(pos) + len(column) * column.itemsize
+        f.write(arena)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rb') as f:
+            if sys.byteorder == 'big':
+                data = f.read()
+            else:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a gadget store' % filename)
+        return GadgetStore.from_bytes(data)
+
+    @staticmethod
+    def from_bytes(data):
+        """
+        Builds a store on top of data, the bytes written by write(): columns are not copied
+        """
+        pos = len(MAGIC)
+        (count, arena_size) = unpack(HEADER, data[pos:pos + calcsize(HEADER)])
+        pos += calcsize(HEADER)
+        store = GadgetStore()
+        view = memoryview(data)
+        for (name, typecode) in (('sections', 'I'),) + COLUMNS + (('hex_offsets', 'I'),):
+            pos = align(pos)
+            if name == 'sections':
+                length = len(GADGET_TYPES) * DEST_SLOTS + 1
+            elif name == 'hex_offsets':
+                length = count + 1
+            else:
+                length = count
+            size = length * array(typecode).itemsize
+            if sys.byteorder == 'big':
+                column = array(typecode)
+                column.frombytes(data[pos:pos + size])
+                column.byteswap()
+            else:
+                # lazily read from the mapped file
+                column = view[pos:pos + size].cast(typecode)
+            pos += size
+            if name == 'sections':
+                store.sections = column
+            elif name == 'hex_offsets':
+                store.hex_offsets = column
+            else:
+                store.columns[name] = column
+        store.arena = view[pos:pos + arena_size]
+        store._mmap = data
+        return store
+
+
+def count_types(gadgets):
+    """
+    Returns the number of gadgets of each type, from the store sections if gadgets is a store
+    """
+    if isinstance(gadgets, GadgetStore):
+        return gadgets.counts()
+    counts = {}
+    for g in gadgets:
+        counts[type(g)] = counts.get(type(g), 0) + 1
+    return counts
+
+
+def print_stats(counts):
+    """
+    Prints the percentage of gadgets of each type
+    """
+    total = sum(counts.values())
+    print ("Found %d different gadgets" % total)
+    for t in counts:
+        print ('*', t.__name__, "%.2f" % (counts[t]/float(total) * 100) + '%')
+
+
+def save_gadgets(filename, gadgets):
+    GadgetStore.from_gadgets(gadgets).save(filename)
+
+
+def load_gadgets(filename, types=None):
+    """
+    Loads the gadgets saved in filename, either as a gadget store or as a pickled list.
+    If types is not None, only the gadgets of the given types are returned, as a list
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            f.seek(0)
+            gadgets = pickle.load(f)
+            if types is not None:
+                gadgets = [g for g in gadgets if type(g) in types]
+            return gadgets
+    store = GadgetStore.load(filename)
+    if types is not None:
+        return store.select(types)
+    return store
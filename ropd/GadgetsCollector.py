@@ -6,19 +6,23 @@ __license__ = "BSD 2-clause"
 __email__ = "pietro.borrello95@gmail.com"
 
 from binascii import unhexlify, hexlify
+import json
 import random
 from struct import pack, unpack
 from itertools import permutations, combinations, chain
-from multiprocessing import Pool
 from tqdm import *
 from ropper import RopperService
 from .Gadget import Gadget, Operations, Types
 from .Gadget import *
+from .Gadget import cache_disassembly
 import capstone
 from capstone.x86 import *
 from unicorn import *
 from unicorn.x86_const import *
 from . import Arch
+from . import Profiler
+from . import Metrics
+from .BinaryInfo import BinaryInfo
 import logging
 
 
@@ -27,92 +31,172 @@ ADDRESS = 0x1000000
 MAX_BYTES_PER_INSTR = 0xf
 HOOK_ERR_VAL = 0x1
 MAX_RETN = 0x20
+# maximum number of instructions of a gadget
+INST_COUNT = 6
 unsafe_classes = [X86_GRP_JUMP, X86_GRP_CALL, X86_GRP_INT]
 sys_unsafe_classes = [X86_GRP_JUMP, X86_GRP_CALL]
 unsafe_ids = [X86_INS_IN, X86_INS_OUT]
-
-FLAGS_MASK = 0xd5
-
-
-
-def filter_unsafe(gadgets):
+# instructions accessing memory without memory operands
+IMPLICIT_MEMORY_IDS = (X86_INS_XLATB, X86_INS_LEAVE, X86_INS_ENTER, X86_INS_MASKMOVQ, X86_INS_MASKMOVDQU, X86_INS_MONITOR)
+# instructions moving the stack pointer to access the stack
+STACK_IDS = (X86_INS_PUSH, X86_INS_POP, X86_INS_PUSHF, X86_INS_PUSHFD, X86_INS_PUSHFQ, X86_INS_POPF, X86_INS_POPFD,
+             X86_INS_POPFQ, X86_INS_PUSHAL, X86_INS_PUSHAW, X86_INS_POPAL, X86_INS_POPAW)
+
+FLAGS_MASK = Arch.FLAGS_MASK
+
+
+
+class StaticAnalysis(object):
+    """
+    Registers read and written by the instructions of a gadget before its ret, from its disassembly.
+    mem_regs are the registers its memory accesses may depend on: the ones addressing its memory operands, or all
+    the registers it reads if these are written by previous instructions (e.g. mov rcx, rax; mov [rcx], rbx).
+    touches_memory tells if it may access memory other than the initialized stack cells, through push and pop
+    """
+    __slots__ = ('read', 'written', 'mem_regs', 'touches_memory')
+
+    def __init__(self, arch, instructions):
+        (self.read, self.written) = arch.effects(instructions)[:2]
+        self.mem_regs = set()
+        self.touches_memory = False
+        written = set()
+        derived = False
+        for i in instructions:
+            regs = set()
+            for op in i.operands:
+                if op.type == X86_OP_MEM and i.id not in (X86_INS_LEA, X86_INS_NOP):
+                    self.touches_memory = True
+                    regs.update(arch.CS_REGS[r] for r in (op.mem.base, op.mem.index) if r in arch.CS_REGS)
+            if i.id in IMPLICIT_MEMORY_IDS:
+                self.touches_memory = True
+                regs.update(arch.CS_REGS[r] for r in i.regs_access()[0] if r in arch.CS_REGS)
+            # e.g. add rsp, 0x100 or mov rsp, rax: the stack is then accessed out of the initialized cells
+            if i.id not in STACK_IDS and any(arch.CS_REGS.get(r) is arch.Registers_sp for r in i.regs_access()[1]):
+                self.touches_memory = True
+            derived = derived or bool(regs & written)
+            self.mem_regs.update(regs)
+            # push and pop move the stack pointer by a constant
+            written.update(r for r in arch.effects([i])[1] if i.id not in STACK_IDS or r is not arch.Registers_sp)
+        if len([i for i in instructions if i.id in STACK_IDS]) >= arch.STACK_CELLS // 2:
+            self.touches_memory = True
+        if derived:
+            self.mem_regs.update(r for r in self.read if r in arch.REG_MASKS)
+        self.mem_regs.discard(arch.Registers_sp)
+
+
+def filter_unsafe(gadgets, arch):
+    """
+    Disassembles each gadget once: discards the ones not ending with a ret, or with jumps, calls or in/out instructions,
+    turns the syscall ones into Other_Gadget and sets the retn and the static analysis of the others.
+    Their disassembly is cached for disasm()
+    """
     safe_gadgets = []
     for g in gadgets:
         unsafe = False
         syscall = False
-        for i in Arch.md.disasm(g.hex, g.address):
+        instructions = list(arch.md.disasm(g.hex, g.address))
+        ret = instructions[-1] if instructions else None
+        if ret is None or ret.address != g.address_end or ret.id != X86_INS_RET:
+            Metrics.count('collect', 'discarded', 'not_ret')
+            continue
+        g.retn = ret.operands[0].value.imm if ret.operands else 0
+        if g.retn >= MAX_RETN:
+            Metrics.count('collect', 'discarded', 'large_retn')
+            continue
+        for i in instructions[:-1]:
             if any(x in i.groups for x in sys_unsafe_classes) or i.id in unsafe_ids:
                 unsafe = True
             if X86_GRP_INT in i.groups:
                 syscall = True
         if not unsafe:
-            if not syscall:
-                safe_gadgets.append(g)
-            else:
-                safe_gadgets.append(Other_Gadget(g))
+            if syscall:
+                g = Other_Gadget(g)
+            g.static = StaticAnalysis(arch, instructions[:-1])
+            cache_disassembly(arch.ARCH_BITS, g.hex, g.address, instructions)
+            safe_gadgets.append(g)
+        else:
+            Metrics.count('collect', 'discarded', 'unsafe')
     return safe_gadgets
 
 #Unused
-def sys_filter_unsafe(gadgets):
+def sys_filter_unsafe(gadgets, arch):
     safe_gadgets = []
     for g in gadgets:
         unsafe = False
-        for i in Arch.md.disasm(g.hex, g.address):
+        for i in arch.md.disasm(g.hex, g.address):
             if any(x in i.groups for x in sys_unsafe_classes) or i.id in unsafe_ids:
                 unsafe = True
         if not unsafe:
             safe_gadgets.append(g)
     return safe_gadgets
 
-def checkLoadConstGadget(init_regs, init_stack, final_state, gadget):
+def sources(gadget, regs):
+    """
+    Returns the registers of regs the gadget may read, all of them if it was not statically analyzed
+    """
+    if gadget.static is None:
+        return list(regs)
+    return [r for r in regs if r in gadget.static.read]
+
+
+def address_registers(arch, gadget, rv_pairs):
+    """
+    Returns the registers that may address the memory accesses of the gadget
+    """
+    if gadget.static is None:
+        return [r for r in rv_pairs if r is not arch.Registers_sp]
+    return [r for r in rv_pairs if r in gadget.static.mem_regs]
+
+def checkLoadConstGadget(arch, init_regs, init_stack, final_state, gadget):
     result = []
     for r in gadget.modified_regs:
         for off in [i for i, x in enumerate(
             init_stack) if x == final_state[r]]:
                 #don't overlap with ret address: load register inside gadget stack occupation
-                if off < gadget.stack_fix - (Arch.ARCH_BITS//8) and off >= 0:
-                    result.append(LoadConst_Gadget(r, off*(Arch.ARCH_BITS//8), gadget))
+                if off < gadget.stack_fix - (arch.ARCH_BITS//8) and off >= 0:
+                    result.append(LoadConst_Gadget(r, off*(arch.ARCH_BITS//8), gadget))
     return result
 
-def checkClearRegGadget(init_regs, init_stack, final_state, gadget):
+def checkClearRegGadget(arch, init_regs, init_stack, final_state, gadget):
     result = []
     for r in gadget.modified_regs:
         if final_state[r] == 0:
                 result.append(ClearReg_Gadget(r, gadget))
     return result
 
-def checkUnOpGadget(init_regs, init_stack, final_state, gadget):
+def checkUnOpGadget(arch, init_regs, init_stack, final_state, gadget):
     result = []
-    for r in gadget.modified_regs:
-        if final_state[r] == compute_operation(init_regs[r], Operations.ADD, 1):
+    for r in sources(gadget, gadget.modified_regs):
+        if final_state[r] == compute_operation(arch, init_regs[r], Operations.ADD, 1):
                 result.append(UnOp_Gadget(r, gadget))
     return result
 
-def checkMovRegGadget(init_regs, init_stack, final_state, gadget):
+def checkMovRegGadget(arch, init_regs, init_stack, final_state, gadget):
     result = []
+    srcs = sources(gadget, init_regs)
     for r in gadget.modified_regs:
         #inverse lookup by value
         for src in [key for key, value in init_regs.items()
-                        if value == final_state[r]]:
+                        if value == final_state[r] and key in srcs]:
             if final_state[src] == init_regs[src]:
                 result.append(MovReg_Gadget(r, src, gadget))
     return result
 
-def compute_operation(a, op, b):
+def compute_operation(arch, a, op, b):
     if op == Operations.ADD:
-        return (a + b) & Arch.MAX_INT
+        return (a + b) & arch.MAX_INT
     elif op == Operations.SUB:
-        return (a - b) & Arch.MAX_INT
+        return (a - b) & arch.MAX_INT
     elif op == Operations.MUL:
-        return (a * b) & Arch.MAX_INT
+        return (a * b) & arch.MAX_INT
     elif op == Operations.DIV:
-        return (a // b) & Arch.MAX_INT
+        return (a // b) & arch.MAX_INT
     elif op == Operations.XOR:
-        return (a ^ b) & Arch.MAX_INT
+        return (a ^ b) & arch.MAX_INT
     elif op == Operations.OR:
-        return (a | b) & Arch.MAX_INT
+        return (a | b) & arch.MAX_INT
     elif op == Operations.AND:
-        return (a & b) & Arch.MAX_INT
+        return (a & b) & arch.MAX_INT
 
 
 def is_commutative(op, ):
@@ -133,37 +217,38 @@ def is_commutative(op, ):
 
 
 
-def checkBinOpGadget(init_regs, init_stack, final_state, gadget):
+def checkBinOpGadget(arch, init_regs, init_stack, final_state, gadget):
     result = []
     #TODO: overapproximating trivial operations (src1 must be != src2, and div must not give 0)
+    srcs = sources(gadget, arch.regs)
     for op in Operations:
         if is_commutative(op):
-            for src1, src2 in combinations(Arch.regs, 2):
-                op_res = compute_operation(
+            for src1, src2 in combinations(srcs, 2):
+                op_res = compute_operation(arch,
                     init_regs[src1], op, init_regs[src2])
                 for dest in [r for r in final_state if final_state[r] == op_res and r in gadget.modified_regs]:
                     result.append(BinOp_Gadget(dest, src1, op, src2, gadget))
         else:
             # if DIV, only valid EAX=EAX/src2, TODO: not op_res == 0 may miss some DIV gadgets
             if op == Operations.DIV:
-                    for src2 in Arch.regs:
-                        dest = Arch.Registers_a
-                        src1 = Arch.Registers_a
+                    for src2 in srcs:
+                        dest = arch.Registers_a
+                        src1 = arch.Registers_a
                         # check real div of 64bits
-                        div_op_res = ((init_regs[Arch.Registers_d] << Arch.ARCH_BITS) + init_regs[src1]) // init_regs[src2]
+                        div_op_res = ((init_regs[arch.Registers_d] << arch.ARCH_BITS) + init_regs[src1]) // init_regs[src2]
                         # check if result handled by hook_err
-                        hook_op_res = ((HOOK_ERR_VAL << Arch.ARCH_BITS) + init_regs[src1]) // init_regs[src2]
+                        hook_op_res = ((HOOK_ERR_VAL << arch.ARCH_BITS) + init_regs[src1]) // init_regs[src2]
                         # check if the gadget itself correctly zeroed EDX
-                        op_res = compute_operation(init_regs[src1], op, init_regs[src2])
-                        if final_state[dest] == div_op_res and src2 != Arch.Registers_a:
+                        op_res = compute_operation(arch, init_regs[src1], op, init_regs[src2])
+                        if final_state[dest] == div_op_res and src2 != arch.Registers_a:
                             result.append(BinOp_Gadget(dest, src1, op, src2, gadget))
-                        elif final_state[dest] == hook_op_res and src2 != Arch.Registers_a:
+                        elif final_state[dest] == hook_op_res and src2 != arch.Registers_a:
                             result.append(BinOp_Gadget(dest, src1, op, src2, gadget))
-                        elif final_state[dest] == op_res and op_res != 0 and src2 != Arch.Registers_a:
+                        elif final_state[dest] == op_res and op_res != 0 and src2 != arch.Registers_a:
                             result.append(BinOp_Gadget(dest, src1, op, src2, gadget))
             else:
-                for src1, src2 in permutations(Arch.regs, 2):
-                    op_res = compute_operation(
+                for src1, src2 in permutations(srcs, 2):
+                    op_res = compute_operation(arch,
                         init_regs[src1], op, init_regs[src2])
                     for dest in [r for r in final_state if final_state[r] == op_res and r in gadget.modified_regs]:
                         result.append(BinOp_Gadget(dest, src1, op, src2, gadget))
@@ -171,21 +256,22 @@ def checkBinOpGadget(init_regs, init_stack, final_state, gadget):
     return result
 
 def hook_err(uc, int_num, user_data):
-    #ip = uc.reg_read(Arch.IP_REG)
+    arch = user_data
+    #ip = uc.reg_read(arch.IP_REG)
     #instr_bytes = uc.mem_read(ip, MAX_BYTES_PER_INSTR)
-    #instr = next(Arch.md.disasm(instr_bytes, 0x0, count = 1))
+    #instr = next(arch.md.disasm(instr_bytes, 0x0, count = 1))
     #print ('ERROR: interrupt %x, due to: %s %s' % (int_num, instr.mnemonic, instr.op_str))
     if int_num==0: #div by zero fault
         # probaly since EDX:EAX doesn't fit in 32 bits
         # if was real div_by_zero, after resume it will double fault, and re-handled as int 0x8
         # safely modify EDX, independently from init_value, that will be overwritten by div
-        uc.reg_write(Arch.regs[Arch.Registers_d], HOOK_ERR_VAL)
+        uc.reg_write(arch.regs[arch.Registers_d], HOOK_ERR_VAL)
         return True
     return False
 
 # callback for tracing invalid memory access (READ or WRITE)
 def hook_mem_invalid(uc, access, address, size, value, user_data):
-    mapped_pages_ref = user_data
+    (mapped_pages_ref, arch) = user_data
     mapped_pages = mapped_pages_ref[0]
     # limit number of possible mapped pages, due to REP MOVS
     if mapped_pages > 128:
@@ -194,9 +280,10 @@ def hook_mem_invalid(uc, access, address, size, value, user_data):
     mapped_pages_ref[0] = mapped_pages
     #memory access not necessarly aligned to page boundaries, so map two pages to be sure
     try:
-        uc.mem_map((address // Arch.PAGE_SIZE) * Arch.PAGE_SIZE, 2 * Arch.PAGE_SIZE)
+        uc.mem_map((address // arch.PAGE_SIZE) * arch.PAGE_SIZE, 2 * arch.PAGE_SIZE)
     except UcError as e:
-        logging.warning('Invalid memory mapping for %x', ((address // Arch.PAGE_SIZE) * Arch.PAGE_SIZE))
+        Metrics.count('collect', 'emulation_errors', 'invalid memory mapping')
+        logging.debug('Invalid memory mapping for %x', ((address // arch.PAGE_SIZE) * arch.PAGE_SIZE))
     return True
 
 
@@ -205,135 +292,128 @@ def hook_mem_invalid(uc, access, address, size, value, user_data):
 def hook_mem_access(uc, access, address, size, value, user_data):
     address_written = user_data[0]
     address_read = user_data[1]
+    arch = user_data[2]
     if access == UC_MEM_WRITE:
         #print("MEM WRITE at 0x%x, data size = %u, data value = 0x%x" % (address, size, value))
         address_written[address] = value
     else:   # READ
-        #value = unpack(Arch.PACK_VALUE, uc.mem_read(address, Arch.ARCH_BITS//8))[0]
+        #value = unpack(arch.PACK_VALUE, uc.mem_read(address, arch.ARCH_BITS//8))[0]
         #check if previously written or stack
         if address not in address_written: #initialize if never written
-            value = Arch.rand()
+            value = arch.rand()
             try:
-                uc.mem_write(address, pack(Arch.PACK_VALUE, value))
+                uc.mem_write(address, pack(arch.PACK_VALUE, value))
             except UcError as e:
                 # probably due to REP MOVS
                 return False
         else:
             #TODO: ignored real read size, only full registers
-            value = unpack(Arch.PACK_VALUE, uc.mem_read(address, Arch.ARCH_BITS//8))[0]
+            value = unpack(arch.PACK_VALUE, uc.mem_read(address, arch.ARCH_BITS//8))[0]
         address_read[address] = value
         #print("MEM READ at 0x%x, data size = %u, value = 0x%x" % (address, size, value))
 
 
-def checkReadMemGadget(
+def checkReadMemGadget(arch,
     rv_pairs1, final_values1, address_read1, rv_pairs2, final_values2, address_read2, gadget):
     result = []
     for dest in gadget.modified_regs:
         possible = set()
         for addr in [addr for addr in address_read1 if address_read1[addr] == final_values1[dest]]:
-            for addr_reg in rv_pairs1:
-                if addr_reg is not Arch.Registers_sp:
-                    offset = (addr - rv_pairs1[addr_reg]) & Arch.MAX_INT
-                    possible.add((dest, addr_reg, offset))
+            for addr_reg in address_registers(arch, gadget, rv_pairs1):
+                offset = (addr - rv_pairs1[addr_reg]) & arch.MAX_INT
+                possible.add((dest, addr_reg, offset))
         for addr in [addr for addr in address_read2 if address_read2[addr] == final_values2[dest]]:
-            for addr_reg in rv_pairs2:
-                if addr_reg is not Arch.Registers_sp:
-                    offset = (addr - rv_pairs2[addr_reg]) & Arch.MAX_INT
-                    if (dest, addr_reg, offset) in possible:
-                        result.append(ReadMem_Gadget(dest, addr_reg, offset, gadget))
+            for addr_reg in address_registers(arch, gadget, rv_pairs2):
+                offset = (addr - rv_pairs2[addr_reg]) & arch.MAX_INT
+                if (dest, addr_reg, offset) in possible:
+                    result.append(ReadMem_Gadget(dest, addr_reg, offset, gadget))
     return result
 
 
-def checkWriteMemGadget(
+def checkWriteMemGadget(arch,
         rv_pairs1, address_written1, rv_pairs2, address_written2, gadget):
     result = []
-    for src in Arch.regs_no_sp:
+    for src in sources(gadget, arch.regs_no_sp):
         possible = set()
         for addr in [addr for addr in address_written1 if address_written1[addr] == rv_pairs1[src]]:
-            for addr_reg in rv_pairs1:
-                if addr_reg is not Arch.Registers_sp:
-                    offset = (addr - rv_pairs1[addr_reg]) & Arch.MAX_INT
-                    possible.add((addr_reg, offset, src))
+            for addr_reg in address_registers(arch, gadget, rv_pairs1):
+                offset = (addr - rv_pairs1[addr_reg]) & arch.MAX_INT
+                possible.add((addr_reg, offset, src))
         for addr in [addr for addr in address_written2 if address_written2[addr] == rv_pairs2[src]]:
-            for addr_reg in rv_pairs2:
-                if addr_reg is not Arch.Registers_sp:
-                    offset = (addr - rv_pairs2[addr_reg]) & Arch.MAX_INT
-                    if (addr_reg, offset, src) in possible:
-                        result.append(WriteMem_Gadget(addr_reg, offset, src, gadget))
+            for addr_reg in address_registers(arch, gadget, rv_pairs2):
+                offset = (addr - rv_pairs2[addr_reg]) & arch.MAX_INT
+                if (addr_reg, offset, src) in possible:
+                    result.append(WriteMem_Gadget(addr_reg, offset, src, gadget))
     return result
 
 # dest = [addr_reg + offset]
-def checkReadMemOpGadget(
+def checkReadMemOpGadget(arch,
     rv_pairs1, final_values1, address_read1, rv_pairs2, final_values2, address_read2, gadget):
     result = []
     for dest in gadget.modified_regs:
         possible = set()
         for op in Operations:
             for addr in address_read1:
-                if compute_operation(address_read1[addr], op, rv_pairs1[dest]) == final_values1[dest]:
+                if compute_operation(arch, address_read1[addr], op, rv_pairs1[dest]) == final_values1[dest]:
                     # ignore bad div
                     if op == Operations.DIV and final_values1[dest] == 0:
                         continue
-                    for addr_reg in rv_pairs1:
-                        if addr_reg is not Arch.Registers_sp:
-                            offset = (addr - rv_pairs1[addr_reg]) & Arch.MAX_INT
-                            possible.add((dest, addr_reg, offset))
+                    for addr_reg in address_registers(arch, gadget, rv_pairs1):
+                        offset = (addr - rv_pairs1[addr_reg]) & arch.MAX_INT
+                        possible.add((dest, addr_reg, offset))
             for addr in address_read2:
-                if compute_operation(address_read2[addr], op, rv_pairs2[dest]) == final_values2[dest]:
-                    for addr_reg in rv_pairs2:
-                        if addr_reg is not Arch.Registers_sp:
-                            offset = (addr - rv_pairs2[addr_reg]) & Arch.MAX_INT
-                            if (dest, addr_reg, offset) in possible:
-                                result.append(ReadMemOp_Gadget(dest, op, addr_reg, offset, gadget))
+                if compute_operation(arch, address_read2[addr], op, rv_pairs2[dest]) == final_values2[dest]:
+                    for addr_reg in address_registers(arch, gadget, rv_pairs2):
+                        offset = (addr - rv_pairs2[addr_reg]) & arch.MAX_INT
+                        if (dest, addr_reg, offset) in possible:
+                            result.append(ReadMemOp_Gadget(dest, op, addr_reg, offset, gadget))
     return result
 
 # [addr_reg + offset] OP= src
-def checkWriteMemOpGadget(
+def checkWriteMemOpGadget(arch,
         rv_pairs1, address_read1, address_written1, rv_pairs2, address_read2, address_written2, gadget):
     result = []
-    for src in Arch.regs_no_sp:
+    for src in sources(gadget, arch.regs_no_sp):
         possible = set()
         for op in Operations:
             for addr in address_written1:
-                if addr in address_read1 and address_written1[addr] == compute_operation(address_read1[addr], op, rv_pairs1[src]):
+                if addr in address_read1 and address_written1[addr] == compute_operation(arch, address_read1[addr], op, rv_pairs1[src]):
                     # ignore bad div
                     if op == Operations.DIV and address_written1[addr] == 0:
                         continue
-                    for addr_reg in rv_pairs1:
-                        if addr_reg is not Arch.Registers_sp:
-                            offset = (addr - rv_pairs1[addr_reg]) & Arch.MAX_INT
-                            possible.add((addr_reg, offset, src))
+                    for addr_reg in address_registers(arch, gadget, rv_pairs1):
+                        offset = (addr - rv_pairs1[addr_reg]) & arch.MAX_INT
+                        possible.add((addr_reg, offset, src))
             for addr in address_written2:
-                if addr in address_read2 and address_written2[addr] == compute_operation(address_read2[addr], op, rv_pairs2[src]):
-                    for addr_reg in rv_pairs2:
-                        if addr_reg is not Arch.Registers_sp:
-                            offset = (addr - rv_pairs2[addr_reg]) & Arch.MAX_INT
-                            if (addr_reg, offset, src) in possible:
-                                result.append(WriteMemOp_Gadget(addr_reg, offset, op, src, gadget))
+                if addr in address_read2 and address_written2[addr] == compute_operation(arch, address_read2[addr], op, rv_pairs2[src]):
+                    for addr_reg in address_registers(arch, gadget, rv_pairs2):
+                        offset = (addr - rv_pairs2[addr_reg]) & arch.MAX_INT
+                        if (addr_reg, offset, src) in possible:
+                            result.append(WriteMemOp_Gadget(addr_reg, offset, op, src, gadget))
     return result
 
 #AH: = SF: ZF: xx: AF: xx: PF: 1: CF
 # xx - unknown
 # mask: 0xd5
 # 2nd youngest bit of EFLAGS is set to 1 (reserved bit)
-def checkLahfGadget(flags_init, final_flags, final_state, gadget):
-    if flags_init == final_flags and Arch.Registers_a in gadget.modified_regs:
-        ah = ((final_state[Arch.Registers_a] >> 8) & FLAGS_MASK) | 2
+def checkLahfGadget(arch, flags_init, final_flags, final_state, gadget):
+    if flags_init == final_flags and arch.Registers_a in gadget.modified_regs:
+        ah = ((final_state[arch.Registers_a] >> 8) & FLAGS_MASK) | 2
         if ah == (final_flags & FLAGS_MASK) | 2 :
             return [Lahf_Gadget(gadget)]
     return []
 
 
-def checkStackPtrOpGadget(init_regs1, final_state1, init_regs2, final_state2, gadget):
+def checkStackPtrOpGadget(arch, init_regs1, final_state1, init_regs2, final_state2, gadget):
     # diff := stack_fix +/- register
-    diff1 = final_state1[Arch.Registers_sp] - init_regs1[Arch.Registers_sp]
-    diff2 = final_state2[Arch.Registers_sp] - init_regs2[Arch.Registers_sp]
+    diff1 = final_state1[arch.Registers_sp] - init_regs1[arch.Registers_sp]
+    diff2 = final_state2[arch.Registers_sp] - init_regs2[arch.Registers_sp]
 
-    for r in Arch.regs_no_sp:
-        stack_fix1 = compute_operation(diff1, Operations.SUB, init_regs1[r])
-        stack_fix2 = compute_operation(diff2, Operations.SUB, init_regs2[r])
-        if stack_fix1 == stack_fix2 and stack_fix1 + (Arch.ARCH_BITS // 8) > 0 and stack_fix1 + (Arch.ARCH_BITS // 8)< 0x1000:
-            gadget.stack_fix = stack_fix1 + (Arch.ARCH_BITS // 8) + gadget.retn
+    for r in arch.regs_no_sp:
+        stack_fix1 = compute_operation(arch, diff1, Operations.SUB, init_regs1[r])
+        stack_fix2 = compute_operation(arch, diff2, Operations.SUB, init_regs2[r])
+        if stack_fix1 == stack_fix2 and stack_fix1 + (arch.ARCH_BITS // 8) > 0 and stack_fix1 + (arch.ARCH_BITS // 8)< 0x1000:
+            gadget.stack_fix = stack_fix1 + (arch.ARCH_BITS // 8) + gadget.retn
 
             # avoid interleave of other (syscall) gadgets with stack ptr gadgets
             if type(gadget) is not Other_Gadget:
@@ -341,91 +421,76 @@ def checkStackPtrOpGadget(init_regs1, final_state1, init_regs2, final_state2, ga
 
     return []
 
-def emulate(g): #gadget g
+def emulate(g, arch, trace_memory=True): #gadget g
     try:
-        mu = Uc(UC_ARCH_X86, Arch.UC_MODE)
+        mu = Uc(UC_ARCH_X86, arch.UC_MODE)
         sp_init = ADDRESS + 0x112230
         rv_pairs = {}
-        for r in Arch.regs_no_sp:
-            rv_pairs[r] = Arch.rand()
-        rv_pairs[Arch.Registers_sp] = sp_init
+        for r in arch.regs_no_sp:
+            rv_pairs[r] = arch.rand()
+        rv_pairs[arch.Registers_sp] = sp_init
         rand_stack = []
         address_written = {}
         address_read = {}
-        for i in range(Arch.STACK_CELLS):
-            value = Arch.rand()
+        for i in range(arch.STACK_CELLS):
+            value = arch.rand()
             rand_stack.append(value)
-            address_written[sp_init + (Arch.ARCH_BITS//8)*i] = value
-        flags_init = Arch.rand() & FLAGS_MASK
+            address_written[sp_init + (arch.ARCH_BITS//8)*i] = value
+        flags_init = arch.rand() & FLAGS_MASK
 
         # map 2MB memory for this emulation
         mu.mem_map(ADDRESS, 2 * 1024 * 1024)
         # write machine code to be emulated to memory
         mu.mem_write(ADDRESS, g.hex)
         # initialize stack
-        mu.reg_write(Arch.regs[Arch.Registers_sp], sp_init)
+        mu.reg_write(arch.regs[arch.Registers_sp], sp_init)
         #init registers with random values
-        for r in Arch.regs_no_sp:
-            mu.reg_write(Arch.regs[r], rv_pairs[r])
+        for r in arch.regs_no_sp:
+            mu.reg_write(arch.regs[r], rv_pairs[r])
             #print (r, hex(rv_pairs[r]))
-        mu.reg_write(Arch.FLAGS_REG, flags_init)
+        mu.reg_write(arch.FLAGS_REG, flags_init)
         #write stack
         for i in range(len(rand_stack)):
-            mu.mem_write(mu.reg_read(Arch.regs[Arch.Registers_sp]) +
-                            (Arch.ARCH_BITS // 8) * i, pack(Arch.PACK_VALUE, rand_stack[i]))
+            mu.mem_write(mu.reg_read(arch.regs[arch.Registers_sp]) +
+                            (arch.ARCH_BITS // 8) * i, pack(arch.PACK_VALUE, rand_stack[i]))
             #print (hex(rand_stack[i]))
 
         # intercept invalid memory events
         mapped_pages = 0
         mapped_pages_ref = [mapped_pages]
         mu.hook_add(UC_HOOK_MEM_READ_UNMAPPED |
-                    UC_HOOK_MEM_WRITE_UNMAPPED, hook_mem_invalid, user_data=mapped_pages_ref)
+                    UC_HOOK_MEM_WRITE_UNMAPPED, hook_mem_invalid, user_data=(mapped_pages_ref, arch))
         #intercept CPU errors (probably due to div)
-        mu.hook_add(UC_HOOK_INTR, hook_err)
+        mu.hook_add(UC_HOOK_INTR, hook_err, user_data=arch)
         # tracing all memory READ & WRITE access
-        user_data = (address_written, address_read)
-        mu.hook_add(UC_HOOK_MEM_WRITE | UC_HOOK_MEM_READ,
-                    hook_mem_access, user_data=user_data)
+        if trace_memory:
+            user_data = (address_written, address_read, arch)
+            mu.hook_add(UC_HOOK_MEM_WRITE | UC_HOOK_MEM_READ,
+                        hook_mem_access, user_data=user_data)
         # emulate machine code in infinite time
         mu.emu_start(ADDRESS, ADDRESS + (g.address_end - g.address), timeout=2*UC_SECOND_SCALE)
 
         final_values = {}
-        for r in Arch.regs:
-            final_values[r] = mu.reg_read(Arch.regs[r])
-        final_flags = mu.reg_read(Arch.FLAGS_REG)
+        for r in arch.regs:
+            final_values[r] = mu.reg_read(arch.regs[r])
+        final_flags = mu.reg_read(arch.FLAGS_REG)
         Uc.release_handle(mu)
         return (rv_pairs, final_values, rand_stack, sp_init, address_written, address_read, flags_init, final_flags)
 
     except UcError as e:
-        logging.warning("Managed error: %s - at code %s" , e, g.hex.hex())
+        Metrics.count('collect', 'emulation_errors', str(e))
+        logging.debug("Managed error: %s - at code %s" , e, g.hex.hex())
 
         return (rv_pairs, None, rand_stack, sp_init, address_written, address_read, None, None)
     
 
-def do_analysis(g):
-    ###
-    #print (g)
-    #for i in Arch.md.disasm(g.hex, g.address):
-    #    print("0x%x:\t%s\t%s" % (i.address, i.mnemonic, i.op_str))
-    ###
-
-    #init Arch for multiprocessing
-    Arch.init(g.arch)
-
-    typed_gadgets = []
-
-    (rv_pairs, final_values, rand_stack, sp_init,
-        address_written, address_read, flags_init, final_flags) = emulate(g)
-
-    #emulate two times for memory operations
-    (rv_pairs2, final_values2, rand_stack2, sp_init2,
-        address_written2, address_read2, flags_init2, final_flags2) = emulate(g)
-
-    if final_values is None or final_values2 is None:
-        return []
+def set_effects(arch, g, rv_pairs, final_values, sp_init):
+    """
+    Sets the registers modified by g and its stack fix, from the initial and final values of an emulation
+    """
     #check modified regs
     modified_regs = set()
-    for r in Arch.regs_no_sp:
+    for r in arch.regs_no_sp:
         if rv_pairs[r] != final_values[r]:
             modified_regs.add(r)
     # must be hashable
@@ -433,78 +498,119 @@ def do_analysis(g):
     #print (g.modified_regs)
     #TODO: xchg    eax, esp
     # ret not executed in unicorn
-    g.stack_fix = final_values[Arch.Registers_sp] - \
-        sp_init + (Arch.ARCH_BITS // 8) + g.retn
+    g.stack_fix = final_values[arch.Registers_sp] - \
+        sp_init + (arch.ARCH_BITS // 8) + g.retn
+
+
+def do_analysis(g):
+    ###
+    #print (g)
+    #for i in arch.md.disasm(g.hex, g.address):
+    #    print("0x%x:\t%s\t%s" % (i.address, i.mnemonic, i.op_str))
+    ###
+
+    arch = Arch.get(g.arch)
+
+    typed_gadgets = []
+    # gadgets only accessing registers and the initialized stack cells need neither the second emulation
+    # nor the memory tracing, and cannot be memory or stack pointer gadgets
+    register_only = g.static is not None and not g.static.touches_memory
+    if register_only:
+        Metrics.count('collect', 'register_only')
+
+    with Profiler.stage('emulate'), Metrics.Latency('collect', 'emulate'):
+        (rv_pairs, final_values, rand_stack, sp_init,
+            address_written, address_read, flags_init, final_flags) = emulate(g, arch, trace_memory=not register_only)
+
+        #emulate two times for memory operations
+        if not register_only:
+            (rv_pairs2, final_values2, rand_stack2, sp_init2,
+                address_written2, address_read2, flags_init2, final_flags2) = emulate(g, arch)
+
+    if final_values is None or (not register_only and final_values2 is None):
+        Metrics.count('collect', 'discarded', 'emulation_error')
+        return []
+    set_effects(arch, g, rv_pairs, final_values, sp_init)
     #also adjust stack fix as side effect
-    typed_gadgets += checkStackPtrOpGadget(
-        rv_pairs, final_values, rv_pairs2, final_values2, g)
+    if not register_only:
+        typed_gadgets += checkStackPtrOpGadget(arch,
+            rv_pairs, final_values, rv_pairs2, final_values2, g)
     if g.stack_fix < 4 or g.stack_fix > 0x1000:
+        Metrics.count('collect', 'discarded', 'wrong_stack_fix')
         return []
 
     # if other (syscall) gadget don't perform type analysis
     if type(g) is Other_Gadget:
+        Metrics.count('collect', 'candidates', 'Other_Gadget')
         return [g]
 
-    typed_gadgets += checkLoadConstGadget(
-        rv_pairs, rand_stack, final_values, g)
-    typed_gadgets += checkClearRegGadget(
-        rv_pairs, rand_stack, final_values, g)
-    typed_gadgets += checkUnOpGadget(
-        rv_pairs, rand_stack, final_values, g)
-    typed_gadgets += checkMovRegGadget(
-        rv_pairs, rand_stack, final_values, g)
-    typed_gadgets += checkBinOpGadget(
-        rv_pairs, rand_stack, final_values, g)
-    typed_gadgets += checkLahfGadget(
-        flags_init, final_flags, final_values, g)
-    typed_gadgets += checkReadMemGadget(
-        rv_pairs, final_values, address_read, rv_pairs2, final_values2, address_read2, g)
-    typed_gadgets += checkWriteMemGadget(
-        rv_pairs, address_written, rv_pairs2, address_written2, g)
-    typed_gadgets += checkReadMemOpGadget(
-        rv_pairs, final_values, address_read, rv_pairs2, final_values2, address_read2, g)
-    typed_gadgets += checkWriteMemOpGadget(
-        rv_pairs, address_read, address_written, rv_pairs2, address_read2, address_written2, g)
+    with Profiler.stage('checks'):
+        typed_gadgets += checkLoadConstGadget(arch,
+            rv_pairs, rand_stack, final_values, g)
+        typed_gadgets += checkClearRegGadget(arch,
+            rv_pairs, rand_stack, final_values, g)
+        typed_gadgets += checkUnOpGadget(arch,
+            rv_pairs, rand_stack, final_values, g)
+        typed_gadgets += checkMovRegGadget(arch,
+            rv_pairs, rand_stack, final_values, g)
+        typed_gadgets += checkBinOpGadget(arch,
+            rv_pairs, rand_stack, final_values, g)
+        if g.static is None or Arch.FlagsType.flags in g.static.read:
+            typed_gadgets += checkLahfGadget(arch,
+                flags_init, final_flags, final_values, g)
+        if not register_only:
+            typed_gadgets += checkReadMemGadget(arch,
+                rv_pairs, final_values, address_read, rv_pairs2, final_values2, address_read2, g)
+            typed_gadgets += checkWriteMemGadget(arch,
+                rv_pairs, address_written, rv_pairs2, address_written2, g)
+            typed_gadgets += checkReadMemOpGadget(arch,
+                rv_pairs, final_values, address_read, rv_pairs2, final_values2, address_read2, g)
+            typed_gadgets += checkWriteMemOpGadget(arch,
+                rv_pairs, address_read, address_written, rv_pairs2, address_read2, address_written2, g)
+    if not typed_gadgets:
+        Metrics.count('collect', 'discarded', 'not_classified')
+    for t in typed_gadgets:
+        Metrics.count('collect', 'candidates', type(t).__name__)
     return typed_gadgets
 
+def analyze_address(g):
+    return (g.address, do_analysis(g))
+
 class GadgetsCollector(object):
-    def __init__(self, filename):
+    def __init__(self, filename, info=None, inst_count=INST_COUNT):
         self._filename =  filename
+        self.inst_count = inst_count
+        # BinaryInfo of the binary, parsed by collect() if not given
+        self.info = info
+        self.arch = None
+        self.metrics = None
 
-    def collect(self, do_filter_unsafe=True):
+    def collect(self):
         print ('Collecting...')
         logging.info("Starting Collection phase")
+        if self.info is None:
+            self.info = BinaryInfo.parse(self._filename)
+        self.arch = Arch.get(self.info.arch)
         options = {'color': False,     # if gadgets are printed, use colored output: default: False
                    'badbytes': '',   # bad bytes which should not be in addresses or ropchains; default: ''
                    'all': False,      # Show all gadgets, this means to not remove double gadgets; default: False
-                   'inst_count': 6,   # Number of instructions in a gadget; default: 6
+                   'inst_count': self.inst_count,   # Number of instructions in a gadget; default: 6
                    'type': 'rop',     # rop, jop, sys, all; default: all
                    'detailed': True}  # if gadgets are printed, use detailed output; default: False
-        rs = RopperService(options)
-        rs.addFile(self._filename)
-        rs.loadGadgetsFor(name=self._filename)
-        ropper_gadgets = rs.getFileFor(name=self._filename).gadgets
-        # set architecture!!
-        Arch.init(str(rs.getFileFor(name=self._filename).arch))
+        with Profiler.stage('ropper'):
+            rs = RopperService(options)
+            rs.addFile(self._filename)
+            rs.loadGadgetsFor(name=self._filename)
+            ropper_gadgets = rs.getFileFor(name=self._filename).gadgets
+        Metrics.count('collect', 'gadgets', 'ropper', n=len(ropper_gadgets))
         gadgets = []
         for g in ropper_gadgets:
             address = g._lines[0][0] + g.imageBase
             address_end = g._lines[-1][0] + g.imageBase
-            hex_bytes = g._bytes
-            #check ret type
-            ret = next(Arch.md.disasm(hex_bytes[address_end - address:], 0x0, count = 1))
-            if ret.id != X86_INS_RET:
-                continue
-            if ret.operands:
-                retn = ret.operands[0].value.imm
-            else:
-                retn = 0
-            if retn < MAX_RETN:
-                gadgets.append(Gadget(hex_bytes, address = address, address_end = address_end, retn=retn, arch=Arch.ARCH_BITS))
-        if do_filter_unsafe:
-            return filter_unsafe(gadgets)
-        else:
-            return gadgets
+            # the ret and the retn are checked by filter_unsafe
+            gadgets.append(Gadget(g._bytes, address=address, address_end=address_end, retn=0, arch=self.arch.ARCH_BITS))
+        with Profiler.stage('filter_unsafe'):
+            return filter_unsafe(gadgets, self.arch)
 
     #Unused
     def sys_collect(self, do_filter_unsafe=True):
@@ -528,34 +634,53 @@ class GadgetsCollector(object):
             hex_bytes = g._bytes
 
             _g = Gadget(hex_bytes, address=address,
-                        address_end=address_end, retn=0, modified_regs=[], arch=Arch.ARCH_BITS)
+                        address_end=address_end, retn=0, modified_regs=[], arch=self.arch.ARCH_BITS)
             gadgets.append(Other_Gadget(_g))
         if do_filter_unsafe:
-            return sys_filter_unsafe(gadgets)
+            return sys_filter_unsafe(gadgets, self.arch)
         else:
             return gadgets
     
-    def analyze(self):
-        safe_gadgets = self.collect(do_filter_unsafe=True)
+    def analyze(self, journal=None):
+        """
+        Emulates and classifies the safe gadgets. If journal is given, the gadgets it records as done are skipped,
+        and the results of the others are recorded in it
+        """
+        Metrics.reset('collect')
+        safe_gadgets = self.collect()
+        typed_gadgets = []
+        if journal is not None and journal.done:
+            safe_gadgets = [g for g in safe_gadgets if g.address not in journal.done]
+            typed_gadgets += journal.gadgets
+            print ('Resuming: %d gadgets already analyzed' % len(journal.done))
+        Metrics.count('collect', 'gadgets', 'emulated', n=len(safe_gadgets))
 
         print ('Analyzing...')
         logging.info("Starting Analysis phase")
-        typed_gadgets = []
 
         # tqdm: progressbar wrapper
         
-        pool = Pool()
+        pool = Profiler.Pool()
         
         # for g in tqdm(safe_gadgets):
         #     typed_gadgets.append(do_analysis(g))
         
-        for res in tqdm(pool.imap_unordered(do_analysis, safe_gadgets), total=len(safe_gadgets)):
-            typed_gadgets += res
+        try:
+            for (address, res) in tqdm(Metrics.imap_unordered(pool, analyze_address, safe_gadgets), total=len(safe_gadgets)):
+                typed_gadgets += res
+                if journal is not None:
+                    journal.add(address, res)
+        finally:
+            # checkpoint the completed gadgets, even if interrupted
+            if journal is not None:
+                journal.flush()
         pool.close()
         pool.join()
         
         print ('Found %d different typed gadgets' % len(typed_gadgets))
         logging.info('Found %d different typed gadgets', len(typed_gadgets))
+        self.metrics = Metrics.summary('collect')
+        logging.info('Collection metrics: %s', json.dumps(self.metrics, sort_keys=True))
         return typed_gadgets
         
    
@@ -14,10 +14,13 @@ from .Gadget import Gadget, Operations, Types
 from .Gadget import *
 from .RopChainKernel import RopChainKernel
 from .RopChain import RopChain
+from .RopChainOptimizer import RopChainOptimizer
+from .RopChainValidator import RopChainValidator
 from .GadgetBox import GadgetBox
+from .GadgetStore import count_types, print_stats
+from .BinaryInfo import load_info
 from . import Arch
 import networkx as nx
-import lief
 import sys
 import logging
 
@@ -51,6 +54,10 @@ def select_best(gadget_list):
         return best
 
 
+def kernel_size(kernel):
+        return sum(box.gadget.stack_fix for box in kernel.gadget_boxes)
+
+
 def gadget_quality(g):
         return ('unknown' in g.mem[0],
                 len(g.mem[0]), len(g.modified_regs), g.stack_fix, (g.address_end - g.address))
@@ -58,79 +65,109 @@ def gadget_quality(g):
 
 
 class GadgetsCombiner(object):
-    def __init__(self, filename, gadgets):
+    # gadget types used to build chains
+    CHAIN_GADGET_TYPES = (LoadConst_Gadget, WriteMem_Gadget, WriteMemOp_Gadget, Other_Gadget)
+
+    def __init__(self, filename, gadgets, info=None):
         self.filename =  filename
         self.gadgets = gadgets
+        # BinaryInfo of the binary, loaded from its sidecar if not given
+        self.info = info
         self.all_load_gadgets = []
         self.best_load_gadgets = []
         self.indipendent_load_gadgets = []
         self.load_kernels = {}
+        self.grouped_load_gadgets = {}
+        self.multi_load_kernels = []
         self.write_kernel = RopChainKernel([])
         self.writable_interval =(None, None)
         self.kernels = []
         self.chain = None
         self.bin_sh_address = None
         self.writable_address = None
+        self.memory_values = {}
+        self.validator = None
+        self.final_gadget = None
+        # kept between chains
+        self.optimizer = None
+        self._validator = None
         
         # assuming all gadget of the same type
-        if len(self.gadgets):
-            Arch.init(self.gadgets[0].arch)
+        self.arch = Arch.get(self.gadgets[0].arch) if len(self.gadgets) else None
 
-    def execve(self):
-        self.find_writable_interval()
+    def reset(self):
+        """
+        Clears the state of the previous chain, keeping the analysis of the binary and of its gadgets
+        """
+        self.load_kernels = {}
+        self.multi_load_kernels = []
+        self.write_kernel = RopChainKernel([])
+        self.kernels = []
+        self.chain = None
+        self.memory_values = {}
+        self.validator = None
+
+    def execve(self, validate=False, max_bytes=None):
+        """
+        Computes a chain performing an execve("/bin/sh") syscall, returns it and keeps it in self.chain.
+        The combiner can be reused to compute other chains
+        """
+        self.reset()
+        if self.info is None:
+            self.info = load_info(self.filename)
+        if self.arch is None:
+            self.arch = Arch.get(self.info.arch)
+        if validate:
+            if self._validator is None:
+                self._validator = RopChainValidator(self.filename, self.arch, self.info)
+            self.validator = self._validator
+        if self.writable_interval == (None, None):
+            self.find_writable_interval()
         self.setup_execve()
 
-        self.find_load_gadgets()
+        if not self.all_load_gadgets:
+            self.find_load_gadgets()
         self.compute_load_kernels()
+        self.compute_multi_load_kernels()
         # in unable to set some registers
-        if set(self.register_values.keys()) - set([reg.name for reg in self.load_kernels]):
+        if set(self.register_values.keys()) - set([reg.name for reg in self.load_kernels]) - \
+                set([reg.name for kernel in self.multi_load_kernels for reg in kernel.dests()]):
             print ('requested:', self.register_values.keys())
             raise Exception('Unable to set requested registers')
 
-        self.compute_write_kernels(0x68732f6e69622f, self.bin_sh_address)
+        self.compute_write_kernels(b'/bin/sh\x00', self.bin_sh_address)
 
-        syscall_gadget = (sorted(filter(lambda g: isinstance(g, Other_Gadget),  self.gadgets), key=gadget_quality) + [None])[0]
+        self.final_gadget = (sorted(filter(lambda g: isinstance(g, Other_Gadget),  self.gadgets), key=gadget_quality) + [None])[0]
 
-        self.compute_chain()
+        self.compute_chain(max_bytes)
 
         if self.chain:
-            self.chain.add(syscall_gadget)
-            print (self.chain.dump())
-
+            self.chain.add(self.final_gadget)
+        return self.chain
 
-    def stats(self):
-        total = 0
-        subtotals = {}
-        # TODO: define gadget load analysis
-        for g in self.gadgets:
-            t = type(g)
-            if t not in subtotals: subtotals[t] = 0
-            total += 1
-            subtotals[t] += 1
 
-        print ("Found %d different gadgets" % total)
-        for t in subtotals:
-            print ('*', t.__name__, "%.2f" % (subtotals[t]/float(total) * 100) + '%')
+    def stats(self, subtotals=None):
+        """
+        Prints the percentage of gadgets of each type. subtotals ({type: count}) can be given when already known
+        """
+        print_stats(subtotals if subtotals is not None else count_types(self.gadgets))
 
     def setup_execve(self):
         self.bin_sh_address = self.writable_interval[1] - 8
 
-        if Arch.ARCH_BITS == Arch.ARCH_64:
+        if self.arch.ARCH_BITS == Arch.ARCH_64:
             self.register_values = {'rax': 0x3b, 'rdi': self.bin_sh_address, 'rsi': 0x0, 'rdx': 0x0}
         else:
-            assert(Arch.ARCH_BITS == Arch.ARCH_32)
+            assert(self.arch.ARCH_BITS == Arch.ARCH_32)
             self.register_values = {'eax': 0xb, 'ebx': self.bin_sh_address, 'ecx': 0x0, 'edx': 0x0}
 
 
     def find_writable_interval(self):
-        binary = lief.parse(self.filename)
         max_size = 0
-        for segment in binary.segments:
-            if segment.virtual_address and segment.has(lief.ELF.SEGMENT_FLAGS.R) and segment.has(lief.ELF.SEGMENT_FLAGS.W):
-                if segment.virtual_size > max_size:
-                    max_size = segment.virtual_size
-                    self.writable_interval = (
-                        segment.virtual_address, segment.virtual_address + segment.virtual_size)
+        for (start, end) in self.info.writable_intervals:
+            if end - start > max_size:
+                max_size = end - start
+                self.writable_interval = (start, end)
         if self.writable_interval == (None, None):
             raise Exception('Writable Address not found')
 
@@ -152,7 +189,7 @@ class GadgetsCombiner(object):
             kernels[reg] = RopChainKernel([GadgetBox(self.indipendent_load_gadgets[reg], value=self.register_values.get(reg.name, None))])
         
         missing_regs = [
-            reg for reg in Arch.Registers if reg not in kernels.keys()]
+            reg for reg in self.arch.Registers if reg not in kernels.keys()]
 
         found_one = True
         while found_one:
@@ -176,7 +213,7 @@ class GadgetsCombiner(object):
 
 
             missing_regs = [
-                reg for reg in Arch.Registers if reg not in kernels.keys()]
+                reg for reg in self.arch.Registers if reg not in kernels.keys()]
 
         self.kernels += [kernels[reg]
                          for reg in kernels if reg.name in self.register_values]
@@ -185,73 +222,243 @@ class GadgetsCombiner(object):
 
         print ('[+] found best guesses for:', [reg.name for reg in self.load_kernels])
 
-    def compute_write_kernels(self, what, where):
-        best_write_gadget = (sorted(filter(lambda g: isinstance(g, WriteMem_Gadget) and set([g.addr_reg, g.src]).issubset(
-            set(self.load_kernels.keys())),
-            self.gadgets), key=gadget_quality) + [None])[0]
-
-        assert(isinstance(what, int))
-        assert(where < Arch.MAX_INT)
-        if (what > Arch.MAX_INT):
-            to_write = [(what & Arch.MAX_INT, where), (what >> Arch.ARCH_BITS, where + (Arch.ARCH_BITS // 8))]
-        else:
-            to_write = [(what, where)]
-
-        for what, where in to_write:
-            if best_write_gadget:
-                if len(best_write_gadget.mem[0]) == 1:
-                    k1 = self.load_kernels[best_write_gadget.addr_reg].copy()
-                    k1.gadget_boxes[-1].value = (where -
-                                                k1.gadget_boxes[-1].gadget.offset) & Arch.MAX_INT
-
-                    k2 = self.load_kernels[best_write_gadget.src].copy()
-                    # hex(pwn.u64('/bin/sh\x00'))
-                    k2.gadget_boxes[-1].value = what
-
-                    k = RopChainKernel([GadgetBox(
-                        best_write_gadget, value=None)])
-
-                    chain = RopChain([k1,k2,k])
-                    
-                    tmp_values = {best_write_gadget.addr_reg.name: where,
-                                best_write_gadget.src.name: what}
-                    
-                    if all(value != tmp_values[reg] for (reg, value) in chain.evaluate().items() if reg in tmp_values):
-                        chain = RopChain([k2, k1, k])
-                    
-                    # re-evaluate with new chain
-                    if all(value != tmp_values[reg] for (reg, value) in chain.evaluate().items() if reg in tmp_values):
-                        print ('[-] Unable to find write memory gadget, setting registers anyway')
-                        return
-
-                    # update write_kernel
-                    self.write_kernel = RopChainKernel(self.write_kernel.gadget_boxes + chain.gadget_boxes)
-                else:
-                    print ('[-] [TODO] Unable to find a simple write memory gadget, setting registers anyway')
-                    return
+    def find_write_gadgets(self, zeroed=False):
+        """
+        Groups the usable memory write gadgets by (addr_reg, src) pair, keeping the best gadget for each offset.
+        If the destination memory is known to be zeroed, [addr_reg + offset] OP= src gadgets behave as plain writes for ADD, XOR and OR
+        """
+        write_gadgets = {}
+        for g in sorted(self.gadgets, key=gadget_quality):
+            if isinstance(g, WriteMem_Gadget):
+                pass
+            elif zeroed and isinstance(g, WriteMemOp_Gadget) and g.op in (Operations.ADD, Operations.XOR, Operations.OR):
+                pass
             else:
-                print ('[-] Unable to find write memory gadget, setting registers anyway')
-                return
+                continue
+            if g.addr_reg == g.src or len(g.mem[0]) != 1:
+                continue
+            if not set([g.addr_reg, g.src]).issubset(set(self.load_kernels.keys())):
+                continue
+            offsets = write_gadgets.setdefault((g.addr_reg, g.src), {})
+            # sorted by quality: keep the first one
+            if g.offset not in offsets:
+                offsets[g.offset] = g
+        return write_gadgets
+
+    def plan_write(self, words, addr_reg, src, offsets):
+        """
+        Plans the writes of the (address, value) words using the given register pair, reusing the address register
+        across consecutive words reachable through the available offsets and the source register across equal values
+        """
+        addr_kernel = self.load_kernels[addr_reg]
+        src_kernel = self.load_kernels[src]
+
+        def best_base(i):
+            best = None
+            best_run = 0
+            for offset in offsets:
+                base = (words[i][0] - offset) & self.arch.MAX_INT
+                run = 0
+                for j in range(i, len(words)):
+                    if (words[j][0] - base) & self.arch.MAX_INT not in offsets:
+                        break
+                    run += 1
+                if run > best_run or (run == best_run and offsets[offset].stack_fix < offsets[(words[i][0] - best) & self.arch.MAX_INT].stack_fix):
+                    best = base
+                    best_run = run
+            return best
+
+        boxes = []
+        # values currently held by the address and source registers, None if unknown
+        base = None
+        value = None
+        for i, (address, what) in enumerate(words):
+            need_addr = base is None or (address - base) & self.arch.MAX_INT not in offsets
+            need_src = value != what
+            if need_src and addr_reg in src_kernel.modified_regs:
+                need_addr = True
+            if need_addr and src in addr_kernel.modified_regs:
+                need_src = True
+
+            if need_addr:
+                base = best_base(i)
+                k_addr = addr_kernel.copy()
+                k_addr.gadget_boxes[-1].value = base
+            if need_src:
+                value = what
+                k_src = src_kernel.copy()
+                k_src.gadget_boxes[-1].value = what
+
+            if need_addr and need_src:
+                if addr_reg in src_kernel.modified_regs:
+                    if src in addr_kernel.modified_regs:
+                        return None
+                    boxes += k_src.gadget_boxes + k_addr.gadget_boxes
+                else:
+                    boxes += k_addr.gadget_boxes + k_src.gadget_boxes
+            elif need_addr:
+                boxes += k_addr.gadget_boxes
+            elif need_src:
+                boxes += k_src.gadget_boxes
+
+            write_gadget = offsets[(address - base) & self.arch.MAX_INT]
+            boxes.append(GadgetBox(write_gadget, value=None))
+            if addr_reg in write_gadget.modified_regs:
+                base = None
+            if src in write_gadget.modified_regs:
+                value = None
+        return RopChainKernel(boxes)
+
+    def compute_write_buffer(self, data, where, zeroed=False):
+        """
+        Computes the shortest kernel writing the data buffer at where, word by word.
+        If zeroed, the destination memory is assumed to be already zero filled, and zero words are skipped
+        """
+        word_size = self.arch.ARCH_BITS // 8
+        data = bytes(data) + b'\x00' * (-len(data) % word_size)
+        words = [((where + i) & self.arch.MAX_INT, unpack('<' + self.arch.PACK_VALUE, data[i:i + word_size])[0])
+                 for i in range(0, len(data), word_size)]
+        if zeroed:
+            words = [(address, what) for (address, what) in words if what != 0]
+        if not words:
+            return RopChainKernel([])
 
+        best = None
+        for (addr_reg, src), offsets in self.find_write_gadgets(zeroed).items():
+            kernel = self.plan_write(words, addr_reg, src, offsets)
+            if kernel is None:
+                continue
+            size = sum(box.gadget.stack_fix for box in kernel.gadget_boxes)
+            if best is None or size < best[0]:
+                best = (size, kernel)
+        if best is None:
+            return None
+        return best[1]
+
+    def compute_write_kernels(self, what, where, zeroed=False):
+        """
+        Adds to the write kernel the gadgets to write what at where.
+        what may be an integer, written as the minimum number of words, or a bytes-like buffer of any length
+        """
+        if isinstance(what, int):
+            word_size = self.arch.ARCH_BITS // 8
+            size = max(1, (what.bit_length() + 7) // 8)
+            what = what.to_bytes(size + (-size % word_size), 'little')
+        assert(where < self.arch.MAX_INT)
+
+        kernel = self.compute_write_buffer(what, where, zeroed)
+        if kernel is None:
+            print ('[-] Unable to find write memory gadget, setting registers anyway')
+            return
+
+        # update write_kernel
+        self.write_kernel = RopChainKernel(self.write_kernel.gadget_boxes + kernel.gadget_boxes)
+        self.memory_values[where] = bytes(what)
         self.kernels.append(self.write_kernel)
 
-    def compute_chain(self):
-        print ('[+] computing sequence')
-        kernels_list = [kernel for (
-            reg, kernel) in self.load_kernels.items() if reg.name in self.register_values]
-        
+    def order_kernels(self, kernels_list):
+        """
+        Orders the kernels so that no kernel clobbers a requested register set by a following one. Returns None if impossible
+        """
+        requested_dests = [set([reg for reg in kernel.dests() if reg.name in self.register_values]) for kernel in kernels_list]
+
+        # a kernel must precede the kernels setting the registers it clobbers
         kernel_graph = nx.DiGraph()
-        kernel_graph.add_nodes_from([kernel.dest() for kernel in kernels_list])
-        for kernel in kernels_list:
-            kernel_graph.add_edges_from([(kernel.dest(), mod_reg) for mod_reg in kernel.modified_regs if kernel.dest() != mod_reg])
+        kernel_graph.add_nodes_from(range(len(kernels_list)))
+        for (i, kernel) in enumerate(kernels_list):
+            kernel_graph.add_edges_from([(i, j) for j in range(len(kernels_list)) if i != j and kernel.modified_regs & requested_dests[j]])
         try:
-            registers_order = list(nx.topological_sort(kernel_graph))
-            kernels_list = [self.load_kernels[reg] for reg in registers_order]
+            return [kernels_list[i] for i in nx.topological_sort(kernel_graph)]
         except nx.exception.NetworkXUnfeasible:
+            return None
+
+    def candidate_load_kernels(self, reg):
+        """
+        Computes the kernels loading the requested value in reg, discarding the ones dominated by a shorter kernel clobbering less registers
+        """
+        value = self.register_values.get(reg.name, None)
+        kernels = []
+        for g in self.all_load_gadgets[reg]:
+            if len(g.mem[0]) == 0:
+                kernels.append(RopChainKernel([GadgetBox(g, value=value)]))
+            elif len(g.mem[0]) == 1 and list(g.mem[0])[0] in self.load_kernels and list(g.mem[0])[0] is not reg:
+                k = self.load_kernels[list(g.mem[0])[0]].copy()
+                k.gadget_boxes[-1].value = self.writable_address
+                k.add(g, value=value)
+                kernels.append(k)
+
+        candidates = []
+        for k in sorted(kernels, key=kernel_size):
+            if not any(kernel_size(c) <= kernel_size(k) and c.modified_regs <= k.modified_regs for c in candidates):
+                candidates.append(k)
+        return candidates
+
+    def search_kernels(self, max_bytes=None):
+        """
+        Branch and bound search of the kernels setting all the requested registers with the smallest chain.
+        Partial chains whose gadgets exceed max_bytes, or the best chain found so far, are pruned.
+        Returns the ordered kernels, or None if no chain fits in max_bytes
+        """
+        requested = [reg for reg in self.arch.Registers if reg.name in self.register_values]
+        candidates = {reg: [(k, set([reg])) for k in self.candidate_load_kernels(reg)] for reg in requested}
+        for kernel in self.multi_load_kernels:
+            regs = set([reg for reg in kernel.dests() if reg.name in self.register_values])
+            for reg in regs:
+                candidates[reg].append((kernel, regs))
+        for reg in requested:
+            candidates[reg].sort(key=lambda c: kernel_size(c[0]))
+
+        # boxes loading the address of a dereference may be shared between kernels and simplified:
+        # only the last gadget of each kernel is surely part of the chain
+        def essential_size(kernel):
+            return kernel.gadget_boxes[-1].gadget.stack_fix
+        min_size = {reg: min([essential_size(k) / float(len(regs)) for (k, regs) in candidates[reg]] + [float('inf')]) for reg in requested}
+        fixed_size = (self.final_gadget.stack_fix if self.final_gadget is not None else 0) + \
+            sum(box.gadget.stack_fix for box in self.write_kernel.gadget_boxes if not box.set_registers())
+        final_size = self.final_gadget.stack_fix if self.final_gadget is not None else 0
+
+        best = {'size': max_bytes + 1 if max_bytes is not None else float('inf'), 'kernels': None}
+        # visit the registers with fewer alternatives first
+        order = sorted(requested, key=lambda reg: len(candidates[reg]))
+
+        def visit(covered, chosen, size):
+            remaining = [reg for reg in order if reg not in covered]
+            if fixed_size + size + sum(min_size[reg] for reg in remaining) >= best['size']:
+                return
+            if not remaining:
+                kernels_list = self.order_kernels(chosen)
+                if kernels_list is None:
+                    return
+                chain = RopChain([self.write_kernel] + kernels_list, arch=self.arch)
+                chain.simplify()
+                values = chain.evaluate()
+                if chain.size() + final_size < best['size'] and \
+                        all(values[reg] == value for (reg, value) in self.register_values.items()):
+                    best['size'] = chain.size() + final_size
+                    best['kernels'] = kernels_list
+                return
+            for (kernel, regs) in candidates[remaining[0]]:
+                if covered.isdisjoint(regs):
+                    visit(covered | regs, chosen + [kernel], size + essential_size(kernel))
+
+        visit(frozenset(), [], 0)
+        return best['kernels']
+
+    def compute_chain(self, max_bytes=None):
+        print ('[+] computing sequence')
+        kernels_list = self.search_kernels(max_bytes)
+        if kernels_list is None:
+            if max_bytes is not None:
+                raise Exception('No chain fits in %d bytes with the verified gadgets' % max_bytes)
             raise Exception('Unable to combine found gadgets')
 
-        chain = RopChain([self.write_kernel]+kernels_list)
-        chain.simplify()
+        if self.optimizer is None:
+            self.optimizer = RopChainOptimizer(self.gadgets, None, self.arch)
+        self.optimizer.validator = self.validator
+        (chain, saved) = self.optimizer.optimize(
+            [self.write_kernel]+kernels_list, self.register_values, self.memory_values)
+        if saved:
+            print ('[+] optimized chain: saved %d bytes' % saved)
 
         bad = False
         _register_values = chain.evaluate()
@@ -260,12 +467,15 @@ class GadgetsCombiner(object):
                 bad = True
         if bad:
             raise Exception('AAAAAAAAAAAAAH! The generated chain does not correctly set registers')
+        if self.validator is not None and not self.validator.validate(chain, self.register_values, self.memory_values):
+            raise Exception('The generated chain does not pass the emulation check')
+        print ('[+] chain size: %d bytes' % (chain.size() + (self.final_gadget.stack_fix if self.final_gadget is not None else 0)))
         self.chain = chain
         return
 
     def find_load_gadgets(self):
 
-        all_load_gadgets = {reg: sorted(filter(lambda x: isinstance(x, LoadConst_Gadget) and x.dest is reg, self.gadgets), key=gadget_quality ) for reg in Arch.Registers}
+        all_load_gadgets = {reg: sorted(filter(lambda x: isinstance(x, LoadConst_Gadget) and x.dest is reg, self.gadgets), key=gadget_quality ) for reg in self.arch.Registers}
         best_load_gadgets = {reg : (all_load_gadgets[reg]+[None])[0] for reg in all_load_gadgets}
     
         indipendent_regs = {}
@@ -273,11 +483,46 @@ class GadgetsCombiner(object):
             if g is not None and len(g.modified_regs) == 1 and len(g.mem[0]) == 0:
                 indipendent_regs[r] = g
 
+        # LoadConst gadgets sharing the same address load multiple registers with a single gadget
+        grouped_load_gadgets = {}
+        for g in self.gadgets:
+            if isinstance(g, LoadConst_Gadget) and len(g.mem[0]) == 0:
+                grouped_load_gadgets.setdefault(g.address, {}).setdefault(g.dest, g)
+
         self.all_load_gadgets = all_load_gadgets
         self.best_load_gadgets = best_load_gadgets
         self.indipendent_load_gadgets = indipendent_regs
+        self.grouped_load_gadgets = {address: group for (address, group) in grouped_load_gadgets.items() if len(group) > 1}
 
-
-
-
-
+    def multi_load_kernel(self, group):
+        """
+        Builds a kernel setting all the requested registers loaded by the group of LoadConst gadgets with a single gadget,
+        giving each stack slot its own value. Returns None if the group loads less than two requested registers
+        """
+        requested = [reg for reg in group if reg.name in self.register_values]
+        if len(requested) < 2:
+            return None
+        slots = {}
+        for reg in requested:
+            value = self.register_values[reg.name]
+            if slots.get(group[reg].offset, value) != value:
+                # the same stack slot should load different values
+                return None
+            slots[group[reg].offset] = value
+        main = group[requested[0]]
+        loads = [(g, slots.get(g.offset)) for (reg, g) in group.items() if g is not main]
+        return RopChainKernel([GadgetBox(main, value=slots[main.offset], loads=loads)])
+
+    def compute_multi_load_kernels(self):
+        """
+        Computes the kernels loading multiple requested registers with a single gadget
+        """
+        multi_load_kernels = []
+        for group in self.grouped_load_gadgets.values():
+            kernel = self.multi_load_kernel(group)
+            if kernel is not None:
+                multi_load_kernels.append(kernel)
+        self.multi_load_kernels = multi_load_kernels
+
+        if multi_load_kernels:
+            print ('[+] found multiple load gadgets for:', [[reg.name for reg in kernel.dests() if reg.name in self.register_values] for kernel in multi_load_kernels])
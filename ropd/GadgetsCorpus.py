@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+from collections import OrderedDict
+from tqdm import *
+import json
+import os
+import time
+from .GadgetsCollector import GadgetsCollector, do_analysis
+from .GadgetsVerifier import load_project, make_symbolic_state, _set_global_project, do_verify, group_by_address
+from . import Profiler
+from . import Metrics
+from .BinaryInfo import META_EXTENSION
+from .GadgetStore import save_gadgets, COLLECTED_EXTENSION, VERIFIED_EXTENSION, GADGET_TYPES
+import logging
+
+SUMMARY_FILE = 'ropd-corpus.json'
+ELF_MAGIC = b'\x7fELF'
+# angr projects kept loaded by each verifier worker
+MAX_WORKER_PROJECTS = 2
+
+_worker_projects = OrderedDict()
+_worker_binary = None
+
+
+def do_analysis_task(task):
+    (binary, g) = task
+    return (binary, do_analysis(g))
+
+
+def do_verify_task(task):
+    """
+    Verifies a group of gadgets of binary, loading its angr project only the first time it is seen by the worker
+    """
+    global _worker_binary
+    (binary, gad_list) = task
+    if binary not in _worker_projects:
+        if len(_worker_projects) >= MAX_WORKER_PROJECTS:
+            _worker_projects.popitem(last=False)
+        project = load_project(binary)
+        _worker_projects[binary] = (project, make_symbolic_state(project))
+    _worker_projects.move_to_end(binary)
+    if binary != _worker_binary:
+        _set_global_project(*_worker_projects[binary])
+        _worker_binary = binary
+    return do_verify(gad_list)
+
+
+def find_binaries(directory):
+    binaries = []
+    for (root, dirs, files) in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name.endswith((COLLECTED_EXTENSION, VERIFIED_EXTENSION, META_EXTENSION)) or os.path.islink(path):
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    if f.read(len(ELF_MAGIC)) == ELF_MAGIC:
+                        binaries.append(path)
+            except IOError:
+                continue
+    return binaries
+
+
+class GadgetsCorpus(object):
+    """
+    Collects and verifies the gadgets of all the binaries in a directory, with a collector and a verifier pool
+    shared by all of them. The tasks of the next binary are queued as soon as it is collected, and each binary
+    is verified as soon as its analysis is complete, while the others are still being analyzed
+    """
+    def __init__(self, directory, processes=None):
+        self.directory = directory
+        self.processes = processes
+        self.binaries = find_binaries(directory)
+        self.typed_gadgets = {}
+        self.remaining = {}
+        self.infos = {}
+        self.summary = {}
+
+    def collect_tasks(self):
+        for binary in self.binaries:
+            self.summary[binary] = {'binary': binary}
+            collector = GadgetsCollector(binary)
+            try:
+                gadgets = collector.collect()
+            except Exception as e:
+                logging.error('Collection of %s failed: %s', binary, e)
+                self.summary[binary]['error'] = str(e)
+                gadgets = []
+            self.summary[binary]['arch'] = collector.arch.ARCH_BITS if gadgets else None
+            self.infos[binary] = collector.info
+            self.typed_gadgets[binary] = []
+            self.remaining[binary] = len(gadgets)
+            for g in gadgets:
+                yield (binary, g)
+
+    def start_verification(self, binary, pool):
+        typed_gadgets = self.typed_gadgets.pop(binary)
+        save_gadgets(binary + COLLECTED_EXTENSION, typed_gadgets)
+        if self.infos.get(binary) is not None:
+            self.infos[binary].save()
+        self.summary[binary]['collected'] = len(typed_gadgets)
+        logging.info('Collected %d gadgets of %s', len(typed_gadgets), binary)
+        tasks = [(binary, gad_list) for gad_list in group_by_address(typed_gadgets).values()]
+        return pool.map_async(Metrics.Task(do_verify_task), tasks, chunksize=8)
+
+    def run(self):
+        print ('Found %d binaries in %s' % (len(self.binaries), self.directory))
+        start = time.time()
+        Metrics.reset('collect')
+        Metrics.reset('verify')
+        collector_pool = Profiler.Pool(self.processes)
+        verifier_pool = Profiler.Pool(self.processes)
+        verifications = {}
+        for (binary, res) in tqdm(Metrics.imap_unordered(collector_pool, do_analysis_task, self.collect_tasks(), chunksize=16), unit='gadgets'):
+            self.typed_gadgets[binary] += res
+            self.remaining[binary] -= 1
+            if self.remaining[binary] == 0:
+                verifications[binary] = self.start_verification(binary, verifier_pool)
+        collector_pool.close()
+        collector_pool.join()
+        # binaries without gadgets
+        for binary in self.binaries:
+            if binary not in verifications:
+                verifications[binary] = self.start_verification(binary, verifier_pool)
+
+        print ('Verifying...')
+        for binary in tqdm(self.binaries):
+            try:
+                verified_gadgets = []
+                for (res, data) in verifications[binary].get():
+                    Metrics.merge(data)
+                    verified_gadgets += res
+            except Exception as e:
+                logging.error('Verification of %s failed: %s', binary, e)
+                self.summary[binary]['error'] = str(e)
+                verified_gadgets = []
+            save_gadgets(binary + VERIFIED_EXTENSION, verified_gadgets)
+            self.summary[binary]['verified'] = len(verified_gadgets)
+            self.summary[binary]['types'] = dict((t.__name__, len([g for g in verified_gadgets if type(g) is t]))
+                                                 for t in GADGET_TYPES if any(type(g) is t for g in verified_gadgets))
+            logging.info('Verified %d gadgets of %s', len(verified_gadgets), binary)
+        verifier_pool.close()
+        verifier_pool.join()
+
+        return {'directory': self.directory,
+                'time': time.time() - start,
+                'collected': sum(s.get('collected', 0) for s in self.summary.values()),
+                'verified': sum(s.get('verified', 0) for s in self.summary.values()),
+                'metrics': {'collect': Metrics.summary('collect'), 'verify': Metrics.summary('verify')},
+                'binaries': [self.summary[binary] for binary in self.binaries]}
+
+    def save_summary(self, summary, filename=None):
+        if filename is None:
+            filename = os.path.join(self.directory, SUMMARY_FILE)
+        with open(filename, 'w') as f:
+            json.dump(summary, f, indent=2)
+        return filename
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextlib
+import io
+import json
+import os
+import signal
+import socket
+import time
+from .GadgetStore import load_gadgets, VERIFIED_EXTENSION
+from .BinaryInfo import load_info
+import logging
+
+SOCKET_FILE = 'ropd.sock'
+# memory used by the loaded binaries before evicting the least recently used ones
+MEMORY_CAP = 2 * 1024 * 1024 * 1024
+# estimated bytes per gadget of the loaded gadgets, of the combiner and of the index (measured on libc and small binaries)
+GADGET_BYTES = 1024
+COMBINER_GADGET_BYTES = 1024
+INDEX_GADGET_BYTES = 2048
+MAX_REQUEST = 1 << 20
+
+
+def resident_memory():
+    """
+    Returns the resident memory of this process in bytes, or None if unknown
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+class LoadedBinary(object):
+    """
+    Verified gadgets of a binary, with the combiner and the gadgets index built on demand from them
+    """
+    def __init__(self, binary):
+        self.binary = binary
+        self.mtime = os.path.getmtime(binary + VERIFIED_EXTENSION)
+        self.binary_stat = self.stat()
+        self.info = load_info(binary)
+        self.gadgets = load_gadgets(binary + VERIFIED_EXTENSION)
+        self.combiner = None
+        self.index = None
+        self.queries = 0
+
+    def stat(self):
+        st = os.stat(self.binary)
+        return (st.st_mtime, st.st_size)
+
+    def is_stale(self):
+        """
+        Tells if the verified gadgets or the binary changed since they were loaded.
+        The binary is hashed again only if its modification time or size changed
+        """
+        if os.path.getmtime(self.binary + VERIFIED_EXTENSION) != self.mtime:
+            return True
+        binary_stat = self.stat()
+        if binary_stat != self.binary_stat:
+            if self.info.is_stale():
+                return True
+            self.binary_stat = binary_stat
+        return False
+
+    def size(self):
+        """
+        Estimated memory of the gadgets, and of the combiner and the index if built.
+        Unlike the resident memory, it does not depend on the memory freed by previous evictions
+        """
+        size = len(self.gadgets) * GADGET_BYTES
+        if self.combiner is not None:
+            size += len(self.gadgets) * COMBINER_GADGET_BYTES
+        if self.index is not None:
+            size += len(self.gadgets) * INDEX_GADGET_BYTES
+        return size
+
+    def get_combiner(self):
+        from .GadgetsCombiner import GadgetsCombiner
+        if self.combiner is None:
+            gadgets = [g for g in self.gadgets if type(g) in GadgetsCombiner.CHAIN_GADGET_TYPES]
+            self.combiner = GadgetsCombiner(self.binary, gadgets, self.info)
+        return self.combiner
+
+    def get_index(self):
+        from .GadgetsIndex import GadgetsIndex
+        if self.index is None:
+            self.index = GadgetsIndex(':memory:')
+            self.index.add(self.binary, self.gadgets)
+        return self.index
+
+
+class GadgetsDaemon(object):
+    """
+    Keeps the gadgets of the queried binaries loaded, and answers chain and gadget queries over a unix socket.
+    Each request and response is a json object on a line:
+
+        {"op": "execve", "binary": PATH, "max_bytes": N, "validate": false}
+        {"op": "gadgets", "binary": PATH, "terms": ["type=LoadConst", "dest=rdi"], "limit": N}
+        {"op": "status"}
+        {"op": "unload", "binary": PATH}
+
+    Responses have "ok": true and the results, or "ok": false and an "error".
+    Queries are run one at a time by a worker thread, so that the binaries and their combiners are not shared
+    """
+    def __init__(self, socket_file=SOCKET_FILE, memory_cap=MEMORY_CAP):
+        self.socket_file = socket_file
+        self.memory_cap = memory_cap
+        self.binaries = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.started = time.time()
+        self.requests = 0
+
+    def load(self, binary):
+        binary = os.path.abspath(binary)
+        loaded = self.binaries.get(binary)
+        if loaded is not None and loaded.is_stale():
+            logging.info('Reloading %s', binary)
+            del self.binaries[binary]
+            loaded = None
+        if loaded is None:
+            loaded = LoadedBinary(binary)
+            self.binaries[binary] = loaded
+            logging.info('Loaded %s: %d gadgets', binary, len(loaded.gadgets))
+        self.binaries.move_to_end(binary)
+        self.evict()
+        loaded.queries += 1
+        return loaded
+
+    def evict(self):
+        """
+        Evicts the least recently used binaries while the estimated memory of the loaded ones is over the cap
+        """
+        # the last used binary is kept, even if over the cap by itself
+        while len(self.binaries) > 1 and sum(b.size() for b in self.binaries.values()) > self.memory_cap:
+            (binary, evicted) = self.binaries.popitem(last=False)
+            logging.info('Evicted %s', binary)
+
+    def execve(self, request):
+        loaded = self.load(request['binary'])
+        combiner = loaded.get_combiner()
+        self.evict()
+        log = io.StringIO()
+        # the combiner reports its progress on stdout
+        with contextlib.redirect_stdout(log):
+            chain = combiner.execve(validate=request.get('validate', False), max_bytes=request.get('max_bytes'))
+        if chain is None:
+            raise Exception('Unable to build a chain: %s' % log.getvalue().strip())
+        packed = chain.pack(request.get('image_base', 0))
+        return {'chain': packed.hex(), 'size': len(packed),
+                'script': chain.dump(), 'gadgets': [box.gadget.address for box in chain.gadget_boxes],
+                'log': log.getvalue()}
+
+    def gadgets(self, request):
+        loaded = self.load(request['binary'])
+        index = loaded.get_index()
+        self.evict()
+        rows = index.query(request.get('terms', []), limit=request.get('limit'))
+        return {'gadgets': [{'address': address, 'type': _type, 'params': params, 'disasm': disasm, 'stack_fix': stack_fix}
+                            for (binary, address, _type, params, disasm, stack_fix) in rows]}
+
+    def status(self, request):
+        return {'uptime': time.time() - self.started, 'requests': self.requests, 'memory': resident_memory(),
+                'memory_cap': self.memory_cap,
+                'binaries': [{'binary': b.binary, 'gadgets': len(b.gadgets), 'size': b.size(), 'queries': b.queries}
+                             for b in reversed(self.binaries.values())]}
+
+    def unload(self, request):
+        return {'unloaded': self.binaries.pop(os.path.abspath(request['binary']), None) is not None}
+
+    def handle_request(self, request):
+        """
+        Runs a request in the worker thread, returns its response
+        """
+        handlers = {'execve': self.execve, 'gadgets': self.gadgets, 'status': self.status, 'unload': self.unload}
+        try:
+            if request.get('op') not in handlers:
+                raise Exception('Unknown op: %s' % request.get('op'))
+            response = handlers[request['op']](request)
+            response['ok'] = True
+        except Exception as e:
+            logging.error('Request %s failed: %s', request, e)
+            response = {'ok': False, 'error': str(e)}
+        return response
+
+    async def handle_client(self, reader, writer):
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.requests += 1
+                try:
+                    request = json.loads(line.decode())
+                    if not isinstance(request, dict):
+                        raise ValueError('request is not an object')
+                except ValueError as e:
+                    response = {'ok': False, 'error': 'Invalid request: %s' % e}
+                else:
+                    response = await loop.run_in_executor(self.executor, self.handle_request, request)
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, ValueError) as e:
+            logging.warning('Client connection lost: %s', e)
+        finally:
+            writer.close()
+
+    async def serve(self):
+        if os.path.exists(self.socket_file):
+            os.remove(self.socket_file)
+        server = await asyncio.start_unix_server(self.handle_client, self.socket_file, limit=MAX_REQUEST)
+        print ('[+] serving on', self.socket_file)
+        logging.info('Serving on %s', self.socket_file)
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_event_loop().add_signal_handler(signum, stop.set)
+        async with server:
+            await stop.wait()
+        logging.info('Stopped serving on %s', self.socket_file)
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            if os.path.exists(self.socket_file):
+                os.remove(self.socket_file)
+            self.executor.shutdown()
+
+
+def request(message, socket_file=SOCKET_FILE):
+    """
+    Sends a request to a running daemon, returns its response
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_file)
+    try:
+        sock.sendall(json.dumps(message).encode() + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(1 << 16)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return json.loads(data.decode())
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+from array import array
+from enum import Enum
+from heapq import merge
+from itertools import islice
+import csv
+import json
+import tempfile
+from .Gadget import Gadget, GadgetBase, disasm_all
+from .GadgetStore import GadgetStore, GADGET_TYPES, FLAG_MEM
+import logging
+
+EXTENSIONS = {'json': '.json', 'ndjson': '.ndjson', 'csv': '.csv', 'text': '.txt'}
+# gadgets materialized and disassembled at once
+EXPORT_CHUNK = 1024
+# rows sorted in memory, bigger stores are sorted with on disk runs
+SORT_RUN = 1 << 20
+WRITE_BUFFER = 1 << 20
+
+CSV_FIELDS = ('type', 'address', 'address_end', 'params', 'disasm', 'hex', 'dest', 'src', 'src1', 'src2', 'op',
+              'addr_reg', 'offset', 'register', 'modified_regs', 'mem', 'simple_access', 'stack_fix', 'retn', 'arch')
+
+
+def to_json(obj):
+    if isinstance(obj, Gadget):
+        return gadget_record(obj)
+    if isinstance(obj, frozenset):
+        return list(obj)
+    elif isinstance(obj, Enum):
+        return obj.name
+    return obj.__dict__
+
+
+def gadget_record(g):
+    d = { 'type':g.__class__.__name__[:g.__class__.__name__.find('_Gadget')],
+          'disasm':g.disasm(), 'params':g.param_str()}
+    d.update(g.params())
+    d.update((name, getattr(g, name)) for name in GadgetBase.__slots__)
+    # convert bytes to str
+    d['hex'] = d['hex'].hex()
+    return d
+
+
+class JsonWriter(object):
+    """
+    Writes the gadgets as a json array
+    """
+    def __init__(self, out):
+        self.out = out
+        self.count = 0
+
+    def begin(self):
+        self.out.write('[')
+
+    def write(self, g):
+        if self.count:
+            self.out.write(',')
+        self.out.write(json.dumps(gadget_record(g), default=to_json, ensure_ascii=False))
+        self.count += 1
+
+    def end(self):
+        self.out.write(']')
+
+
+class NdjsonWriter(JsonWriter):
+    """
+    Writes a json object per line
+    """
+    def begin(self):
+        pass
+
+    def write(self, g):
+        self.out.write(json.dumps(gadget_record(g), default=to_json, ensure_ascii=False))
+        self.out.write('\n')
+        self.count += 1
+
+    def end(self):
+        pass
+
+
+class CsvWriter(object):
+    def __init__(self, out):
+        self.writer = csv.writer(out)
+        self.count = 0
+
+    def begin(self):
+        self.writer.writerow(CSV_FIELDS)
+
+    def write(self, g):
+        d = gadget_record(g)
+        d['modified_regs'] = ' '.join(sorted(r.name for r in g.modified_regs or ()))
+        d['mem'] = ' '.join(sorted(r.name for r in g.mem[0])) if g.mem is not None else ''
+        d['simple_access'] = int(g.mem[1]) if g.mem is not None else ''
+        self.writer.writerow([d[f].name if isinstance(d.get(f), Enum) else d.get(f, '') for f in CSV_FIELDS])
+        self.count += 1
+
+    def end(self):
+        pass
+
+
+class TextWriter(object):
+    """
+    Writes each gadget followed by its disassembly
+    """
+    def __init__(self, out):
+        self.out = out
+        self.count = 0
+
+    def begin(self):
+        pass
+
+    def write(self, g):
+        self.out.write(str(g) + '\n' + g.dump() + '\n')
+        self.count += 1
+
+    def end(self):
+        pass
+
+
+WRITERS = {'json': JsonWriter, 'ndjson': NdjsonWriter, 'csv': CsvWriter, 'text': TextWriter}
+
+
+def popcount(x):
+    return bin(x).count('1')
+
+
+def sort_key(store):
+    """
+    Key ordering the rows of the store by gadget type, then by number of dereferenced registers,
+    number of modified registers and stack fix. Computed from the columns, without building the gadgets
+    """
+    type_rank = [sorted(t.__name__ for t in GADGET_TYPES).index(t.__name__) for t in GADGET_TYPES]
+    c = store.columns
+    def key(i):
+        return (type_rank[c['type'][i]], popcount(c['mem'][i]) if c['flags'][i] & FLAG_MEM else 0,
+                popcount(c['modified_regs'][i]), c['stack_fix'][i])
+    return key
+
+
+def read_run(run):
+    run.seek(0)
+    while True:
+        chunk = array('I')
+        data = run.read(SORT_RUN)
+        if not data:
+            break
+        chunk.frombytes(data)
+        yield from chunk
+
+
+def sorted_rows(store, key, run_size=SORT_RUN):
+    """
+    Yields the rows of the store ordered by key. If the store has more than run_size rows,
+    sorted runs are saved in temporary files and then merged
+    """
+    if len(store) <= run_size:
+        yield from sorted(range(len(store)), key=key)
+        return
+    runs = []
+    try:
+        for start in range(0, len(store), run_size):
+            run = tempfile.TemporaryFile()
+            run.write(array('I', sorted(range(start, min(start + run_size, len(store))), key=key)).tobytes())
+            runs.append(run)
+        logging.info('Merging %d sorted runs', len(runs))
+        # merge is stable: rows with the same key keep the store order
+        yield from merge(*[read_run(run) for run in runs], key=key)
+    finally:
+        for run in runs:
+            run.close()
+
+
+class GadgetsExporter(object):
+    """
+    Streams the gadgets of a store to a file, building at most EXPORT_CHUNK gadgets at a time
+    """
+    def __init__(self, gadgets):
+        if not isinstance(gadgets, GadgetStore):
+            gadgets = GadgetStore.from_gadgets(gadgets)
+        self.store = gadgets
+
+    def rows(self, ordered=True):
+        if ordered:
+            return sorted_rows(self.store, sort_key(self.store))
+        return iter(range(len(self.store)))
+
+    def export(self, out, fmt='json', ordered=True):
+        """
+        Writes the gadgets to the file object out in the given format, returns the number of gadgets written
+        """
+        writer = WRITERS[fmt](out)
+        writer.begin()
+        rows = self.rows(ordered)
+        while True:
+            chunk = [self.store[i] for i in islice(rows, EXPORT_CHUNK)]
+            if not chunk:
+                break
+            disasm_all(chunk, processes=1)
+            for g in chunk:
+                writer.write(g)
+        writer.end()
+        return writer.count
+
+    def export_file(self, filename, fmt='json', ordered=True):
+        with open(filename, 'w', buffering=WRITE_BUFFER, newline='' if fmt == 'csv' else None) as out:
+            return self.export(out, fmt, ordered)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+import os
+import re
+import sqlite3
+from enum import Enum
+from .Gadget import *
+from .GadgetStore import PARAMS, PARAM_COLUMNS, regs_to_mask
+from . import Arch
+import logging
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS binaries (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE,
+    basename TEXT,
+    arch INTEGER
+);
+CREATE TABLE IF NOT EXISTS gadgets (
+    binary INTEGER REFERENCES binaries(id),
+    type TEXT,
+    address INTEGER,
+    address_end INTEGER,
+    hex BLOB,
+    dest TEXT,
+    src TEXT,
+    src2 TEXT,
+    addr_reg TEXT,
+    op TEXT,
+    offset INTEGER,
+    mem INTEGER,
+    unknown INTEGER,
+    simple_access INTEGER,
+    modified_regs INTEGER,
+    stack_fix INTEGER,
+    retn INTEGER,
+    params TEXT,
+    disasm TEXT
+);
+CREATE INDEX IF NOT EXISTS gadgets_type_dest ON gadgets(type, dest);
+CREATE INDEX IF NOT EXISTS gadgets_type_src ON gadgets(type, src);
+CREATE INDEX IF NOT EXISTS gadgets_type_addr_reg ON gadgets(type, addr_reg);
+CREATE INDEX IF NOT EXISTS gadgets_binary ON gadgets(binary);
+'''
+
+# fields that can be used in query terms, mapped to their columns
+FIELDS = {'type': 'g.type', 'dest': 'g.dest', 'src': 'g.src', 'src1': 'g.src', 'register': 'g.src', 'src2': 'g.src2',
+          'addr_reg': 'g.addr_reg', 'op': 'g.op', 'offset': 'g.offset', 'unknown': 'g.unknown',
+          'simple_access': 'g.simple_access', 'stack_fix': 'g.stack_fix', 'retn': 'g.retn',
+          'address': 'g.address', 'arch': 'b.arch'}
+NUMERIC_FIELDS = ('offset', 'unknown', 'simple_access', 'stack_fix', 'retn', 'address', 'arch')
+# fields testing a register in a bitmask: (column, register bit set)
+MASK_FIELDS = {'derefs': ('g.mem', True), 'modifies': ('g.modified_regs', True), 'preserves': ('g.modified_regs', False)}
+OPERATORS = ('<=', '>=', '!=', '=', '<', '>')
+TERM = re.compile(r'^(\w+)(<=|>=|!=|=|<|>)(.+)$')
+
+
+def type_name(gadget_type):
+    return gadget_type.__name__[:gadget_type.__name__.find('_Gadget')] if gadget_type is not Gadget else 'Gadget'
+
+
+def register_bit(name):
+    for registers in (Arch.Registers64, Arch.Registers32):
+        if name in registers.__members__:
+            return 1 << (registers[name].value - 1)
+    raise Exception('Unknown register: %s' % name)
+
+
+def signed(value, bits):
+    """
+    Returns the offset value, masked to bits, as a signed integer: SQLite integers are signed 64 bits
+    """
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+
+def offset_condition(operator, value):
+    """
+    Compares the offsets with value, sign extended to the arch of each binary, e.g. 0xfffffff8 is -8 in 32 bits
+    """
+    conditions = []
+    parameters = []
+    for bits in (Arch.ARCH_32, Arch.ARCH_64):
+        # out of range for this arch
+        if not -(1 << (bits - 1)) <= value < 1 << bits:
+            continue
+        conditions.append('(b.arch = ? AND g.offset %s ?)' % operator)
+        parameters += [bits, signed(value, bits)]
+    if not conditions:
+        return ('0', [])
+    return ('(%s)' % ' OR '.join(conditions), parameters)
+
+
+def parse_term(term):
+    """
+    Translates a query term (e.g. 'addr_reg=rdi', 'stack_fix<=16', 'preserves=rbx') to an SQL condition and its parameters
+    """
+    match = TERM.match(term)
+    if match is None:
+        raise Exception('Invalid query term: %s' % term)
+    (field, operator, value) = match.groups()
+    if field == 'binary':
+        if operator not in ('=', '!='):
+            raise Exception('Invalid operator for binary: %s' % operator)
+        condition = '(b.name = ? OR b.basename = ?)'
+        return (condition if operator == '=' else 'NOT ' + condition, [value, value])
+    if field in MASK_FIELDS:
+        if operator != '=':
+            raise Exception('Invalid operator for %s: %s' % (field, operator))
+        (column, is_set) = MASK_FIELDS[field]
+        return ('(%s & ?) %s 0' % (column, '!=' if is_set else '='), [register_bit(value)])
+    if field not in FIELDS:
+        raise Exception('Unknown query field: %s' % field)
+    if field in NUMERIC_FIELDS:
+        value = int(value, 0)
+        if field == 'offset':
+            return offset_condition(operator, value)
+    elif field == 'type' and value.endswith('_Gadget'):
+        value = value[:value.find('_Gadget')]
+    elif field == 'op':
+        value = value.upper()
+    return ('%s %s ?' % (FIELDS[field], operator), [value])
+
+
+class GadgetsIndex(object):
+    """
+    SQLite database of verified gadgets, shared between many binaries
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, binary, gadgets):
+        """
+        Indexes the gadgets of binary, replacing the ones previously indexed for it
+        """
+        name = os.path.abspath(binary)
+        rows = []
+        arch = None
+        for g in gadgets:
+            arch = g.arch
+            params = dict((PARAM_COLUMNS[param], getattr(g, param)) for param in PARAMS[type(g)])
+            params = dict((column, value.name if isinstance(value, Enum) else value) for (column, value) in params.items())
+            mem = g.mem[0] if g.mem is not None else ()
+            rows.append((type_name(type(g)), g.address, g.address_end, g.hex, params.get('dest'), params.get('src'),
+                         params.get('src2'), params.get('addr_reg'), params.get('op'),
+                         signed(params['offset'], g.arch) if params.get('offset') is not None else None,
+                         regs_to_mask(mem), int(Arch.UnknownType.unknown in mem),
+                         int(g.mem[1]) if g.mem is not None else None,
+                         regs_to_mask(g.modified_regs or ()), g.stack_fix, g.retn, g.param_str(), g.disasm()))
+        with self.db:
+            old = self.db.execute('SELECT id FROM binaries WHERE name = ?', (name,)).fetchone()
+            if old is not None:
+                self.db.execute('DELETE FROM gadgets WHERE binary = ?', old)
+                self.db.execute('DELETE FROM binaries WHERE id = ?', old)
+            binary_id = self.db.execute('INSERT INTO binaries (name, basename, arch) VALUES (?, ?, ?)',
+                                        (name, os.path.basename(name), arch)).lastrowid
+            self.db.executemany('INSERT INTO gadgets VALUES (%d, %s)' % (binary_id, ', '.join(['?'] * 18)), rows)
+        logging.info('Indexed %d gadgets of %s in %s', len(rows), name, self.filename)
+        return len(rows)
+
+    def query(self, terms, limit=None):
+        """
+        Returns the gadgets matching all the terms, as (binary, address, type, params, disasm, stack_fix) rows
+        """
+        conditions = []
+        parameters = []
+        for term in terms:
+            (condition, term_parameters) = parse_term(term)
+            conditions.append(condition)
+            parameters += term_parameters
+        sql = 'SELECT b.basename, g.address, g.type, g.params, g.disasm, g.stack_fix FROM gadgets g JOIN binaries b ON g.binary = b.id'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY b.basename, g.type, g.unknown, g.stack_fix, g.address'
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+        return self.db.execute(sql, parameters).fetchall()
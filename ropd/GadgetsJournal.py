@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+from array import array
+from struct import pack, unpack, calcsize
+import os
+import time
+import zlib
+from .GadgetStore import GadgetStore
+from .BinaryInfo import file_digest
+import logging
+
+JOURNAL_EXTENSION = '.journal'
+JOURNAL_MAGIC = b'ROPDJN\x00\x01'
+# payload length, payload crc32
+RECORD_HEADER = '<II'
+# seconds between two checkpoints
+CHECKPOINT_INTERVAL = 10
+
+
+class GadgetsJournal(object):
+    """
+    Append-only journal of the gadget groups completed by a collection or verification phase.
+    Each record holds the addresses of the groups completed since the previous one and their resulting gadgets.
+    The journal starts with the digest of the phase input, so that it is not resumed if the input changed
+    """
+    def __init__(self, filename, input_filename, interval=CHECKPOINT_INTERVAL):
+        self.filename = filename
+        self.digest = file_digest(input_filename)
+        self.interval = interval
+        self.done = set()
+        self.gadgets = []
+        self._addresses = array('Q')
+        self._pending = []
+        self._last = time.time()
+        self._valid_size = 0
+        self._f = None
+
+    def resume(self):
+        """
+        Loads the completed groups from the journal, dropping a partially written last record.
+        Returns the number of completed groups
+        """
+        if not os.path.exists(self.filename):
+            return 0
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        if data[:len(JOURNAL_MAGIC)] != JOURNAL_MAGIC or data[len(JOURNAL_MAGIC):len(JOURNAL_MAGIC) + len(self.digest)] != self.digest:
+            print ('[-] %s is not a journal of the current input, starting over' % self.filename)
+            return 0
+        pos = len(JOURNAL_MAGIC) + len(self.digest)
+        size = calcsize(RECORD_HEADER)
+        while pos + size <= len(data):
+            (length, crc) = unpack(RECORD_HEADER, data[pos:pos + size])
+            payload = data[pos + size:pos + size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                logging.warning('Dropping truncated record at offset %d of %s', pos, self.filename)
+                break
+            (count,) = unpack('<I', payload[:4])
+            addresses = array('Q')
+            addresses.frombytes(payload[4:4 + 8 * count])
+            self.done.update(addresses)
+            self.gadgets += list(GadgetStore.from_bytes(payload[4 + 8 * count:]))
+            pos += size + length
+        # appended records must follow the last valid one
+        self._valid_size = pos
+        return len(self.done)
+
+    def open(self):
+        if self.done:
+            self._f = open(self.filename, 'r+b')
+            self._f.truncate(self._valid_size)
+            self._f.seek(self._valid_size)
+        else:
+            self._f = open(self.filename, 'wb')
+            self._f.write(JOURNAL_MAGIC + self.digest)
+            self._f.flush()
+        self._last = time.time()
+
+    def add(self, address, gadgets):
+        """
+        Records the gadgets resulting from the group at address, checkpointing every interval seconds
+        """
+        self._addresses.append(address)
+        self._pending += gadgets
+        if time.time() - self._last >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if not self._addresses:
+            return
+        if self._f is None:
+            self.open()
+        payload = pack('<I', len(self._addresses)) + self._addresses.tobytes() + GadgetStore.from_gadgets(self._pending).to_bytes()
+        self._f.write(pack(RECORD_HEADER, len(payload), zlib.crc32(payload)) + payload)
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._addresses = array('Q')
+        self._pending = []
+        self._last = time.time()
+
+    def close(self):
+        """
+        Removes the journal, once the results of the phase are saved
+        """
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+from capstone.x86 import *
+from .Gadget import Other_Gadget, Lahf_Gadget
+from .GadgetStore import PARAMS
+from . import Arch
+
+# instruction groups of prefixes whose effects are fully described by the registers they access
+PLAIN_GROUPS = frozenset([X86_GRP_MODE32, X86_GRP_MODE64, X86_GRP_NOT64BITMODE])
+
+
+class GadgetsTrie(object):
+    """
+    Gadgets ending with the same ret, organized by suffix: the parent of a gadget is its longest proper suffix,
+    i.e. the closest gadget starting at one of its instructions and ending with its ret
+    """
+    def __init__(self, gadgets):
+        # address -> address of the parent
+        self.parent = {}
+        # address -> capstone instructions preceding the parent
+        self.prefix = {}
+        sites = {}
+        for g in gadgets:
+            sites.setdefault(g.address_end, {})[g.address] = g
+        for site in sites.values():
+            starts = set()
+            # suffixes are visited before the gadgets containing them
+            for g in sorted(site.values(), key=lambda g: -g.address):
+                instructions = list(Arch.get(g.arch).md.disasm(g.hex, g.address))
+                for (n, i) in enumerate(instructions[1:], 1):
+                    if i.address in starts:
+                        self.parent[g.address] = i.address
+                        self.prefix[g.address] = instructions[:n]
+                        break
+                starts.add(g.address)
+
+
+def tail_params(g):
+    return tuple(getattr(g, p) for p in PARAMS[type(g)])
+
+
+def prefix_writes(arch, prefix):
+    """
+    Returns the registers written by the prefix of a gadget, or None if no gadget can inherit the verification of
+    its tail through it: the prefix accesses memory, or its effects are not fully described by the registers it accesses
+    """
+    if any(not (set(i.groups) <= PLAIN_GROUPS) for i in prefix):
+        return None
+    # e.g. segment or vector registers
+    if any(r not in arch.CS_REGS and r != X86_REG_EFLAGS for i in prefix for r in i.regs_access()[1]):
+        return None
+    (read, written, memory) = arch.effects(prefix)
+    if memory:
+        return None
+    return written
+
+
+def inherit(gad_list, prefix, tail_gadgets):
+    """
+    Returns the gadgets of gad_list verified by the verified gadgets of their tail, or None if some has to be verified.
+    A gadget is verified by its tail if the tail has a verified gadget of the same type and parameters, and the prefix
+    only writes registers that gadget does not depend on, without accessing memory
+    """
+    if not tail_gadgets:
+        return None
+    arch = Arch.get(gad_list[0].arch)
+    written = prefix_writes(arch, prefix)
+    if written is None:
+        return None
+    verified = dict(((type(t), tail_params(t)), t) for t in tail_gadgets)
+    inherited = []
+    for g in gad_list:
+        t = verified.get((type(g), tail_params(g)))
+        if t is None or type(g) is Other_Gadget or g.stack_fix != t.stack_fix:
+            return None
+        depends = set(p for p in tail_params(g) if p in arch.REG_MASKS) | set(r for r in t.mem[0] if r in arch.REG_MASKS)
+        if type(g) is Lahf_Gadget:
+            depends.add(Arch.FlagsType.flags)
+        if depends & written:
+            return None
+        inherited.append((g, t))
+    for (g, t) in inherited:
+        g.mem = t.mem
+        # the emulation may miss registers written by the prefix with their same value
+        g.modified_regs = frozenset(g.modified_regs | t.modified_regs | set(r for r in written if r in arch.REG_MASKS))
+    return gad_list
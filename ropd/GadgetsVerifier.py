@@ -10,15 +10,20 @@ import random
 from struct import pack, unpack
 from itertools import permutations, combinations, chain
 from functools import partial
-from multiprocessing import Pool
 from tqdm import *
 from .Gadget import Gadget, Operations, Types
 from .Gadget import *
 from . import Arch
+from . import Profiler
+from . import Metrics
+from . import WorkQueue
+from .GadgetsTrie import GadgetsTrie, inherit, prefix_writes
 import angr
+import queue
 import sys
+import json
 import claripy
-from .GadgetsCollector import FLAGS_MASK
+from .Arch import FLAGS_MASK
 import logging
 
 ANGR_MEM = 'mem'
@@ -26,12 +31,20 @@ ANGR_READ = 'read'
 ANGR_WRITE = 'write'
 ANGR_PROJECT = None
 ANGR_STATE = None
+# raised by claripy when the solver times out, wrapped by angr in SimSolverModeError
+SOLVER_INTERRUPT = getattr(claripy.errors, 'ClaripySolverInterruptError', None)
 
-def _set_global_project(project):
+def load_project(filename):
+    with Profiler.stage('load_project'):
+        project = angr.Project(filename, load_options={'main_opts': {'custom_base_addr': 0}})
+    # lifting happens inside successors()
+    Profiler.wrap(project.factory.default_engine, 'lift_vex', 'lift')
+    return project
+
+def _set_global_project(project, state=None):
     global ANGR_PROJECT, ANGR_STATE
     ANGR_PROJECT = project
-    Arch.init(project.arch.bits)
-    ANGR_STATE = make_symbolic_state(project)
+    ANGR_STATE = state if state is not None else make_symbolic_state(project)
 
 def make_initial_state(project, stack_length):
     """
@@ -62,8 +75,9 @@ def make_symbolic_state(project, stack_length=8):
     """
     input_state = make_initial_state(project, stack_length)
     symbolic_state = input_state.copy()
+    arch = Arch.get(project.arch.bits)
     # overwrite all registers
-    for reg in Arch.Registers:
+    for reg in arch.Registers:
         symbolic_state.registers.store(reg.name, symbolic_state.se.BVS("sreg_" + reg.name+ '-', project.arch.bits))
     #overwrite flags
     symbolic_state.registers.store('flags', symbolic_state.se.BVS("sreg_" + "flags-", project.arch.bits))
@@ -75,11 +89,11 @@ def verifyStackFix(g, init_state, final_state):
     # check that is unsat to have a different stack fix
     return not final_state.satisfiable(extra_constraints=[final_state.regs.sp - init_state.regs.sp != g.stack_fix])
 
-def verifyModReg(g, init_state, final_state):
+def verifyModReg(arch, g, init_state, final_state):
     # check preserved regs:
     preserved_regs = []
-    for reg in Arch.Registers:
-        if reg is not Arch.Registers_sp and reg not in g.modified_regs:
+    for reg in arch.Registers:
+        if reg is not arch.Registers_sp and reg not in g.modified_regs:
             preserved_regs.append(reg)
        
     constraints = False
@@ -95,11 +109,11 @@ def verifyModReg(g, init_state, final_state):
     
     return True'''
 
-def computeModReg(g, init_state, final_state):
+def computeModReg(arch, g, init_state, final_state):
     # check preserved regs:
     modified_regs = set()
     # maybe less efficient but more readable
-    for reg in [r for r in Arch.Registers if r is not Arch.Registers_sp]:
+    for reg in [r for r in arch.Registers if r is not arch.Registers_sp]:
         if final_state.satisfiable(extra_constraints=[final_state.registers.load(reg.name) != init_state.registers.load(reg.name)]):
             modified_regs.add(reg)
     return frozenset(modified_regs)
@@ -139,7 +153,7 @@ def verifyUnOpGadget(project, g, init_state, final_state):
 
 def verifyLahfGadget(project, g, init_state, final_state):
     flags = (init_state.regs.flags & FLAGS_MASK) | 2
-    ah = ((final_state.registers.load(Arch.Registers_a.name) >> 8) & FLAGS_MASK) | 2
+    ah = ((final_state.registers.load(Arch.get(project.arch.bits).Registers_a.name) >> 8) & FLAGS_MASK) | 2
     return not final_state.satisfiable(extra_constraints=[ ah != flags])
 
 def verifyReadMemGadget(project, g, init_state, final_state):
@@ -214,7 +228,7 @@ def verifyStackPtrOpGadget(project, g, init_state, final_state):
         [final_state.regs.sp != compute_operation(init_state.regs.sp + g.stack_fix, g.op, init_state.registers.load(g.register.name))])
 
 # TODO: naive implementation, but it works quite efficiently
-def compute_mem_accesses(project, g, init_state, final_state):
+def compute_mem_accesses(arch, project, g, init_state, final_state):
     mem = set()
     # Is the memory access performed through a simple dereferentiation? es: mov n, [REG]
     simple_accesses = True
@@ -225,7 +239,7 @@ def compute_mem_accesses(project, g, init_state, final_state):
             if var.startswith("sreg_"):
                 # get the name of the register from symbolic name, previously initialized as sreg_REG-
                 try:
-                    mem.add(Arch.Registers[var[5:].split("-")[0]])
+                    mem.add(arch.Registers[var[5:].split("-")[0]])
                 except KeyError:
                     mem.add(Arch.UnknownType.unknown)
             elif var.startswith("symbolic_stack"):
@@ -238,9 +252,9 @@ def compute_mem_accesses(project, g, init_state, final_state):
             if a.action == ANGR_READ:
                 # allow silently reads on the stack in a range [init.sp-Arch.STACK_CELLS, init.sp+Arch.STACK_CELLS], that anyway probably won't be useful
                 constraints = False
-                constraints = claripy.Or(constraints, (a.addr.ast - init_state.regs.sp) > (Arch.STACK_CELLS * (Arch.ARCH_BITS//8)))
+                constraints = claripy.Or(constraints, (a.addr.ast - init_state.regs.sp) > (arch.STACK_CELLS * (arch.ARCH_BITS//8)))
                 # Note: < and > are unsigned by default in claripy
-                constraints = claripy.Or(constraints, claripy.SLT(a.addr.ast - init_state.regs.sp, -(Arch.STACK_CELLS * (Arch.ARCH_BITS//8))))
+                constraints = claripy.Or(constraints, claripy.SLT(a.addr.ast - init_state.regs.sp, -(arch.STACK_CELLS * (arch.ARCH_BITS//8))))
                 if final_state.satisfiable(extra_constraints=[constraints]):
                     mem.add(Arch.UnknownType.unknown)
                     simple_accesses = False
@@ -248,7 +262,7 @@ def compute_mem_accesses(project, g, init_state, final_state):
                 # check if may write fixed memory outside the reserved area for the gadget on the stack
                 constraints = False
                 # outside or on the ret address
-                constraints = claripy.Or(constraints, a.addr.ast - init_state.regs.sp >= g.stack_fix - (Arch.ARCH_BITS//8))
+                constraints = claripy.Or(constraints, a.addr.ast - init_state.regs.sp >= g.stack_fix - (arch.ARCH_BITS//8))
                 # before init of the gadget
                 constraints = claripy.Or(constraints, a.addr.ast - init_state.regs.sp < 0)
                 if final_state.satisfiable(extra_constraints=[constraints]):
@@ -256,122 +270,318 @@ def compute_mem_accesses(project, g, init_state, final_state):
                     simple_accesses = False
     return (frozenset(mem), simple_accesses)
 
+def is_solver_timeout(e):
+    while e is not None:
+        if SOLVER_INTERRUPT is not None and isinstance(e, SOLVER_INTERRUPT):
+            return True
+        # some z3 releases report timeouts as canceled
+        if isinstance(e, claripy.errors.ClaripyZ3Error) and str(e).endswith(('canceled', 'timeout')):
+            return True
+        e = e.__cause__ or e.__context__
+    return False
+
+def discard(reason, g):
+    """
+    Counts g as discarded for reason, and logs it if debug logging is enabled
+    """
+    Metrics.count('verify', 'discarded', reason, type(g).__name__)
+    # dumping gadgets is expensive: only done if the log is written
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('DISCARDED: %s\n%s\n%s', reason.replace('_', ' '), g, g.dump())
+
+def discard_all(reason, gad_list):
+    for g in gad_list:
+        discard(reason, g)
+
+def symbolic_step(project, generic_state, first_g, gad_list=None):
+    """
+    Symbolically executes the gadget from the generic state, returns the (initial, final) states or None if it is not a valid gadget.
+    The gadgets of gad_list, at the same address, are discarded with it
+    """
+    if gad_list is None:
+        gad_list = [first_g]
+    init_state = generic_state.copy()
+    init_state.regs.ip = first_g.address
+    init_state.options.add(angr.options.BYPASS_UNSUPPORTED_SYSCALL)
+    # since ends with ret it will have unconstrained successors
+    try:
+        succ = project.factory.successors(init_state).unconstrained_successors
+    # gadget may be strange, very strange opcode can be present
+    except angr.errors.SimIRSBNoDecodeError as e:
+        discard_all('not_recognized_instructions', gad_list)
+        return None
+    except Exception as e:
+        if is_solver_timeout(e):
+            raise
+        logging.error(e)
+        discard_all('unsupported_instructions', gad_list)
+        return None
+    if len(succ) == 0:
+        if type(first_g) is not Other_Gadget: # syscall ending
+            discard_all('not_a_valid_gadget', gad_list)
+            return None
+        else:
+            # WHY? don't know why necessary 2 steps to bypass syscall
+            succ = project.factory.successors(init_state).flat_successors[0]
+            succ = project.factory.successors(succ).flat_successors[0]
+            succ = project.factory.successors(succ).unconstrained_successors
+            if len(succ) == 0:
+                discard_all('not_a_valid_gadget', gad_list)
+                return None
+    return (init_state, succ[0])
+
 def do_verify(gad_list):
+    # verify modified registers and stack fix once for all
+    if not gad_list:
+        logging.debug('DISCARDED: empty list')
+        return []
     try:
-        project = ANGR_PROJECT
-        generic_state = ANGR_STATE
-        verified_gadgets = []
-        # verify modified registers and stack fix once for all
-        if not gad_list:
-            logging.debug('DISCARDED: empty list')
-            return []
-        first_g = gad_list[0]
-        init_state = generic_state.copy()
-        init_state.regs.ip = first_g.address
-        init_state.options.add(angr.options.BYPASS_UNSUPPORTED_SYSCALL)
-        # since ends with ret it will have unconstrained successors
-        try:
-            succ = project.factory.successors(init_state).unconstrained_successors
-        # gadget may be strange, very strange opcode can be present
-        except angr.errors.SimIRSBNoDecodeError as e:
-            logging.debug('DISCARDED: not recognized instructions\n' + first_g.dump())
-            return []
-        except Exception as e:
-            logging.error(e)
-            logging.debug('DISCARDED: unsupported instructions\n' + first_g.dump())
-            return []
-        if len(succ) == 0:
-            if type(first_g) is not Other_Gadget: # syscall ending
-                logging.debug('DISCARDED: not a valid gadget\n' + first_g.dump())
+        with Metrics.Latency('verify', 'address'):
+            project = ANGR_PROJECT
+            generic_state = ANGR_STATE
+            arch = Arch.get(project.arch.bits)
+            first_g = gad_list[0]
+            with Profiler.stage('successors'), Metrics.Latency('verify', 'successors'):
+                states = symbolic_step(project, generic_state, first_g, gad_list)
+            if states is None:
                 return []
-            else:
-                # WHY? don't know why necessary 2 steps to bypass syscall
-                succ = project.factory.successors(init_state).flat_successors[0]
-                succ = project.factory.successors(succ).flat_successors[0]
-                succ = project.factory.successors(succ).unconstrained_successors
-                if len(succ) == 0:
-                    logging.debug(
-                        'DISCARDED: not a valid Other_Gadget\n' + first_g.dump())
-                    return []
-        final_state = succ[0]
-        modified_regs = None
-        if not verifyModReg(first_g, init_state, final_state):
-            logging.debug('recomputing modified regs\n' + first_g.dump())
-            modified_regs = computeModReg(first_g, init_state, final_state)
-            logging.debug('previous: %s, now %s\n', first_g.modified_regs, modified_regs)
-        mem = compute_mem_accesses(project, first_g, init_state, final_state)
-
-        for g in gad_list:
-            #maybe mod_regs recomputed
-            if modified_regs is not None:
-                g.modified_regs = modified_regs
-            # assign memory accesses analysys
-            g.mem = mem
-            # maybe StackPtrOp_gadget
-            if type(g) is StackPtrOp_Gadget and verifyStackPtrOpGadget(project, g, init_state, final_state):
-                # add esp to modified regs
-                #g.modified_regs.append(Arch.Registers_sp)
-                verified_gadgets.append(g)
-            elif not verifyStackFix(g, init_state, final_state):
-                logging.debug('DISCARDED: wrong stack fix\n'+ str(g) + '\n' + g.dump())
-            if type(g) is MovReg_Gadget and verifyMovRegGadget(project, g, init_state, final_state):
-                verified_gadgets.append(g)
-            elif type(g) is LoadConst_Gadget and verifyLoadConstGadget(project, g, init_state, final_state):
-                verified_gadgets.append(g)
-            elif type(g) is ClearReg_Gadget and verifyClearRegGadget(project, g, init_state, final_state):
-                verified_gadgets.append(g)
-            elif type(g) is UnOp_Gadget and verifyUnOpGadget(project, g, init_state, final_state):
-                verified_gadgets.append(g)
-            elif type(g) is BinOp_Gadget and verifyBinOpGadget(project, g, init_state, final_state):
-                verified_gadgets.append(g)
-            elif type(g) is ReadMem_Gadget and verifyReadMemGadget(project, g, init_state, final_state):
-                verified_gadgets.append(g)
-            elif type(g) is WriteMem_Gadget and verifyWriteMemGadget(project, g, init_state, final_state):
-                verified_gadgets.append(g)
-            elif type(g) is ReadMemOp_Gadget and verifyReadMemOpGadget(project, g, init_state, final_state):
-                verified_gadgets.append(g)
-            elif type(g) is WriteMemOp_Gadget and verifyWriteMemOpGadget(project, g, init_state, final_state):
-                verified_gadgets.append(g)
-            elif type(g) is Lahf_Gadget and verifyLahfGadget(project, g, init_state, final_state):
-                verified_gadgets.append(g)
-            elif type(g) is Other_Gadget: # no need to verify
-                verified_gadgets.append(g)
-            elif type(g) is StackPtrOp_Gadget:
-                # just checked, but avoid logging
-                continue
-            else:
-                logging.debug('DISCARDED:\n' + str(g) + '\n' + g.dump())
-        return verified_gadgets
+            (init_state, final_state) = states
+            with Profiler.stage('solver'), Metrics.Latency('verify', 'solver'):
+                return check_gadgets(arch, project, gad_list, init_state, final_state)
     except Exception as e:
-        logging.error(e)
+        if is_solver_timeout(e):
+            Metrics.count('verify', 'solver_timeouts')
+            discard_all('solver_timeout', gad_list)
+        else:
+            logging.error(e)
+            discard_all('error', gad_list)
         return []
 
+def check_gadgets(arch, project, gad_list, init_state, final_state):
+    """
+    Verifies the gadgets of gad_list, that share the same address, against its symbolic execution
+    """
+    first_g = gad_list[0]
+    verified_gadgets = []
+    modified_regs = None
+    if not verifyModReg(arch, first_g, init_state, final_state):
+        Metrics.count('verify', 'recomputed_modified_regs')
+        modified_regs = computeModReg(arch, first_g, init_state, final_state)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('recomputing modified regs\n%s\nprevious: %s, now %s\n', first_g.dump(), first_g.modified_regs, modified_regs)
+    mem = compute_mem_accesses(arch, project, first_g, init_state, final_state)
+
+    for g in gad_list:
+        #maybe mod_regs recomputed
+        if modified_regs is not None:
+            g.modified_regs = modified_regs
+        # assign memory accesses analysys
+        g.mem = mem
+        # maybe StackPtrOp_gadget
+        if type(g) is StackPtrOp_Gadget and verifyStackPtrOpGadget(project, g, init_state, final_state):
+            # add esp to modified regs
+            #g.modified_regs.append(Arch.Registers_sp)
+            verified_gadgets.append(g)
+        elif not verifyStackFix(g, init_state, final_state):
+            # not discarded: the type is still verified below
+            Metrics.count('verify', 'wrong_stack_fix', type(g).__name__)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug('DISCARDED: wrong stack fix\n%s\n%s', g, g.dump())
+        if type(g) is MovReg_Gadget and verifyMovRegGadget(project, g, init_state, final_state):
+            verified_gadgets.append(g)
+        elif type(g) is LoadConst_Gadget and verifyLoadConstGadget(project, g, init_state, final_state):
+            verified_gadgets.append(g)
+        elif type(g) is ClearReg_Gadget and verifyClearRegGadget(project, g, init_state, final_state):
+            verified_gadgets.append(g)
+        elif type(g) is UnOp_Gadget and verifyUnOpGadget(project, g, init_state, final_state):
+            verified_gadgets.append(g)
+        elif type(g) is BinOp_Gadget and verifyBinOpGadget(project, g, init_state, final_state):
+            verified_gadgets.append(g)
+        elif type(g) is ReadMem_Gadget and verifyReadMemGadget(project, g, init_state, final_state):
+            verified_gadgets.append(g)
+        elif type(g) is WriteMem_Gadget and verifyWriteMemGadget(project, g, init_state, final_state):
+            verified_gadgets.append(g)
+        elif type(g) is ReadMemOp_Gadget and verifyReadMemOpGadget(project, g, init_state, final_state):
+            verified_gadgets.append(g)
+        elif type(g) is WriteMemOp_Gadget and verifyWriteMemOpGadget(project, g, init_state, final_state):
+            verified_gadgets.append(g)
+        elif type(g) is Lahf_Gadget and verifyLahfGadget(project, g, init_state, final_state):
+            verified_gadgets.append(g)
+        elif type(g) is Other_Gadget: # no need to verify
+            verified_gadgets.append(g)
+        elif type(g) is StackPtrOp_Gadget:
+            # just checked, but avoid logging
+            continue
+        else:
+            discard('not_verified', g)
+    for g in verified_gadgets:
+        Metrics.count('verify', 'verified', type(g).__name__)
+    return verified_gadgets
+
+def verify_address(gad_list):
+    return (gad_list[0].address, do_verify(gad_list))
+
+def group_by_address(typed_gadgets):
+    """
+    Groups the typed gadgets by address, to verify them with a single symbolic execution
+    """
+    gadgets = {}
+    for g in typed_gadgets:
+        if g.address not in gadgets:
+            gadgets[g.address] = []
+        gadgets[g.address].append(g)
+    return gadgets
+
 class GadgetsVerifier(object):
     def __init__(self, filename, typed_gadgets):
         self.filename =  filename
         self.typed_gadgets = typed_gadgets
+        self.metrics = None
 
-    def verify(self):
-        project = angr.Project(self.filename, load_options={'main_opts': {'custom_base_addr': 0}})
+    def verify(self, journal=None):
+        """
+        Verifies the typed gadgets grouped by address. If journal is given, the groups it records as done are skipped,
+        and the results of the others are recorded in it.
+        A gadget whose prefix only writes registers, without accessing memory, waits for the verification of its tail
+        (the gadget ending with the same ret after the prefix) and inherits it if its registers are not written by
+        the prefix, see GadgetsTrie. The other gadgets are verified right away
+        """
+        Metrics.reset('verify')
+        project = load_project(self.filename)
         
         print ('Verifying...')
         logging.info("Starting Verification phase")
-        gadgets = {}
-        verified_num = 0
-        for g in self.typed_gadgets:
-            if g.address not in gadgets:
-                gadgets[g.address] = []
-            gadgets[g.address].append(g)
+        (gadgets, verified_gadgets) = self.pending_groups(journal)
+        with Profiler.stage('trie'):
+            trie = GadgetsTrie(self.typed_gadgets)
+        # address -> verified gadgets, of the tails of the other groups
+        verified = group_by_address(verified_gadgets)
+        # address -> groups that may inherit its verification, waiting for it
+        waiting = {}
+        ready = []
+        for address in gadgets:
+            parent = trie.parent.get(address)
+            if parent in gadgets and prefix_writes(Arch.get(gadgets[address][0].arch), trie.prefix[address]) is not None:
+                waiting.setdefault(parent, []).append(address)
+            else:
+                ready.append(address)
+        pool = Profiler.Pool(initializer=_set_global_project, initargs=(project,))
+        results = queue.Queue()
+        progress = tqdm(total=len(gadgets))
+        # groups submitted to the pool, not completed yet
+        running = 0
+
+        def resolve(address, tail_gadgets):
+            """
+            Completes the group of address if it inherits the verification of its tail, submits it otherwise
+            """
+            nonlocal running
+            res = None
+            if address in trie.parent:
+                res = inherit(gadgets[address], trie.prefix[address], tail_gadgets)
+            if res is None:
+                Metrics.submit(pool, verify_address, gadgets[address], results)
+                running += 1
+                return
+            for g in res:
+                Metrics.count('verify', 'inherited', type(g).__name__)
+                Metrics.count('verify', 'verified', type(g).__name__)
+            complete(address, res)
+
+        def complete(address, res):
+            verified[address] = res
+            verified_gadgets.extend(res)
+            if journal is not None:
+                journal.add(address, res)
+            progress.update(1)
+            for child in waiting.pop(address, []):
+                resolve(child, res)
+
+        try:
+            # groups that cannot inherit are verified right away, the others as soon as their tail is
+            for address in ready:
+                resolve(address, verified.get(trie.parent.get(address)))
+            while running:
+                (result, data) = results.get()
+                running -= 1
+                if data is None:
+                    raise result
+                Metrics.merge(data)
+                (address, res) = result
+                complete(address, res)
+            pool.close()
+        except:
+            # do not leave the workers running
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            progress.close()
+            # checkpoint the completed groups, even if interrupted
+            if journal is not None:
+                journal.flush()
+
+        return self.finish(verified_gadgets)
+
+    def pending_groups(self, journal):
+        """
+        Returns the gadgets to verify grouped by address, and the ones already verified according to journal
+        """
+        gadgets = group_by_address(self.typed_gadgets)
         verified_gadgets = []
-        '''for gad_list in tqdm(gadgets.values()):
-            verified_gadgets += do_verify(project, generic_state, gad_list)
-        '''
-        pool = Pool(initializer=_set_global_project, initargs=(project,))
-        for res in tqdm(pool.imap_unordered(do_verify, gadgets.values()), total=len(gadgets.values())):
-            verified_gadgets += res
-        pool.close()
-        pool.join()
+        if journal is not None and journal.done:
+            gadgets = dict((address, gad_list) for (address, gad_list) in gadgets.items() if address not in journal.done)
+            verified_gadgets += journal.gadgets
+            print ('Resuming: %d addresses already verified' % len(journal.done))
+        return (gadgets, verified_gadgets)
 
+    def finish(self, verified_gadgets):
         print ('Found %d different verified gadgets' % len(verified_gadgets))
         logging.info('Found %d different verified gadgets', len(verified_gadgets))
+        self.metrics = Metrics.summary('verify')
+        logging.info('Verification metrics: %s', json.dumps(self.metrics, sort_keys=True))
         return verified_gadgets
+
+    def serve(self, address, batch_size=WorkQueue.BATCH_SIZE, lease_timeout=WorkQueue.LEASE_TIMEOUT, journal=None):
+        """
+        Verifies the typed gadgets as verify(), serving batches of address groups to the workers connecting to address
+        (host:port or a unix socket path), see WorkQueue
+        """
+        Metrics.reset('verify')
+        print ('Verifying...')
+        logging.info("Starting distributed Verification phase on %s", address)
+        (gadgets, verified_gadgets) = self.pending_groups(journal)
+        groups = list(gadgets.values())
+        batches = [WorkQueue.serialize([g for gad_list in groups[i:i + batch_size] for g in gad_list])
+                   for i in range(0, len(groups), batch_size)]
+        work_queue = WorkQueue.WorkQueue(batches, lease_timeout=lease_timeout)
+        server = WorkQueue.start_server(address, work_queue, self.filename)
+        print ('Serving %d batches on %s, start the workers with: ropd worker --connect %s' % (len(batches), address, address))
+        progress = tqdm(total=len(groups))
+        try:
+            for i in range(len(batches)):
+                while True:
+                    try:
+                        (batch, payload, metrics) = work_queue.results.get(timeout=WorkQueue.WAIT_TIME)
+                        break
+                    except WorkQueue.queue.Empty:
+                        work_queue.expire()
+                group_count = min(batch_size, len(groups) - batch * batch_size)
+                if payload is None:
+                    for gad_list in groups[batch * batch_size:batch * batch_size + batch_size]:
+                        discard_all('error', gad_list)
+                    res = []
+                else:
+                    Metrics.merge(Metrics.decode(metrics))
+                    res = WorkQueue.deserialize(payload)
+                    verified_gadgets += res
+                if journal is not None:
+                    for gad_list in groups[batch * batch_size:batch * batch_size + batch_size]:
+                        journal.add(gad_list[0].address, [g for g in res if g.address == gad_list[0].address])
+                progress.update(group_count)
+        finally:
+            progress.close()
+            if journal is not None:
+                journal.flush()
+            WorkQueue.stop_server(server)
+        return self.finish(verified_gadgets)
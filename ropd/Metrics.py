@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+import bisect
+import json
+import os
+import time
+
+METRICS_EXTENSION = '.metrics.json'
+# upper bounds in milliseconds of the latency histograms buckets, the last bucket is unbounded
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# (phase, group, ...) -> count
+counters = {}
+# (phase, name) -> [count, total seconds, max seconds, bucket counts]
+histograms = {}
+
+
+def count(*path, n=1):
+    """
+    Increments the counter of path, e.g. count('verify', 'discarded', 'wrong_stack_fix', 'LoadConst_Gadget')
+    """
+    counters[path] = counters.get(path, 0) + n
+
+
+def observe(phase, name, seconds):
+    h = histograms.get((phase, name))
+    if h is None:
+        h = histograms[(phase, name)] = [0, 0.0, 0.0, [0] * (len(BUCKETS) + 1)]
+    h[0] += 1
+    h[1] += seconds
+    if seconds > h[2]:
+        h[2] = seconds
+    h[3][bisect.bisect_left(BUCKETS, seconds * 1000)] += 1
+
+
+class Latency(object):
+    """
+    Context manager adding its duration to a latency histogram
+    """
+    def __init__(self, phase, name):
+        self.phase = phase
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        observe(self.phase, self.name, time.perf_counter() - self.start)
+        return False
+
+
+def take():
+    """
+    Returns the metrics recorded since the last call, and clears them
+    """
+    global counters, histograms
+    data = (counters, histograms)
+    counters = {}
+    histograms = {}
+    return data
+
+
+def merge(data):
+    (other_counters, other_histograms) = data
+    for (path, n) in other_counters.items():
+        counters[path] = counters.get(path, 0) + n
+    for (key, (n, total, maximum, buckets)) in other_histograms.items():
+        h = histograms.get(key)
+        if h is None:
+            histograms[key] = [n, total, maximum, list(buckets)]
+            continue
+        h[0] += n
+        h[1] += total
+        h[2] = max(h[2], maximum)
+        h[3] = [a + b for (a, b) in zip(h[3], buckets)]
+
+
+def encode(data):
+    """
+    Returns the metrics returned by take() as json serializable lists, to be sent to another host
+    """
+    (c, h) = data
+    return [[list(path) + [n] for (path, n) in c.items()],
+            [list(key) + value for (key, value) in h.items()]]
+
+
+def decode(encoded):
+    (c, h) = encoded
+    return (dict((tuple(item[:-1]), item[-1]) for item in c),
+            dict(((phase, name), [n, total, maximum, buckets]) for (phase, name, n, total, maximum, buckets) in h))
+
+
+def reset(phase):
+    for path in [path for path in counters if path[0] == phase]:
+        del counters[path]
+    for key in [key for key in histograms if key[0] == phase]:
+        del histograms[key]
+
+
+class Task(object):
+    """
+    Pool task returning the metrics recorded by the worker while running function, along with its result
+    """
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, arg):
+        take()
+        result = self.function(arg)
+        return (result, take())
+
+
+def imap_unordered(pool, function, iterable, chunksize=1):
+    """
+    pool.imap_unordered, merging in this process the metrics recorded by the workers
+    """
+    for (result, data) in pool.imap_unordered(Task(function), iterable, chunksize):
+        merge(data)
+        yield result
+
+
+def submit(pool, function, arg, results):
+    """
+    Runs function(arg) in pool, putting (result, metrics recorded by the worker) in the queue results when done,
+    or (exception, None) if it raised. The metrics are to be merged by the caller
+    """
+    pool.apply_async(Task(function), (arg,), callback=results.put, error_callback=lambda e: results.put((e, None)))
+
+
+def percentile(buckets, n, p):
+    rank = n * p
+    seen = 0
+    for (i, c) in enumerate(buckets):
+        seen += c
+        if seen >= rank and c:
+            return BUCKETS[i] if i < len(BUCKETS) else None
+    return None
+
+
+def summary(phase):
+    """
+    Returns the counters and the latency histograms of phase, as a json serializable dict
+    """
+    result = {'phase': phase}
+    for (path, n) in sorted(counters.items()):
+        if path[0] != phase:
+            continue
+        node = result
+        for key in path[1:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = n
+    latency = {}
+    for ((p, name), (n, total, maximum, buckets)) in sorted(histograms.items()):
+        if p != phase or n == 0:
+            continue
+        # percentiles are the upper bounds of the buckets containing them
+        latency[name] = {'count': n, 'mean_ms': total / n * 1000, 'max_ms': maximum * 1000,
+                         'p50_ms': percentile(buckets, n, 0.5), 'p90_ms': percentile(buckets, n, 0.9),
+                         'p99_ms': percentile(buckets, n, 0.99),
+                         # [upper bound, count] of the non empty buckets, the upper bound of the last one is null
+                         'buckets': [[b, c] for (b, c) in zip(BUCKETS + (None,), buckets) if c]}
+    result['latency_ms'] = latency
+    return result
+
+
+def save(filename, phase):
+    """
+    Saves the summary of phase in a json file, keeping the summaries of the other phases
+    """
+    summaries = {}
+    if os.path.exists(filename):
+        try:
+            with open(filename) as f:
+                summaries = json.load(f)
+        except ValueError:
+            summaries = {}
+    summaries[phase] = summary(phase)
+    with open(filename, 'w') as f:
+        json.dump(summaries, f, indent=2, sort_keys=True)
+    return filename
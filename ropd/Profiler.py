@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+from multiprocessing import util
+import multiprocessing
+import cProfile
+import functools
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# when disabled, stage() returns a shared no-op timer and nothing is recorded
+ENABLED = False
+# directory where workers save their stages (and cProfile stats if requested)
+PROFILE_DIR = None
+SAVE_CPROFILE = False
+
+# stage name -> [calls, seconds]
+stages = {}
+_profile = None
+_start = None
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def stage(name):
+    """
+    Context manager timing a stage of the analysis
+    """
+    return Timer(name) if ENABLED else NULL_TIMER
+
+
+def add(name, seconds, calls=1):
+    s = stages.get(name)
+    if s is None:
+        s = stages[name] = [0, 0.0]
+    s[0] += calls
+    s[1] += seconds
+
+
+def wrap(obj, method, name):
+    """
+    Times the calls of a method of obj as the stage name, if profiling is enabled
+    """
+    if not ENABLED or not hasattr(obj, method):
+        return
+    function = getattr(obj, method)
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        with Timer(name):
+            return function(*args, **kwargs)
+    setattr(obj, method, timed)
+
+
+def enable(profile_dir=None):
+    """
+    Starts profiling this process and the workers of the pools created with Pool().
+    If profile_dir is given, cProfile stats of each process are saved in it
+    """
+    global ENABLED, PROFILE_DIR, SAVE_CPROFILE, _profile, _start
+    ENABLED = True
+    SAVE_CPROFILE = profile_dir is not None
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        PROFILE_DIR = os.path.abspath(profile_dir)
+        for name in os.listdir(PROFILE_DIR):
+            if name.startswith('stages-'):
+                os.remove(os.path.join(PROFILE_DIR, name))
+    else:
+        PROFILE_DIR = tempfile.mkdtemp(prefix='ropd-profile-')
+    stages.clear()
+    _start = time.perf_counter()
+    if SAVE_CPROFILE:
+        _profile = cProfile.Profile()
+        _profile.enable()
+
+
+def _init_worker(profile_dir, save_cprofile, initializer, initargs):
+    global ENABLED, PROFILE_DIR, SAVE_CPROFILE, _profile
+    ENABLED = True
+    PROFILE_DIR = profile_dir
+    SAVE_CPROFILE = save_cprofile
+    # forked workers inherit the stages of the parent
+    stages.clear()
+    _profile = None
+    if save_cprofile:
+        _profile = cProfile.Profile()
+        _profile.enable()
+    # run when the worker exits, after the pool is closed
+    util.Finalize(None, _save_worker, exitpriority=10)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def _save_worker():
+    if _profile is not None:
+        _profile.disable()
+        _profile.dump_stats(os.path.join(PROFILE_DIR, 'worker-%d.prof' % os.getpid()))
+    (fd, filename) = tempfile.mkstemp(prefix='stages-', suffix='.json', dir=PROFILE_DIR)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(stages, f)
+
+
+def Pool(processes=None, initializer=None, initargs=()):
+    """
+    multiprocessing.Pool whose workers report their stages when they exit, if profiling is enabled
+    """
+    if not ENABLED:
+        return multiprocessing.Pool(processes, initializer, initargs)
+    return multiprocessing.Pool(processes, _init_worker, (PROFILE_DIR, SAVE_CPROFILE, initializer, initargs))
+
+
+def collect():
+    """
+    Returns the stages of this process merged with the ones saved by the exited workers, and the number of workers
+    """
+    merged = dict((name, list(s)) for (name, s) in stages.items())
+    workers = 0
+    for name in os.listdir(PROFILE_DIR):
+        if not (name.startswith('stages-') and name.endswith('.json')):
+            continue
+        with open(os.path.join(PROFILE_DIR, name)) as f:
+            for (stage_name, (calls, seconds)) in json.load(f).items():
+                s = merged.setdefault(stage_name, [0, 0.0])
+                s[0] += calls
+                s[1] += seconds
+        workers += 1
+    return (merged, workers)
+
+
+def report():
+    """
+    Prints the time spent in each stage by this process and its workers, and stops profiling
+    """
+    global ENABLED, _profile
+    if not ENABLED:
+        return
+    wall = time.perf_counter() - _start
+    (merged, workers) = collect()
+    print ('[+] profile: %.2fs wall time, %d workers' % (wall, workers))
+    print ('%-20s %10s %12s %12s' % ('stage', 'calls', 'total (s)', 'mean (ms)'))
+    for (name, (calls, seconds)) in sorted(merged.items(), key=lambda item: -item[1][1]):
+        print ('%-20s %10d %12.3f %12.3f' % (name, calls, seconds, seconds / calls * 1000 if calls else 0))
+    print ('(worker stages are summed over all the workers, nested stages are included in the outer ones)')
+    if _profile is not None:
+        _profile.disable()
+        _profile.dump_stats(os.path.join(PROFILE_DIR, 'main-%d.prof' % os.getpid()))
+        _profile = None
+    if SAVE_CPROFILE:
+        for name in os.listdir(PROFILE_DIR):
+            if name.startswith('stages-'):
+                os.remove(os.path.join(PROFILE_DIR, name))
+        print ('[+] cProfile stats saved in', PROFILE_DIR)
+    else:
+        shutil.rmtree(PROFILE_DIR)
+    ENABLED = False
@@ -7,6 +7,7 @@ __email__ = "pietro.borrello95@gmail.com"
 
 from binascii import unhexlify, hexlify
 from enum import Enum
+from struct import pack
 from . import Arch
 from .RopChainKernel import RopChainKernel
 from .GadgetBox import GadgetBox
@@ -18,68 +19,89 @@ def hex(s):
     return '0x' + format(s, 'x')
 
 class RopChain(object):
-    def __init__(self, kernels=[]):
+    def __init__(self, kernels=[], arch=None):
         self.gadget_boxes = []
         self.set_registers = {}
+        self.arch = arch
         for kernel in kernels:
             self.gadget_boxes += kernel.gadget_boxes
 
+    def context(self):
+        """
+        Architecture of the chain, given or taken from its first gadget
+        """
+        if self.arch is None and self.gadget_boxes:
+            self.arch = Arch.get(self.gadget_boxes[0].gadget.arch)
+        return self.arch
+
     def simplify(self):
-        set_registers = {reg.name: None for reg in Arch.Registers}
+        arch = self.context()
+        set_registers = {reg.name: None for reg in arch.Registers}
         _simple_boxes = []
         for box in self.gadget_boxes:
-            try:
-                if(set_registers[box.gadget.dest.name] == box.value):
-                    continue
-                _simple_boxes.append(box)
-            except (AttributeError, KeyError):
-                _simple_boxes.append(box)
-            
+            box_registers = box.set_registers()
+            if box_registers and all(set_registers[reg.name] == value for (reg, value) in box_registers.items()):
+                continue
+            _simple_boxes.append(box)
 
             for reg in box.gadget.modified_regs:
                 set_registers[reg.name] = None
-            try:
-                set_registers[box.gadget.dest.name] = box.value
-            except AttributeError:
-                pass
+            for (reg, value) in box_registers.items():
+                set_registers[reg.name] = value
         #print (self.dump())
         self.gadget_boxes = _simple_boxes
 
     def dump(self, dump_values=True):
+        arch = self.context()
         ris = ''
         if dump_values:
             values = self.evaluate()
             ris += "# values after the chain:\n"
-            for reg in Arch.Registers:
+            for reg in arch.Registers:
                 ris += '# ' + (reg.name + ':').ljust(5, ' ') + \
                     (hex(values[reg.name]) if values[reg.name] is not None else '?') + '\n'
             ris += '\n'
 
         ris += "IMAGE_BASE =  0x0\n"
-        ris += "rebase = lambda x : p" + str(Arch.ARCH_BITS) + "(x + IMAGE_BASE)\n\n"
+        ris += "rebase = lambda x : p" + str(arch.ARCH_BITS) + "(x + IMAGE_BASE)\n\n"
         ris += "rop = ''"
         for box in self.gadget_boxes:
             ris += "\nrop += rebase(" + hex(box.gadget.address)+ ") # " + box.gadget.disasm()
-            for i in range(Arch.ARCH_BITS // 8, box.gadget.stack_fix, Arch.ARCH_BITS // 8):
-                ris += "\nrop += p" + str(Arch.ARCH_BITS) + "(" + hex(box.value) + ")"
+            for i in range(arch.ARCH_BITS // 8, box.gadget.stack_fix, arch.ARCH_BITS // 8):
+                ris += "\nrop += p" + str(arch.ARCH_BITS) + "(" + hex(box.stack_value(i - arch.ARCH_BITS // 8)) + ")"
         return ris
 
     def evaluate(self):
-        set_registers = {reg.name: None for reg in Arch.Registers }
+        arch = self.context()
+        set_registers = {reg.name: None for reg in arch.Registers }
         for box in self.gadget_boxes:
             for reg in box.gadget.modified_regs:
                 set_registers[reg.name] = None
-            try:
-                set_registers[box.gadget.dest.name] = box.value
-            except AttributeError:
-                pass
+            for (reg, value) in box.set_registers().items():
+                set_registers[reg.name] = value
         return set_registers
             
+    def pack(self, image_base=0):
+        arch = self.context()
+        ris = b''
+        for box in self.gadget_boxes:
+            ris += pack('<' + arch.PACK_VALUE, (box.gadget.address + image_base) & arch.MAX_INT)
+            for i in range(arch.ARCH_BITS // 8, box.gadget.stack_fix, arch.ARCH_BITS // 8):
+                value = box.stack_value(i - arch.ARCH_BITS // 8)
+                ris += pack('<' + arch.PACK_VALUE, (value if value is not None else 0) & arch.MAX_INT)
+        return ris
+
+    def size(self):
+        return sum(box.gadget.stack_fix for box in self.gadget_boxes)
+
     def add(self, gadget, value=None):
         self.gadget_boxes.append(GadgetBox(gadget, value=value))
 
+    def key(self):
+        return tuple(box.key() for box in self.gadget_boxes)
+
     def __eq__(self, other):
-        return type(self) == type(other) and self.__dict__ == other.__dict__
+        return type(self) == type(other) and self.key() == other.key()
 
     def __ne__(self, other):
         """Overrides the default implementation (unnecessary in Python 3)"""
@@ -87,4 +109,4 @@ class RopChain(object):
 
     def __hash__(self):
         """Overrides the default implementation"""
-        return hash(tuple(sorted(self.__dict__.items())))
+        return hash(self.key())
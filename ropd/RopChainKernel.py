@@ -24,6 +24,12 @@ class RopChainKernel(object):
         except:
             return "WriteMem"
 
+    def dests(self):
+        try:
+            return set(self.gadget_boxes[-1].set_registers())
+        except IndexError:
+            return set()
+
     def dump(self):
         ris = ''
         for box in self.gadget_boxes:
@@ -31,15 +37,18 @@ class RopChainKernel(object):
         return ris
 
     def copy(self):
-        ris = RopChainKernel([GadgetBox(box.gadget, value=box.value) for box in self.gadget_boxes])
+        ris = RopChainKernel([GadgetBox(box.gadget, value=box.value, loads=box.loads) for box in self.gadget_boxes])
         return ris
     
     def add(self, gadget, value=None):
         self.gadget_boxes.append(GadgetBox(gadget, value=value))
         self.modified_regs.update(gadget.modified_regs)
 
+    def key(self):
+        return tuple(box.key() for box in self.gadget_boxes)
+
     def __eq__(self, other):
-        return type(self) == type(other) and self.__dict__ == other.__dict__
+        return type(self) == type(other) and self.key() == other.key()
 
     def __ne__(self, other):
         """Overrides the default implementation (unnecessary in Python 3)"""
@@ -47,4 +56,4 @@ class RopChainKernel(object):
 
     def __hash__(self):
         """Overrides the default implementation"""
-        return hash(tuple(sorted(self.__dict__.items())))
+        return hash(self.key())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+from itertools import islice
+from .Gadget import *
+from .RopChainKernel import RopChainKernel
+from .RopChain import RopChain
+from .GadgetBox import GadgetBox
+from . import Arch
+import networkx as nx
+import logging
+
+# maximum number of kernel orderings tried
+MAX_ORDERS = 128
+# maximum number of consecutive gadgets merged into a single one
+MAX_MERGE = 4
+
+
+def gadget_reads(g, arch):
+    """
+    Registers whose value is used by the gadget, either as operand or to dereference memory
+    """
+    if isinstance(g, Other_Gadget) or Arch.UnknownType.unknown in g.mem[0]:
+        return set(arch.Registers)
+    reads = set([r for r in g.mem[0] if isinstance(r, arch.Registers)])
+    for attr in ('src', 'src1', 'src2', 'addr_reg', 'register'):
+        if hasattr(g, attr):
+            reads.add(getattr(g, attr))
+    if isinstance(g, (UnOp_Gadget, ReadMemOp_Gadget)):
+        reads.add(g.dest)
+    return reads
+
+
+def boxes_size(boxes):
+    return sum(box.gadget.stack_fix for box in boxes)
+
+
+class RopChainOptimizer(object):
+    def __init__(self, gadgets, validator=None, arch=None):
+        self.validator = validator
+        self.arch = arch if arch is not None or not gadgets else Arch.get(gadgets[0].arch)
+        self.equivalent_gadgets = {}
+        self.grouped_load_gadgets = {}
+        for g in gadgets:
+            # syscalls and stack pointer gadgets differ for more than their parameters
+            if not isinstance(g, (Other_Gadget, StackPtrOp_Gadget)) and type(g) is not Gadget:
+                self.equivalent_gadgets.setdefault((type(g), g.param_str()), []).append(g)
+            if isinstance(g, LoadConst_Gadget) and len(g.mem[0]) == 0:
+                self.grouped_load_gadgets.setdefault(g.address, {}).setdefault(g.dest, g)
+        for equivalents in self.equivalent_gadgets.values():
+            equivalents.sort(key=lambda g: g.stack_fix)
+        self.grouped_load_gadgets = [group for group in self.grouped_load_gadgets.values() if len(group) > 1]
+
+    def optimize(self, kernels, register_values, memory_values={}):
+        """
+        Optimizes the chain composed by the kernels, that must set the registers to register_values.
+        Returns the optimized chain and the number of bytes saved with respect to the simplified chain.
+        If a validator is available, candidate chains are validated by emulation, together with memory_values
+        """
+        chain = RopChain(kernels, arch=self.arch)
+        chain.simplify()
+        original_size = chain.size()
+        live_regs = set([reg for reg in self.arch.Registers if reg.name in register_values])
+
+        candidates = []
+        for order in islice(self.kernel_orders(kernels), MAX_ORDERS):
+            boxes = [box for kernel in order for box in kernel.gadget_boxes]
+            candidate = RopChain([RopChainKernel(self.optimize_boxes(boxes, live_regs))], arch=self.arch)
+            if candidate.size() >= original_size:
+                continue
+            values = candidate.evaluate()
+            if all(values[reg] == value for (reg, value) in register_values.items()):
+                candidates.append(candidate)
+        candidates.sort(key=lambda c: c.size())
+        if self.validator is not None and candidates:
+            candidates = [c for (c, valid) in zip(candidates, self.validator.validate_many(candidates, register_values, memory_values)) if valid]
+
+        best = (candidates + [chain])[0]
+        logging.info('Chain optimized from %d to %d bytes', original_size, best.size())
+        return (best, original_size - best.size())
+
+    def kernel_orders(self, kernels):
+        """
+        Generates the orderings of the kernels in which no kernel clobbers a register set by a following one.
+        Kernels without destinations (i.e. memory writes) keep their relative order
+        """
+        dests = [kernel.dests() for kernel in kernels]
+        kernel_graph = nx.DiGraph()
+        kernel_graph.add_nodes_from(range(len(kernels)))
+        for (i, kernel) in enumerate(kernels):
+            kernel_graph.add_edges_from([(i, j) for j in range(len(kernels)) if i != j and kernel.modified_regs & dests[j]])
+        side_effects = [i for i in range(len(kernels)) if not dests[i]]
+        kernel_graph.add_edges_from(zip(side_effects, side_effects[1:]))
+        yield kernels
+        try:
+            for order in nx.all_topological_sorts(kernel_graph):
+                yield [kernels[i] for i in order]
+        except nx.exception.NetworkXUnfeasible:
+            return
+
+    def optimize_boxes(self, boxes, live_regs):
+        size = None
+        while size is None or boxes_size(boxes) < size:
+            size = boxes_size(boxes)
+            boxes = self.substitute_gadgets(boxes)
+            boxes = self.merge_loads(boxes)
+            boxes = self.remove_dead_stores(boxes, live_regs)
+            chain = RopChain([RopChainKernel(boxes)], arch=self.arch)
+            chain.simplify()
+            boxes = chain.gadget_boxes
+        return boxes
+
+    def substitute_gadgets(self, boxes):
+        """
+        Replaces each gadget with an equivalent one with lower stack fix, not clobbering or dereferencing more registers
+        """
+        result = []
+        for box in boxes:
+            g = box.gadget
+            if not box.loads and (type(g), g.param_str()) in self.equivalent_gadgets:
+                for e in self.equivalent_gadgets[(type(g), g.param_str())]:
+                    if e.stack_fix >= g.stack_fix:
+                        break
+                    if e.modified_regs <= g.modified_regs and set(e.mem[0]) <= set(g.mem[0]):
+                        box = GadgetBox(e, value=box.value)
+                        break
+            result.append(box)
+        return result
+
+    def merge_loads(self, boxes):
+        """
+        Replaces consecutive LoadConst gadgets with a single gadget loading all their registers
+        """
+        result = []
+        i = 0
+        while i < len(boxes):
+            merged = None
+            for n in range(min(MAX_MERGE, len(boxes) - i), 1, -1):
+                merged = self.merge_window(boxes[i:i + n])
+                if merged is not None:
+                    break
+            if merged is not None:
+                result.append(merged)
+                i += n
+            else:
+                result.append(boxes[i])
+                i += 1
+        return result
+
+    def merge_window(self, window):
+        if not all(isinstance(box.gadget, LoadConst_Gadget) and not box.loads for box in window):
+            return None
+        values = dict((box.gadget.dest, box.value) for box in window)
+        if len(values) != len(window):
+            return None
+        modified_regs = set()
+        for box in window:
+            modified_regs.update(box.gadget.modified_regs)
+        best = None
+        for group in self.grouped_load_gadgets:
+            if not set(values).issubset(set(group)):
+                continue
+            g = group[window[0].gadget.dest]
+            if g.stack_fix >= boxes_size(window) or not g.modified_regs <= modified_regs:
+                continue
+            if best is not None and g.stack_fix >= best.stack_fix:
+                continue
+            slots = {}
+            for (reg, value) in values.items():
+                if slots.get(group[reg].offset, value) != value:
+                    break
+                slots[group[reg].offset] = value
+            else:
+                best = g
+                best_loads = [(l, slots.get(l.offset)) for l in group.values() if l is not g]
+        if best is None:
+            return None
+        return GadgetBox(best, value=values[best.dest], loads=best_loads)
+
+    def remove_dead_stores(self, boxes, live_regs):
+        """
+        Removes the gadgets only setting registers that are overwritten before being used
+        """
+        live = set(live_regs)
+        result = []
+        for box in reversed(boxes):
+            dests = set(box.set_registers())
+            if dests and live.isdisjoint(dests) and not isinstance(box.gadget, (WriteMem_Gadget, WriteMemOp_Gadget, Other_Gadget, StackPtrOp_Gadget)):
+                continue
+            live -= dests
+            live |= gadget_reads(box.gadget, self.arch)
+            result.append(box)
+        result.reverse()
+        return result
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+from struct import pack, unpack
+from unicorn import *
+from unicorn.x86_const import *
+from .Gadget import Other_Gadget
+from .RopChain import RopChain
+from . import Arch
+from .BinaryInfo import load_info
+import logging
+
+# memory where the chain is laid out
+STACK_ADDRESS = 0x70000000
+STACK_SIZE = 2 * 1024 * 1024
+# return address placed after the chain, execution stops when reaching it
+STOP_ADDRESS = 0x6fff0000
+MAX_INSTRUCTIONS = 0x10000
+MAX_MAPPED_PAGES = 128
+
+
+# callback mapping the pages accessed but not belonging to the binary
+def hook_mem_invalid(uc, access, address, size, value, user_data):
+    (mapped_pages, arch) = user_data
+    if len(mapped_pages) > MAX_MAPPED_PAGES:
+        return False
+    page = (address // arch.PAGE_SIZE) * arch.PAGE_SIZE
+    #memory access not necessarly aligned to page boundaries, so map two pages to be sure
+    for p in (page, page + arch.PAGE_SIZE):
+        try:
+            uc.mem_map(p, arch.PAGE_SIZE)
+            mapped_pages.append(p)
+        except UcError as e:
+            pass
+    return True
+
+
+# callback tracing the pages of the binary written by the chain
+def hook_mem_write(uc, access, address, size, value, user_data):
+    (dirty_pages, arch) = user_data
+    dirty_pages.add((address // arch.PAGE_SIZE) * arch.PAGE_SIZE)
+    dirty_pages.add(((address + size - 1) // arch.PAGE_SIZE) * arch.PAGE_SIZE)
+
+
+class RopChainValidator(object):
+    """
+    Validates ropchains by concretely executing them under unicorn, with the binary segments mapped in memory
+    """
+    def __init__(self, filename, arch, info=None):
+        self.filename = filename
+        self.arch = arch
+        self.segments = (info or load_info(filename)).segment_contents()
+        self.mu = None
+        self.pages = {}
+        self.dirty_pages = set()
+        self.mapped_pages = []
+
+    def setup(self):
+        self.mu = Uc(UC_ARCH_X86, self.arch.UC_MODE)
+        # merge the pages of all the segments, since they may overlap
+        intervals = []
+        for (address, content, size) in sorted(self.segments):
+            start = (address // self.arch.PAGE_SIZE) * self.arch.PAGE_SIZE
+            end = ((address + max(size, len(content)) + self.arch.PAGE_SIZE - 1) // self.arch.PAGE_SIZE) * self.arch.PAGE_SIZE
+            if intervals and start <= intervals[-1][1]:
+                intervals[-1][1] = max(intervals[-1][1], end)
+            else:
+                intervals.append([start, end])
+        for (start, end) in intervals:
+            self.mu.mem_map(start, end - start)
+        for (address, content, size) in self.segments:
+            self.mu.mem_write(address, content)
+        # save the initial content of the binary pages, to restore the ones written by a chain
+        for (start, end) in intervals:
+            for page in range(start, end, self.arch.PAGE_SIZE):
+                self.pages[page] = bytes(self.mu.mem_read(page, self.arch.PAGE_SIZE))
+        self.mu.mem_map(STACK_ADDRESS, STACK_SIZE)
+
+        self.mu.hook_add(UC_HOOK_MEM_READ_UNMAPPED | UC_HOOK_MEM_WRITE_UNMAPPED | UC_HOOK_MEM_FETCH_UNMAPPED,
+                         hook_mem_invalid, user_data=(self.mapped_pages, self.arch))
+        self.mu.hook_add(UC_HOOK_MEM_WRITE, hook_mem_write, user_data=(self.dirty_pages, self.arch))
+
+    def reset(self):
+        for page in self.dirty_pages:
+            if page in self.pages:
+                self.mu.mem_write(page, self.pages[page])
+        self.dirty_pages.clear()
+        for page in self.mapped_pages:
+            self.mu.mem_unmap(page, self.arch.PAGE_SIZE)
+        del self.mapped_pages[:]
+
+    def run(self, chain, register_values, memory_values):
+        boxes = chain.gadget_boxes
+        # stop before executing the final gadget (i.e. the syscall)
+        if boxes and isinstance(boxes[-1].gadget, Other_Gadget):
+            boxes = boxes[:-1]
+        if not boxes:
+            return not register_values and not memory_values
+        prefix = RopChain(arch=self.arch)
+        prefix.gadget_boxes = boxes
+        payload = prefix.pack() + pack('<' + self.arch.PACK_VALUE, STOP_ADDRESS)
+        if len(payload) > STACK_SIZE // 2:
+            return False
+
+        self.reset()
+        self.mu.mem_write(STACK_ADDRESS, payload)
+        # unknown registers get random values, as if the first gadget was reached by a ret
+        for r in self.arch.regs_no_sp:
+            self.mu.reg_write(self.arch.regs[r], self.arch.rand())
+        self.mu.reg_write(self.arch.regs[self.arch.Registers_sp], STACK_ADDRESS + self.arch.ARCH_BITS // 8)
+        try:
+            self.mu.emu_start(boxes[0].gadget.address, STOP_ADDRESS, timeout=UC_SECOND_SCALE, count=MAX_INSTRUCTIONS)
+        except UcError as e:
+            logging.debug('Chain validation failed: %s', e)
+            return False
+        if self.mu.reg_read(self.arch.IP_REG) != STOP_ADDRESS:
+            logging.debug('Chain validation failed: the chain does not terminate')
+            return False
+
+        for (reg, value) in register_values.items():
+            if self.mu.reg_read(self.arch.regs[self.arch.Registers[reg]]) != value & self.arch.MAX_INT:
+                logging.debug('Chain validation failed: wrong value for %s', reg)
+                return False
+        for (address, data) in memory_values.items():
+            try:
+                if bytes(self.mu.mem_read(address, len(data))) != bytes(data):
+                    logging.debug('Chain validation failed: wrong memory content at %x', address)
+                    return False
+            except UcError as e:
+                return False
+        return True
+
+    def validate(self, chain, register_values, memory_values={}):
+        """
+        Checks that the chain sets the registers to register_values, and writes the buffers in memory_values
+        ({address: bytes}) to memory. A final syscall gadget is not executed
+        """
+        return self.validate_many([chain], register_values, memory_values)[0]
+
+    def validate_many(self, chains, register_values, memory_values={}):
+        """
+        Validates all the chains against the same query, reusing the same emulator
+        """
+        if self.mu is None:
+            self.setup()
+        return [self.run(chain, register_values, memory_values) for chain in chains]
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+__author__ = "Pietro Borrello"
+__copyright__ = "Copyright 2021, ROPD Project"
+__license__ = "BSD 2-clause"
+__email__ = "pietro.borrello95@gmail.com"
+
+from collections import deque
+from struct import pack, unpack, calcsize
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from . import Metrics
+from .GadgetStore import GadgetStore
+import logging
+
+# json header length, payload length
+MESSAGE_HEADER = '<II'
+MAX_MESSAGE = 1 << 30
+# batches not completed in this many seconds are given to another worker
+LEASE_TIMEOUT = 300
+# leases of a batch before giving up on it
+MAX_ATTEMPTS = 3
+# address groups of each batch
+BATCH_SIZE = 16
+# seconds a worker waits before asking again for a batch, when all are leased
+WAIT_TIME = 1
+# returned by WorkQueue.lease() when all batches are completed
+DONE = -1
+
+
+def parse_address(address):
+    """
+    Returns the socket family and address of host:port, or of a unix socket path
+    """
+    (host, sep, port) = address.rpartition(':')
+    if sep and port.isdigit():
+        return (socket.AF_INET, (host or '0.0.0.0', int(port)))
+    return (socket.AF_UNIX, address)
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+def send_message(sock, header, payload=b''):
+    data = json.dumps(header).encode()
+    sock.sendall(pack(MESSAGE_HEADER, len(data), len(payload)) + data + payload)
+
+
+def recv_message(sock):
+    """
+    Returns the (header, payload) of the next message, or (None, None) if the connection is closed
+    """
+    sizes = recv_exactly(sock, calcsize(MESSAGE_HEADER))
+    if sizes is None:
+        return (None, None)
+    (header_size, payload_size) = unpack(MESSAGE_HEADER, sizes)
+    if header_size + payload_size > MAX_MESSAGE:
+        raise Exception('Message too long: %d bytes' % (header_size + payload_size))
+    data = recv_exactly(sock, header_size + payload_size)
+    if data is None:
+        return (None, None)
+    return (json.loads(data[:header_size].decode()), data[header_size:])
+
+
+class WorkQueue(object):
+    """
+    Batches of gadget groups leased to the workers. A batch not completed before its lease expires, or whose worker
+    disconnects, is leased again, up to MAX_ATTEMPTS times. Completed and failed batches are put in results.
+    A batch is given up after MAX_ATTEMPTS leases, but the workers that received it can still complete it: it fails
+    once all of them disconnected, or when no other batch is left to wait for
+    """
+    def __init__(self, batches, lease_timeout=LEASE_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+        # batch id -> serialized gadgets
+        self.batches = batches
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.pending = deque(range(len(batches)))
+        # batch id -> (owner, deadline) of its current lease
+        self.leases = {}
+        # batch id -> owners that received it, and may still complete it
+        self.holders = [set() for b in batches]
+        self.attempts = [0] * len(batches)
+        self.given_up = set()
+        self.completed = set()
+        # (batch id, serialized verified gadgets, encoded metrics), gadgets are None if the batch failed
+        self.results = queue.Queue()
+        self.lock = threading.Lock()
+
+    def expire(self):
+        now = time.time()
+        with self.lock:
+            for (batch, (owner, deadline)) in list(self.leases.items()):
+                if deadline < now:
+                    logging.warning('Lease of batch %d expired', batch)
+                    self._release(batch)
+            self._fail_given_up()
+
+    def _release(self, batch):
+        del self.leases[batch]
+        if self.attempts[batch] >= self.max_attempts:
+            logging.error('Batch %d failed %d times, giving up', batch, self.attempts[batch])
+            self.given_up.add(batch)
+        else:
+            self.pending.appendleft(batch)
+
+    def _fail_given_up(self):
+        waiting = len(self.completed) + len(self.given_up) < len(self.batches)
+        for batch in [batch for batch in self.given_up if not self.holders[batch] or not waiting]:
+            self.given_up.remove(batch)
+            self.completed.add(batch)
+            self.results.put((batch, None, None))
+
+    def lease(self, owner):
+        """
+        Returns the id of the next batch to process, DONE if all are completed, None if all the others are leased
+        """
+        self.expire()
+        with self.lock:
+            if len(self.completed) == len(self.batches):
+                return DONE
+            if not self.pending:
+                return None
+            batch = self.pending.popleft()
+            self.attempts[batch] += 1
+            self.leases[batch] = (owner, time.time() + self.lease_timeout)
+            self.holders[batch].add(owner)
+            return batch
+
+    def complete(self, owner, batch, payload, metrics):
+        with self.lock:
+            self.holders[batch].discard(owner)
+            # late results of a batch leased again
+            if batch in self.completed:
+                return
+            if batch in self.given_up:
+                logging.info('Late result of batch %d accepted', batch)
+                self.given_up.remove(batch)
+            self.leases.pop(batch, None)
+            if batch in self.pending:
+                self.pending.remove(batch)
+            self.completed.add(batch)
+        self.results.put((batch, payload, metrics))
+
+    def release(self, owner, batches):
+        """
+        Leases again the batches of a disconnected worker, the ones it still holds
+        """
+        with self.lock:
+            for batch in batches:
+                self.holders[batch].discard(owner)
+                if batch in self.leases and self.leases[batch][0] is owner:
+                    self._release(batch)
+            self._fail_given_up()
+
+
+class WorkQueueHandler(socketserver.BaseRequestHandler):
+    """
+    Serves a worker: each message of the worker is answered with the next batch to process
+    """
+    def handle(self):
+        server = self.server
+        leased = set()
+        try:
+            (header, payload) = recv_message(self.request)
+            if header is None or header.get('type') != 'hello':
+                return
+            logging.info('Worker %s connected', header.get('worker'))
+            send_message(self.request, {'type': 'setup', 'name': server.name, 'sha256': server.digest}, server.binary)
+            while True:
+                (header, payload) = recv_message(self.request)
+                if header is None:
+                    break
+                if header['type'] == 'result':
+                    leased.discard(header['batch'])
+                    server.queue.complete(self, header['batch'], payload, header['metrics'])
+                batch = server.queue.lease(self)
+                if batch == DONE:
+                    send_message(self.request, {'type': 'done'})
+                    break
+                if batch is None:
+                    send_message(self.request, {'type': 'wait', 'seconds': WAIT_TIME})
+                    continue
+                leased.add(batch)
+                send_message(self.request, {'type': 'batch', 'batch': batch}, server.queue.batches[batch])
+        except (OSError, ValueError) as e:
+            logging.warning('Worker connection lost: %s', e)
+        finally:
+            server.queue.release(self, leased)
+
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def start_server(address, work_queue, binary):
+    """
+    Serves the batches of work_queue to the workers connecting to address, in a background thread
+    """
+    (family, addr) = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = UnixServer(addr, WorkQueueHandler)
+    else:
+        server = TCPServer(addr, WorkQueueHandler)
+    server.queue = work_queue
+    server.name = os.path.basename(binary)
+    with open(binary, 'rb') as f:
+        server.binary = f.read()
+    server.digest = hashlib.sha256(server.binary).hexdigest()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def stop_server(server):
+    server.shutdown()
+    server.server_close()
+    if server.address_family == socket.AF_UNIX and os.path.exists(server.server_address):
+        os.remove(server.server_address)
+
+
+def serialize(gadgets):
+    return GadgetStore.from_gadgets(gadgets).to_bytes()
+
+
+def deserialize(payload):
+    return list(GadgetStore.from_bytes(payload))
+
+
+def worker_loop(address, workdir):
+    """
+    Verifies the batches served at address until the coordinator is done
+    """
+    from .GadgetsVerifier import load_project, _set_global_project, do_verify, group_by_address
+    (family, addr) = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(addr)
+    try:
+        send_message(sock, {'type': 'hello', 'worker': '%s:%d' % (socket.gethostname(), os.getpid())})
+        (header, payload) = recv_message(sock)
+        if header is None:
+            return 0
+        # the binary is shared by the workers of this host
+        binary = os.path.join(workdir, header['sha256'], header['name'])
+        if not os.path.exists(binary):
+            os.makedirs(os.path.dirname(binary), exist_ok=True)
+            (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(binary))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp, binary)
+        _set_global_project(load_project(binary))
+        send_message(sock, {'type': 'request'})
+        batches = 0
+        while True:
+            (header, payload) = recv_message(sock)
+            if header is None or header['type'] == 'done':
+                return batches
+            if header['type'] == 'wait':
+                time.sleep(header['seconds'])
+                send_message(sock, {'type': 'request'})
+                continue
+            Metrics.take()
+            verified_gadgets = []
+            for gad_list in group_by_address(deserialize(payload)).values():
+                verified_gadgets += do_verify(gad_list)
+            send_message(sock, {'type': 'result', 'batch': header['batch'], 'metrics': Metrics.encode(Metrics.take())},
+                         serialize(verified_gadgets))
+            batches += 1
+    finally:
+        sock.close()
+
+
+def _worker_process(address, workdir):
+    try:
+        batches = worker_loop(address, workdir)
+        logging.info('Worker %d verified %d batches', os.getpid(), batches)
+    except (OSError, ValueError) as e:
+        print ('[-] worker %d: %s' % (os.getpid(), e))
+
+
+def run_workers(address, processes=None):
+    """
+    Runs processes workers verifying the batches served at address
+    """
+    processes = processes or os.cpu_count()
+    workdir = tempfile.mkdtemp(prefix='ropd-worker-')
+    try:
+        workers = [multiprocessing.Process(target=_worker_process, args=(address, workdir)) for i in range(processes)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+    finally:
+        shutil.rmtree(workdir)
@@ -5,17 +5,30 @@ __copyright__ = "Copyright 2021, ROPD Project"
 __license__ = "BSD 2-clause"
 __email__ = "pietro.borrello95@gmail.com"
 
-import logging
-logging.basicConfig(filename='ropd.log',filemode='w', format='%(asctime)s %(levelname)s: %(message)s', datefmt='%H:%M:%S',level=logging.DEBUG) 
-# mask angr infos
-logging.getLogger('angr').setLevel(logging.CRITICAL)
-logging.getLogger('cle').setLevel(logging.CRITICAL)
-logging.getLogger('claripy').setLevel(logging.CRITICAL)
-logging.getLogger('pyvex').setLevel(logging.CRITICAL)
-logging.getLogger('ana').setLevel(logging.CRITICAL)
-
-from .GadgetsCollector import GadgetsCollector
-from .GadgetsVerifier import GadgetsVerifier
-from .GadgetsCombiner import GadgetsCombiner
-from .GadgetBox import GadgetBox
-from .RopChainKernel import RopChainKernel
+import importlib
+import sys
+import types
+
+# exported classes, imported on first access since their modules load angr, ropper, unicorn, networkx and lief.
+# Each class is defined in the module with the same name
+EXPORTS = ('GadgetsCollector', 'GadgetsVerifier', 'GadgetsCombiner', 'GadgetBox', 'RopChainKernel')
+
+__all__ = list(EXPORTS)
+
+
+class Package(types.ModuleType):
+    def __setattr__(self, name, value):
+        # importing a submodule binds it in the package: keep exporting the class instead
+        if name in EXPORTS and isinstance(value, types.ModuleType):
+            value = getattr(value, name)
+        super(Package, self).__setattr__(name, value)
+
+
+def __getattr__(name):
+    if name not in EXPORTS:
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+    importlib.import_module('.' + name, __name__)
+    return globals()[name]
+
+
+sys.modules[__name__].__class__ = Package
@@ -7,130 +7,267 @@ __email__ = "pietro.borrello95@gmail.com"
 
 
 import logging
-import json
-from enum import Enum
-from itertools import groupby
+import os
+import sys
 
 import argparse
-import pickle
-
-logging.basicConfig(filename='ropd.log',filemode='w', format='%(asctime)s %(levelname)s: %(message)s', datefmt='%H:%M:%S',level=logging.DEBUG) 
-# mask angr infos
-logging.getLogger('angr').setLevel(logging.CRITICAL)
-logging.getLogger('cle').setLevel(logging.CRITICAL)
-logging.getLogger('claripy').setLevel(logging.CRITICAL)
-logging.getLogger('pyvex').setLevel(logging.CRITICAL)
-logging.getLogger('ana').setLevel(logging.CRITICAL)
-
-
-from .GadgetsCollector import GadgetsCollector
-from .GadgetsVerifier import GadgetsVerifier
-from .GadgetsCombiner import GadgetsCombiner
-from .GadgetBox import GadgetBox
-from .RopChainKernel import RopChainKernel
-from .Gadget import Gadget
-
-COLLECTED_EXTENSION = '.collected'
-VERIFIED_EXTENSION = '.verified'
-TEST_EXTENSION = '.test'
-JSON_EXTENSION = '.json'
 
+from . import Profiler
+from . import Metrics
+from .Metrics import METRICS_EXTENSION
+from .GadgetsJournal import GadgetsJournal, JOURNAL_EXTENSION
+from .BinaryInfo import load_info
+from .GadgetStore import save_gadgets, load_gadgets, count_types, print_stats, COLLECTED_EXTENSION, VERIFIED_EXTENSION
 
-def collect(binary, do_print=False):
-    gadgets_collector = GadgetsCollector(binary)
-    typed_gadgets = gadgets_collector.analyze()
+LOG_FILE = 'ropd.log'
+TEST_EXTENSION = '.test'
+# loggers of angr and its dependencies, too verbose
+QUIET_LOGGERS = ('angr', 'cle', 'claripy', 'pyvex', 'ana')
+
+
+def setup_logging(filename=LOG_FILE, level=logging.INFO):
+    logging.basicConfig(filename=filename, filemode='a', format='%(asctime)s %(levelname)s: %(message)s', datefmt='%H:%M:%S', level=level)
+    # mask angr infos
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.CRITICAL)
+
+
+def open_journal(filename, input_filename, resume):
+    """
+    Returns the journal checkpointing the results saved in filename, loaded from a previous run if resume
+    """
+    journal = GadgetsJournal(filename + JOURNAL_EXTENSION, input_filename)
+    if resume:
+        done = journal.resume()
+        if not done:
+            print ('Nothing to resume from', journal.filename)
+    return journal
+
+def collect(binary, do_print=False, resume=False, inst_count=None):
+    from .GadgetsCollector import GadgetsCollector, INST_COUNT
+    journal = open_journal(binary + COLLECTED_EXTENSION, binary, resume)
+    gadgets_collector = GadgetsCollector(binary, inst_count=inst_count or INST_COUNT)
+    typed_gadgets = gadgets_collector.analyze(journal=journal)
     if do_print:
         for g in typed_gadgets:
             print (g)
-    with open(binary + COLLECTED_EXTENSION, 'wb') as collected_file:
-        pickle.dump(typed_gadgets, collected_file)
+    save_gadgets(binary + COLLECTED_EXTENSION, typed_gadgets)
+    gadgets_collector.info.save()
+    journal.close()
     print ('Collected gadgets saved in', binary + COLLECTED_EXTENSION)
+    print ('Collection metrics saved in', Metrics.save(binary + METRICS_EXTENSION, 'collect'))
     return typed_gadgets
 
-def verify(binary, do_print=False):
+def check_info(binary):
+    """
+    Returns the BinaryInfo of binary, or None if its gadgets were collected from a different content
+    """
+    try:
+        return load_info(binary)
+    except Exception as e:
+        print ('ERROR: %s' % e)
+
+def verify(binary, do_print=False, resume=False, serve=None, batch_size=None, lease_timeout=None):
+    from .GadgetsVerifier import GadgetsVerifier
     try:
-        with open(binary + COLLECTED_EXTENSION, 'rb') as collected_file:
-            typed_gadgets = pickle.load(collected_file)
+        typed_gadgets = load_gadgets(binary + COLLECTED_EXTENSION)
     except IOError as e:
         print ('ERROR: %s' % e)
         print ('Did you collected gadget before verification?')
         return
+    if check_info(binary) is None:
+        return
+    journal = open_journal(binary + VERIFIED_EXTENSION, binary + COLLECTED_EXTENSION, resume)
     gadgets_verifier = GadgetsVerifier(binary, typed_gadgets)
-    verified_gadgets = gadgets_verifier.verify()
+    if serve is not None:
+        from . import WorkQueue
+        verified_gadgets = gadgets_verifier.serve(serve, batch_size=batch_size or WorkQueue.BATCH_SIZE,
+                                                  lease_timeout=lease_timeout or WorkQueue.LEASE_TIMEOUT, journal=journal)
+    else:
+        verified_gadgets = gadgets_verifier.verify(journal=journal)
     if do_print:
         for g in verified_gadgets:
             print (g)
-    with open(binary + VERIFIED_EXTENSION, 'wb') as collected_file:
-        pickle.dump(verified_gadgets, collected_file)
+    save_gadgets(binary + VERIFIED_EXTENSION, verified_gadgets)
+    journal.close()
     print ('Verified gadgets saved in', binary + VERIFIED_EXTENSION)
+    print ('Verification metrics saved in', Metrics.save(binary + METRICS_EXTENSION, 'verify'))
     return verified_gadgets
 
-def dump_file(binary):
+def dump_file(binary, ordered=True):
+    from .GadgetsExporter import GadgetsExporter
     try:
-        with open(binary + VERIFIED_EXTENSION, 'rb') as collected_file:
-            typed_gadgets = pickle.load(collected_file)
-            for (_type,group) in groupby(sorted(typed_gadgets, key=lambda g: (g.__class__.__name__)), lambda g: (g.__class__.__name__)):
-                for g in sorted(group, key=lambda g: (len(g.mem[0]), len(g.modified_regs), g.stack_fix)):
-                    print (g)
-                    print (g.dump())
-            
+        typed_gadgets = load_gadgets(binary + VERIFIED_EXTENSION)
+        GadgetsExporter(typed_gadgets).export(sys.stdout, 'text', ordered=ordered)
     except IOError as e:
         print ('ERROR: %s' % e)
         print ('Did you collected and verified gadgets before?')
         return
 
 
-def to_json(obj):
-    if isinstance(obj, Gadget):
-        d = { 'type':obj.__class__.__name__[:obj.__class__.__name__.find('_Gadget')], 
-              'disasm':obj.disasm(), 'params':obj.param_str()}
-        d.update(obj.__dict__)
-        # convert bytearray to str
-        d['hex'] = d['hex'].hex()
-        return d
-    if isinstance(obj, frozenset):
-        return list(obj)
-    elif isinstance(obj, Enum):
-        return obj.name
-    return o.__dict__
-
+def dump_json(binary, fmt='json', ordered=True):
+    from .GadgetsExporter import GadgetsExporter, EXTENSIONS
+    filename = binary + EXTENSIONS[fmt]
+    try:
+        typed_gadgets = load_gadgets(binary + VERIFIED_EXTENSION)
+        GadgetsExporter(typed_gadgets).export_file(filename, fmt, ordered=ordered)
+    except IOError as e:
+        print ('ERROR: %s' % e)
+        print ('Did you collected and verified gadgets before?')
+        return
+    print ('%s gadgets saved in' % fmt.capitalize(), filename)
 
-def dump_json(binary):
+def index(binary, db):
+    from .GadgetsIndex import GadgetsIndex
     try:
-        with open(binary + VERIFIED_EXTENSION, 'rb') as collected_file:
-            with open(binary + JSON_EXTENSION, 'w') as json_file:
-                typed_gadgets = pickle.load(collected_file)
-                json_file.write('[')
-                ordered_gadgets = list(sorted(typed_gadgets, key=lambda g: (g.__class__.__name__, 'unknown' in g.mem[0], len(g.mem[0]), len(g.modified_regs), g.stack_fix)))
-                for g in ordered_gadgets[:-1]:
-                    json_file.write(json.dumps(g, default=to_json, ensure_ascii=False))
-                    json_file.write(',')
-                g = ordered_gadgets[-1]
-                json_file.write(json.dumps(g, default=to_json, ensure_ascii=False))
-                json_file.write(']')
+        typed_gadgets = load_gadgets(binary + VERIFIED_EXTENSION)
     except IOError as e:
         print ('ERROR: %s' % e)
         print ('Did you collected and verified gadgets before?')
         return
-    print ('Json gadgets saved in', binary + JSON_EXTENSION)
+    gadgets_index = GadgetsIndex(db)
+    count = gadgets_index.add(binary, typed_gadgets)
+    gadgets_index.close()
+    print ('%d gadgets indexed in' % count, db)
+
+def query(argv):
+    from .GadgetsIndex import GadgetsIndex
+    parser = argparse.ArgumentParser(prog='ropd query',
+        description="query a gadgets database built with --index")
+
+    parser.add_argument('db', help="gadgets database")
+
+    parser.add_argument('terms', nargs='*', help="filters, e.g. type=WriteMem addr_reg=rdi unknown=0 stack_fix<=16 preserves=rbx")
+
+    parser.add_argument('--limit', help="maximum number of gadgets printed", type=int, default=None)
+
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.db):
+        print ('ERROR: %s does not exist' % args.db)
+        return
+    gadgets_index = GadgetsIndex(args.db)
+    try:
+        rows = gadgets_index.query(args.terms, limit=args.limit)
+    except Exception as e:
+        print ('ERROR: %s' % e)
+        return
+    finally:
+        gadgets_index.close()
+    for (binary, address, _type, params, disasm, stack_fix) in rows:
+        print ('%s: 0x%x %s(%s) %s [stack_fix = %d]' % (binary, address, _type, params, disasm, stack_fix))
+    print ('[+] %d gadgets found' % len(rows))
+
+def serve_verify(argv):
+    parser = argparse.ArgumentParser(prog='ropd verify',
+        description="verify the collected gadgets of a binary, serving batches of gadgets to workers started with: ropd worker")
+
+    parser.add_argument('binary', help="input binary")
+
+    parser.add_argument('--serve', help="address the workers connect to: host:port or a unix socket path", metavar='ADDR', required=True)
+
+    parser.add_argument('--batch-size', help="gadget addresses in each batch (default: 16)", type=int, default=None)
+
+    parser.add_argument('--lease', help="seconds after which a batch not completed is given to another worker (default: 300)", type=int, default=None)
+
+    parser.add_argument("--resume", help="resume an interrupted verification from its journal", action="store_true")
+
+    add_debug_argument(parser)
+
+    args = parser.parse_args(argv)
+    start_debug(args)
+    verify(args.binary, resume=args.resume, serve=args.serve, batch_size=args.batch_size, lease_timeout=args.lease)
+
+def worker(argv):
+    from . import WorkQueue
+    parser = argparse.ArgumentParser(prog='ropd worker',
+        description="verify the batches of gadgets served by: ropd verify --serve")
+
+    parser.add_argument('--connect', help="address of the coordinator: host:port or a unix socket path", metavar='ADDR', required=True)
+
+    parser.add_argument('-j', '--processes', help="number of worker processes (default: number of cpus)", type=int, default=None)
+
+    add_debug_argument(parser)
+
+    args = parser.parse_args(argv)
+    start_debug(args)
+    WorkQueue.run_workers(args.connect, args.processes)
+
+def serve(argv):
+    from .GadgetsDaemon import GadgetsDaemon, SOCKET_FILE, MEMORY_CAP
+    parser = argparse.ArgumentParser(prog='ropd serve',
+        description="keep the verified gadgets of the queried binaries loaded, and answer chain and gadget queries on a unix socket")
+
+    parser.add_argument('--socket', help="unix socket path (default: %s)" % SOCKET_FILE, default=SOCKET_FILE)
+
+    parser.add_argument('--memory-cap', help="MB of memory used by the loaded binaries before evicting the least recently used (default: %d)" % (MEMORY_CAP // (1024 * 1024)),
+                        type=int, default=MEMORY_CAP // (1024 * 1024))
+
+    args = parser.parse_args(argv)
+    GadgetsDaemon(args.socket, args.memory_cap * 1024 * 1024).run()
+
+def add_profile_arguments(parser):
+    parser.add_argument('--profile', help="print the time spent in each stage of the analysis, summed over the workers", action="store_true")
+
+    parser.add_argument('--profile-dir', help="also save the cProfile stats of each process in DIR (implies --profile)", metavar='DIR', default=None)
+
+def add_debug_argument(parser):
+    parser.add_argument('--debug', help="also log each discarded gadget and emulation error to %s" % LOG_FILE, action="store_true")
+
+def start_debug(args):
+    # set before starting the pools, inherited by their workers
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+def start_profile(args):
+    if args.profile or args.profile_dir:
+        Profiler.enable(args.profile_dir)
+
+def corpus(argv):
+    from .GadgetsCorpus import GadgetsCorpus
+    parser = argparse.ArgumentParser(prog='ropd corpus',
+        description="collect and verify the gadgets of all the binaries in a directory, sharing the worker pools")
+
+    parser.add_argument('directory', help="directory containing the binaries, searched recursively")
+
+    parser.add_argument('--summary', help="aggregated summary file (default: <directory>/ropd-corpus.json)", default=None)
+
+    parser.add_argument('-j', '--processes', help="number of processes of each pool (default: number of cpus)", type=int, default=None)
+
+    add_profile_arguments(parser)
+
+    add_debug_argument(parser)
+
+    args = parser.parse_args(argv)
+    start_debug(args)
+    start_profile(args)
+    gadgets_corpus = GadgetsCorpus(args.directory, processes=args.processes)
+    summary = gadgets_corpus.run()
+    Profiler.report()
+    filename = gadgets_corpus.save_summary(summary, args.summary)
+    for s in summary['binaries']:
+        print ('*', s['binary'], '%d collected, %d verified' % (s.get('collected', 0), s.get('verified', 0)) + (' (ERROR: %s)' % s['error'] if 'error' in s else ''))
+    print ('Summary saved in', filename)
 
 def stats(binary):
     try:
-        with open(binary + VERIFIED_EXTENSION, 'rb') as collected_file:
-            gadgets = pickle.load(collected_file)
-            gadgets_combiner = GadgetsCombiner(binary, gadgets)
-            gadgets_combiner.stats()
+        # the counts of a gadget store are in its header, no need to read the gadgets
+        print_stats(count_types(load_gadgets(binary + VERIFIED_EXTENSION)))
     except IOError as e:
         print ('ERROR: %s' % e)
         print ('Did you collected and verified gadgets before?')
         return
 
-def execve(binary):
+def execve(binary, validate=False, max_bytes=None):
+    from .GadgetsCombiner import GadgetsCombiner
     try:
-        with open(binary + VERIFIED_EXTENSION, 'rb') as collected_file:
-            gadgets = pickle.load(collected_file)
-            gadgets_combiner = GadgetsCombiner(binary, gadgets)
-            gadgets_combiner.execve()
+        gadgets = load_gadgets(binary + VERIFIED_EXTENSION, types=GadgetsCombiner.CHAIN_GADGET_TYPES)
+        info = check_info(binary)
+        if info is None:
+            return
+        gadgets_combiner = GadgetsCombiner(binary, gadgets, info)
+        chain = gadgets_combiner.execve(validate=validate, max_bytes=max_bytes)
+        if chain:
+            print (chain.dump())
     except IOError as e:
         print ('ERROR: %s' % e)
         print ('Did you collected and verified gadgets before?')
@@ -139,19 +276,23 @@ def execve(binary):
     
 def diff(binary):
     try:
-        with open(binary + VERIFIED_EXTENSION, 'rb') as file1:
-            l1 = pickle.load(file1)
-            logging.info("Diffing")
-            typed_gadgets2 = collect(binary)
-            l2 = verify(binary)
-            for l in l1:
-                if l not in l2:
-                    print ('[+]', l)
-                    print (l.dump())
-            for l in l2:
-                if l not in l1:
-                    print ('[-]', l)
-                    print (l.dump())
+        l1 = dict((g, g) for g in load_gadgets(binary + VERIFIED_EXTENSION))
+        logging.info("Diffing")
+        typed_gadgets2 = collect(binary)
+        l2 = dict((g, g) for g in verify(binary))
+        for l in l1:
+            if l not in l2:
+                print ('[+]', l)
+                print (l.dump())
+        for l in l2:
+            if l not in l1:
+                print ('[-]', l)
+                print (l.dump())
+            elif not l.same_analysis(l1[l]):
+                # same gadget, different modified registers, memory accesses or stack fix
+                print ('[*]', l1[l])
+                print ('[*]', l)
+                print (l.dump())
     except IOError as e:
         print ('ERROR: %s' % e)
         print ('You need to have something to compute the delta from! Try to collect and verify gadgets first')
@@ -159,6 +300,18 @@ def diff(binary):
 
 
 def main():
+    setup_logging()
+    if len(sys.argv) > 1 and sys.argv[1] == 'query':
+        return query(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'corpus':
+        return corpus(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'verify':
+        return serve_verify(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        return worker(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        return serve(sys.argv[2:])
+
     parser = argparse.ArgumentParser(
         description="This is RopDaemon, a fast rop-gadget compiler")
     
@@ -170,38 +323,68 @@ def main():
 
     parser.add_argument('-v', "--verify", help="formally verify collected gadgets", action="store_true")
 
+    parser.add_argument("--resume", help="resume an interrupted collection or verification from its journal", action="store_true")
+
+    parser.add_argument('--inst-count', help="maximum number of instructions of the collected gadgets (default: 6)", metavar='N', type=int, default=None)
+
     parser.add_argument('-e', "--execve", help="generate a ropchain to perform an execve(\"/bin/sh\") syscall", action="store_true")
 
     parser.add_argument( '-d', '--dump', help="dump gadgets file to a readable format", action="store_true")
 
     parser.add_argument( '-j', '--json', help="dump gadgets file to json format", action="store_true")
 
+    parser.add_argument('--format', help="format of the gadgets file dumped with -j", choices=['json', 'ndjson', 'csv'], default='json')
+
+    parser.add_argument('--unsorted', help="dump gadgets in the order they are stored, without sorting them", action="store_true")
+
     parser.add_argument('--stats', help="statistics about verified gadgets", action="store_true")
 
+    parser.add_argument('--index', help="add verified gadgets to a database, see: ropd query -h", metavar='DB', default=None)
+
+    parser.add_argument('--validate', help="validate generated ropchains by emulating them", action="store_true")
+
+    parser.add_argument('--max-bytes', help="maximum size in bytes of generated ropchains", type=lambda x: int(x, 0), default=None)
+
+    add_profile_arguments(parser)
+
+    add_debug_argument(parser)
+
     # parser.add_argument('--diff', help="compute another gadget verification and diff with the actual version [AND OVVERRIDE CURRENT VERSION]", action="store_true")
 
     args = parser.parse_args()
+    start_debug(args)
     logging.info('Starting analysis of %s', args.binary)
+    start_profile(args)
 
     if args.collect:
-        typed_gadgets = collect(args.binary)
+        with Profiler.stage('collect'):
+            typed_gadgets = collect(args.binary, resume=args.resume, inst_count=args.inst_count)
 
     if args.verify:
-        verified_gadgets = verify(args.binary)
+        with Profiler.stage('verify'):
+            verified_gadgets = verify(args.binary, resume=args.resume)
 
     if args.dump:
-        dump_file(args.binary)
+        dump_file(args.binary, ordered=not args.unsorted)
     if args.json:
-        dump_json(args.binary)
+        with Profiler.stage('json'):
+            dump_json(args.binary, fmt=args.format, ordered=not args.unsorted)
 
     if args.stats:
         stats(args.binary)
 
+    if args.index:
+        with Profiler.stage('index'):
+            index(args.binary, args.index)
+
     # if args.diff:
     #     diff(args.binary)
 
     if args.execve:
-        execve(args.binary)
+        with Profiler.stage('execve'):
+            execve(args.binary, validate=args.validate, max_bytes=args.max_bytes)
+
+    Profiler.report()
     
     
 